@@ -0,0 +1,118 @@
+"""
+本地行动策略 - 由状态直接决定的行动不再请求大模型
+"""
+import random
+from typing import Callable, Dict, List, Optional
+from config import ACTION_POLICY, RESOURCE_TYPES, WORLD_SIZE
+
+
+class ActionRule:
+    """一条本地规则：condition(npc)成立时由action(npc)直接给出行动"""
+
+    def __init__(self, name: str, condition: Callable, action: Callable):
+        self.name = name
+        self.condition = condition
+        self.action = action
+
+
+def _food_count(npc) -> int:
+    return npc.inventory.get("鱼", 0) + npc.inventory.get("果实", 0)
+
+
+def _gatherable(npc) -> List[Dict]:
+    """附近还能装进背包的资源，按对应库存的空余比例从大到小排序"""
+    candidates = []
+    for resource in npc.nearby_resources:
+        key = RESOURCE_TYPES[resource["type"]]["gather"]
+        limit = npc.INVENTORY_LIMITS.get(key)
+        if limit is None or resource["amount"] <= 0:
+            continue
+        free = limit - npc.inventory.get(key, 0)
+        if free > 0:
+            candidates.append((free / limit, resource))
+    candidates.sort(key=lambda item: item[0], reverse=True)
+    return [resource for _, resource in candidates]
+
+
+def _explore_target(npc) -> Dict:
+    """在岛屿范围内随机选择一个探索目标"""
+    center = WORLD_SIZE // 2
+    radius = ACTION_POLICY["explore_radius"]
+    return {"x": round(random.uniform(center - radius, center + radius), 1),
+            "y": round(random.uniform(center - radius, center + radius), 1)}
+
+
+def default_rules() -> List[ActionRule]:
+    """默认规则，按顺序匹配"""
+    low_energy = ACTION_POLICY["low_energy"]
+    return [
+        ActionRule(
+            "drink_when_low",
+            lambda npc: npc.energy < low_energy and npc.inventory.get("水", 0) > 0,
+            lambda npc: {"action": "drink", "target": None, "details": "能量低，先喝水", "volume": None}
+        ),
+        ActionRule(
+            "eat_when_low",
+            lambda npc: npc.energy < low_energy and _food_count(npc) > 0,
+            lambda npc: {"action": "eat", "target": None, "details": "能量低，吃点东西", "volume": None}
+        ),
+        # 以下规则只在附近没有其他NPC时生效，有人时交给大模型处理社交决策
+        ActionRule(
+            "gather_nearby",
+            lambda npc: not npc.nearby_npcs and bool(_gatherable(npc)),
+            lambda npc: {"action": "gather", "target": _gatherable(npc)[0]["type"],
+                         "details": "采集附近的资源", "volume": None}
+        ),
+        ActionRule(
+            "move_on_when_full",
+            lambda npc: not npc.nearby_npcs and bool(npc.nearby_resources) and not _gatherable(npc),
+            lambda npc: {"action": "move", "target": _explore_target(npc),
+                         "details": "背包已满，去别处看看", "volume": None}
+        ),
+        ActionRule(
+            "explore_when_alone",
+            lambda npc: not npc.nearby_npcs and not npc.nearby_resources,
+            lambda npc: {"action": "move", "target": _explore_target(npc),
+                         "details": "四处寻找资源", "volume": None}
+        ),
+    ]
+
+
+class RulePolicy:
+    """在请求大模型之前先匹配本地规则，并统计节省的模型调用次数"""
+
+    def __init__(self, rules: Optional[List[ActionRule]] = None,
+                 enabled_rules: Optional[List[str]] = None):
+        rules = rules if rules is not None else default_rules()
+        enabled = enabled_rules if enabled_rules is not None else ACTION_POLICY["enabled_rules"]
+        self.rules = [rule for rule in rules if rule.name in enabled]
+        self.enabled = ACTION_POLICY["enabled"]
+        self.stats = {"evaluated": 0, "avoided_calls": 0, "deferred": 0, "by_rule": {}}
+
+    def match(self, npc) -> Optional[ActionRule]:
+        """返回第一条成立的规则（不计入统计）"""
+        if not self.enabled:
+            return None
+        for rule in self.rules:
+            if rule.condition(npc):
+                return rule
+        return None
+
+    def evaluate(self, npc) -> Optional[Dict]:
+        """匹配规则并给出行动；返回None表示需要交给大模型决策"""
+        self.stats["evaluated"] += 1
+        rule = self.match(npc)
+        if rule is None:
+            return None
+        self.stats["avoided_calls"] += 1
+        self.stats["by_rule"][rule.name] = self.stats["by_rule"].get(rule.name, 0) + 1
+        return rule.action(npc)
+
+    def record_deferred(self):
+        """记录一次交给大模型的决策请求（含预取和批量请求）"""
+        self.stats["deferred"] += 1
+
+    def report(self) -> str:
+        by_rule = ", ".join(f"{name}:{count}" for name, count in self.stats["by_rule"].items())
+        return (f"本地策略: 共评估{self.stats['evaluated']}次，节省模型调用{self.stats['avoided_calls']}次，"
+                f"交给模型{self.stats['deferred']}次 ({by_rule or '无'})")
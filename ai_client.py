@@ -1,130 +1,311 @@
 """
 阿里云百炼AI客户端
 """
-import time
 import json
 import re
-from http import HTTPStatus
-from dashscope import Application
+import asyncio
+import threading
+from typing import Optional, Dict, AsyncIterator
+from llm_provider import LLMProvider, BailianProvider, BATCH_SECTION_HEADER
+from rate_limiter import RateLimitScheduler
+from context_window import ContextWindow, estimate_tokens, message_tokens
+from response_cache import ResponseCache
+from persistence import PersistenceManager
+from token_budget import TokenLedger
+from config import (MODEL_RATE_LIMITS, PRIORITY_CONVERSATION, PRIORITY_DECISION,
+                    RESPONSE_CACHE_PATH, BATCH_ACTION_ROLE)
+
+# 行动决策的系统提示词
+ACTION_SYSTEM_PROMPT = """你需要根据提供的信息决定角色的下一步行动。
+请以JSON格式返回，包含以下字段：
+- action: 行动类型 (move, gather, eat, drink, give, talk, reflect)
+- target: 目标位置(x,y)或目标对象名称，无目标则为null
+- details: 行动细节描述
+- volume: 若为talk行动，需指定volume为"normal"或"loud"，其他行动为null
+
+示例: {"action": "move", "target": {"x": 10.5, "y": 7.2}, "details": "向东北方向移动寻找水源", "volume": null}
+"""
+
+# 批量行动决策的系统提示词
+BATCH_ACTION_SYSTEM_PROMPT = ACTION_SYSTEM_PROMPT + f"""
+本次需要同时为多个角色分别决策，每个角色的信息以"{BATCH_SECTION_HEADER}名字"开头。
+请返回一个JSON数组，每个元素对应一个角色，并额外包含name字段，例如:
+[{{"name": "凯", "action": "move", "target": {{"x": 10.5, "y": 7.2}}, "details": "寻找水源", "volume": null}}]
+"""
+
+# 调用失败时返回的默认行动
+DEFAULT_ACTION_REPLY = '{"action": "rest", "target": null, "details": "暂时休息", "volume": null}'
+
+# 流式队列中的结束标记：后端正常结束 / 中途失败
+_STREAM_DONE = object()
+_STREAM_FAILED = object()
+
 
 class BailianClient:
-    def __init__(self, api_key: str):
+    """NPC和记忆系统使用的大模型客户端
+
+    负责限流、上下文管理和结果解析，实际请求交给可替换的LLMProvider，
+    默认使用百炼应用，也可以换成离线的MockProvider。
+    """
+
+    def __init__(self, api_key: str, provider: Optional[LLMProvider] = None,
+                 cache: Optional[ResponseCache] = None, persistence: Optional[PersistenceManager] = None):
         self.api_key = api_key
-        self.kai_app_id = '3eae9a8c46aa49d596cc10015ff3b11b'
-        self.elara_app_id = '4a1b71350ea54ec6bedd304ac6938709'
-        self.jax_app_id = 'fdcabb9f543e4da8a333902f3f7a4330'
-        self.kai_messages = []
-        self.elara_messages = []
-        self.jax_messages = []
-        self.last_call_time = 0  # 记录上次调用时间
-        self.call_cooldown = 10.0  # 调用冷却时间（秒）
-
-    def generate_response(self, role: str, message: str) -> str:
-        """调用百炼模型生成对应角色的回应"""
-        # 检查冷却时间
-        current_time = time.time()
-        if current_time - self.last_call_time < self.call_cooldown:
-            time.sleep(self.call_cooldown - (current_time - self.last_call_time))
-
-        self.last_call_time = time.time()
+        self.provider = provider or BailianProvider(api_key)
+        self.contexts = {}
+        self.scheduler = RateLimitScheduler(MODEL_RATE_LIMITS)
+        self.cache = cache or ResponseCache(path=RESPONSE_CACHE_PATH, persistence=persistence)
+        self.ledger = TokenLedger()
 
-        try:
-            if role == "凯":
-                app_id = self.kai_app_id
-                messages = self.kai_messages
-            elif role == "伊拉拉":
-                app_id = self.elara_app_id
-                messages = self.elara_messages
-            elif role == "贾克斯":
-                app_id = self.jax_app_id
-                messages = self.jax_messages
-            else:
-                raise ValueError(f"未知角色: {role}")
-
-            messages.append({'role': 'user', 'content': message})
-
-            response = Application.call(
-                api_key=self.api_key,
-                app_id=app_id,
-                messages=messages
-            )
+    def _cache_key(self, role: str, prompt: str, kind: str = "response") -> str:
+        """缓存键包含回答该角色的后端和模型，切换后端或应用后不会用到旧的回复"""
+        return self.cache.make_key(role, prompt, kind, self.provider.model_id(role))
 
-            if response.status_code == HTTPStatus.OK:
-                assistant_reply = response.output.text.strip()
-                messages.append({'role': 'assistant', 'content': assistant_reply})
-                return assistant_reply
-            else:
-                print(f"百炼API错误: {response.status_code} - {response.message}")
-                if messages and messages[-1]['role'] == 'user':
-                    messages.pop()
-                return ""
+    def _resolve_role(self, role: str, strict: bool = True):
+        """返回角色对应的限流键和上下文窗口"""
+        route = self.provider.route(role, strict)
+        context = self.contexts.get(role)
+        if context is None:
+            context = self.contexts[role] = ContextWindow()
+        return route, context
+
+    def supports_batch_actions(self) -> bool:
+        """后端为BATCH_ACTION_ROLE配置了单独的路由时才能批量决策
 
+        百炼后端没有配置时会落到默认角色的应用，所有NPC的决策都由该角色的应用
+        回答并占用它的限流名额，因此不批量。
+        """
+        try:
+            self.provider.route(BATCH_ACTION_ROLE)
+        except ValueError:
+            return False
+        return True
+
+    def _call_application(self, role: str, messages: list, expect_json: bool = False) -> Optional[str]:
+        """同步调用大模型后端，成功返回文本，失败返回None"""
+        try:
+            return self.provider.complete(role, messages, expect_json)
         except Exception as e:
+            print(f"调用大模型失败: {str(e)}")
+            return None
+
+    def _record_usage(self, role: str, call_site: str, messages: list, reply: Optional[str]):
+        """记录一次请求的提示词和回复大小"""
+        self.ledger.record(role, call_site, sum(message_tokens(m) for m in messages),
+                           estimate_tokens(reply or ""))
+
+    @staticmethod
+    def _extract_action_json(action_reply: str) -> str:
+        """提取回复中的JSON部分"""
+        json_match = re.search(r'\{.*\}', action_reply, re.DOTALL)
+        if json_match:
+            return json_match.group()
+        return action_reply
+
+    @staticmethod
+    def _build_batch_prompt(prompts: Dict[str, str]) -> str:
+        return "\n\n".join(f"{BATCH_SECTION_HEADER}{name}\n{prompt}" for name, prompt in prompts.items())
+
+    @staticmethod
+    def _parse_batch_actions(reply: str, names) -> Dict[str, str]:
+        """解析批量决策回复，返回成功解析的条目（角色名 -> 行动JSON）"""
+        items = []
+        array_match = re.search(r'\[.*\]', reply, re.DOTALL)
+        if array_match:
+            try:
+                items = json.loads(array_match.group())
+            except json.JSONDecodeError:
+                items = []
+        if not isinstance(items, list) or not items:
+            # 数组整体无法解析时，逐个对象尝试
+            items = []
+            for obj in re.findall(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', reply):
+                try:
+                    items.append(json.loads(obj))
+                except json.JSONDecodeError:
+                    continue
+
+        parsed = {}
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get("action"), str):
+                continue
+            name = item.get("name")
+            if name in names and name not in parsed:
+                entry = {k: v for k, v in item.items() if k != "name"}
+                parsed[name] = json.dumps(entry, ensure_ascii=False)
+        return parsed
+
+    def _record_batch_results(self, prompts: Dict[str, str], results: Dict[str, str]):
+        """把批量决策结果写入各角色的上下文和缓存"""
+        for name, action_reply in results.items():
+            _, context = self._resolve_role(name, strict=False)
+            context.append({'role': 'user', 'content': prompts[name]},
+                           {'role': 'assistant', 'content': action_reply})
+            self.cache.put(self._cache_key(name, prompts[name], "action"), action_reply)
+
+    def _cached_batch_entries(self, prompts: Dict[str, str]) -> Dict[str, str]:
+        """批量请求前先取出已缓存的条目"""
+        cached = {}
+        for name, prompt in prompts.items():
+            action_reply = self.cache.get(self._cache_key(name, prompt, "action"))
+            if action_reply is not None:
+                cached[name] = action_reply
+        return cached
+
+    async def agenerate_response(self, role: str, message: str,
+                                 priority: int = PRIORITY_CONVERSATION,
+                                 call_site: str = "response") -> str:
+        """调用大模型生成对应角色的回应，排队和网络请求期间不阻塞事件循环"""
+        try:
+            route, context = self._resolve_role(role)
+        except ValueError as e:
             print(f"调用百炼模型失败: {str(e)}")
-            if messages and messages[-1]['role'] == 'user':
-                messages.pop()
             return ""
 
-    def generate_action(self, role: str, prompt: str) -> str:
-        """调用百炼模型生成角色行动决策"""
-        # 检查冷却时间
-        current_time = time.time()
-        if current_time - self.last_call_time < self.call_cooldown:
-            time.sleep(self.call_cooldown - (current_time - self.last_call_time))
+        user_message = {'role': 'user', 'content': message}
+        cache_key = self._cache_key(role, message)
+        assistant_reply = self.cache.get(cache_key)
+        if assistant_reply is None:
+            # 发送历史快照，多个请求同时进行时互不干扰
+            request = context.build([user_message])
+            async with self.scheduler.slot(route, priority):
+                assistant_reply = await asyncio.to_thread(self._call_application, role, request)
+            self._record_usage(role, call_site, request, assistant_reply)
+            if assistant_reply is None:
+                return ""
+            self.cache.put(cache_key, assistant_reply)
+        else:
+            self.ledger.record_cached(role, call_site)
 
-        self.last_call_time = time.time()
+        context.append(user_message, {'role': 'assistant', 'content': assistant_reply})
+        return assistant_reply
 
+    async def astream_response(self, role: str, message: str,
+                               priority: int = PRIORITY_CONVERSATION,
+                               call_site: str = "response") -> AsyncIterator[str]:
+        """流式生成回应，逐段产出文本；完整结束后才写入上下文和缓存
+
+        后端中途失败时已产出的部分不写入上下文和缓存，产出最后一段之后抛出后端的
+        异常，调用方据此知道这句话没有说完；调用方取消或提前关闭时通知工作线程
+        停止读取，并发名额随即归还。
+        """
         try:
-            if role == "凯":
-                app_id = self.kai_app_id
-                messages = self.kai_messages
-            elif role == "伊拉拉":
-                app_id = self.elara_app_id
-                messages = self.elara_messages
-            else:
-                app_id = self.jax_app_id
-                messages = self.jax_messages
-
-            system_prompt = """你需要根据提供的信息决定角色的下一步行动。
-请以JSON格式返回，包含以下字段：
-- action: 行动类型 (move, gather, eat, drink, give, talk, reflect)
-- target: 目标位置(x,y)或目标对象名称，无目标则为null
-- details: 行动细节描述
-- volume: 若为talk行动，需指定volume为"normal"或"loud"，其他行动为null
+            route, context = self._resolve_role(role)
+        except ValueError as e:
+            print(f"调用百炼模型失败: {str(e)}")
+            return
 
-示例: {"action": "move", "target": {"x": 10.5, "y": 7.2}, "details": "向东北方向移动寻找水源", "volume": null}
-"""
-            messages.append({'role': 'system', 'content': system_prompt})
-            messages.append({'role': 'user', 'content': prompt})
+        user_message = {'role': 'user', 'content': message}
+        cache_key = self._cache_key(role, message)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.ledger.record_cached(role, call_site)
+            context.append(user_message, {'role': 'assistant', 'content': cached})
+            yield cached
+            return
 
-            response = Application.call(
-                api_key=self.api_key,
-                app_id=app_id,
-                messages=messages
-            )
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stopped = threading.Event()
+        errors = []
+        request = context.build([user_message])
 
-            if response.status_code == HTTPStatus.OK:
-                action_reply = response.output.text.strip()
-                # 提取JSON部分
-                json_match = re.search(r'\{.*\}', action_reply, re.DOTALL)
-                if json_match:
-                    action_reply = json_match.group()
-                messages.append({'role': 'assistant', 'content': action_reply})
-                return action_reply
-            else:
-                print(f"百炼API错误: {response.status_code} - {response.message}")
-                if messages and messages[-1]['role'] == 'user':
-                    messages.pop()
-                if messages and messages[-1]['role'] == 'system':
-                    messages.pop()
-                # 返回默认的有效JSON响应
-                return '{"action": "rest", "target": null, "details": "暂时休息", "volume": null}'
+        def produce():
+            # 在工作线程中读取后端的流，通过队列交回事件循环，最后放入结束或失败标记
+            outcome = _STREAM_DONE
+            chunks = self.provider.stream(role, request)
+            try:
+                for chunk in chunks:
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            except Exception as e:
+                errors.append(e)
+                outcome = _STREAM_FAILED
+            finally:
+                if stopped.is_set():
+                    chunks.close()
+                else:
+                    loop.call_soon_threadsafe(queue.put_nowait, outcome)
 
-        except Exception as e:
-            print(f"调用百炼模型失败: {str(e)}")
-            if messages and messages[-1]['role'] == 'user':
-                messages.pop()
-            if messages and messages[-1]['role'] == 'system':
-                messages.pop()
-            # 返回默认的有效JSON响应
-            return '{"action": "rest", "target": null, "details": "暂时休息", "volume": null}'
\ No newline at end of file
+        parts = []
+        completed = False
+        async with self.scheduler.slot(route, priority):
+            producer = loop.run_in_executor(None, produce)
+            try:
+                while True:
+                    chunk = await queue.get()
+                    if chunk is _STREAM_DONE or chunk is _STREAM_FAILED:
+                        completed = chunk is _STREAM_DONE
+                        break
+                    parts.append(chunk)
+                    yield chunk
+                await producer
+            finally:
+                # 正常结束时无影响；取消或提前关闭时让工作线程不再读取和回传
+                stopped.set()
+
+        assistant_reply = "".join(parts).strip()
+        self._record_usage(role, call_site, request, assistant_reply)
+        if not completed:
+            raise errors[0]
+        if assistant_reply:
+            context.append(user_message, {'role': 'assistant', 'content': assistant_reply})
+            self.cache.put(cache_key, assistant_reply)
+
+    async def agenerate_action(self, role: str, prompt: str,
+                               priority: int = PRIORITY_DECISION,
+                               call_site: str = "decide_action") -> str:
+        """调用大模型生成角色行动决策，排队和网络请求期间不阻塞事件循环"""
+        route, context = self._resolve_role(role, strict=False)
+        user_message = {'role': 'user', 'content': prompt}
+        cache_key = self._cache_key(role, prompt, "action")
+        action_reply = self.cache.get(cache_key)
+        if action_reply is None:
+            request = context.build([user_message], system_prompt=ACTION_SYSTEM_PROMPT)
+            async with self.scheduler.slot(route, priority):
+                action_reply = await asyncio.to_thread(self._call_application, role, request, True)
+            self._record_usage(role, call_site, request, action_reply)
+            if action_reply is None:
+                return DEFAULT_ACTION_REPLY
+            action_reply = self._extract_action_json(action_reply)
+            self.cache.put(cache_key, action_reply)
+        else:
+            self.ledger.record_cached(role, call_site)
+
+        # 系统提示词只随请求发送，不写入历史
+        context.append(user_message, {'role': 'assistant', 'content': action_reply})
+        return action_reply
+
+    async def agenerate_actions_batch(self, prompts: Dict[str, str],
+                                      priority: int = PRIORITY_DECISION) -> Dict[str, str]:
+        """一次请求为多个角色生成行动决策，返回角色名到行动JSON的映射
+
+        解析失败的条目单独回退到agenerate_action。
+        """
+        results = self._cached_batch_entries(prompts)
+        pending = {name: prompt for name, prompt in prompts.items() if name not in results}
+        if len(pending) > 1:
+            messages = [
+                {'role': 'system', 'content': BATCH_ACTION_SYSTEM_PROMPT},
+                {'role': 'user', 'content': self._build_batch_prompt(pending)}
+            ]
+            route = self.provider.route(BATCH_ACTION_ROLE)
+            async with self.scheduler.slot(route, priority):
+                reply = await asyncio.to_thread(
+                    self._call_application, BATCH_ACTION_ROLE, messages, True
+                )
+            self._record_usage(BATCH_ACTION_ROLE, "decide_action_batch", messages, reply)
+            parsed = self._parse_batch_actions(reply or "", pending)
+            self._record_batch_results(pending, parsed)
+            results.update(parsed)
+
+        missing = [name for name in prompts if name not in results]
+        if missing:
+            if len(prompts) > 1:
+                print(f"批量决策中有{len(missing)}条未能解析，逐个重新请求")
+            fallback = await asyncio.gather(
+                *(self.agenerate_action(name, prompts[name], priority) for name in missing)
+            )
+            results.update(zip(missing, fallback))
+        return results
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+记忆检索基准测试 - 对比逐条打分加全量排序的旧实现与索引加向量化打分的当前实现，
+并在同一候选集上单独对比Python逐条打分加排序与NumPy向量化打分加argpartition取前k
+
+用法: python bench_memory.py [--sizes 10000 100000 1000000] [--queries 20]
+"""
+import math
+import time
+import random
+import argparse
+from memory_system import MemoryStream, MemoryType
+from memory_record import MemoryRecord, MEMORY_TYPE_CODES
+from memory_index import top_k
+
+SAMPLE_CONTENTS = [
+    "我说: 要不要一起去找点吃的？ (音量: normal)", "Bob对我说: 我们得多存一些淡水。",
+    "采集了2份水", "吃了1条鱼，恢复了能量", "喝了1份水，恢复了能量", "结束了一次对话",
+    "决定移动到(12.0, 15.5): 四处寻找资源", "想吃东西，但没有鱼或果实了", "反思总结: 要多和大家合作",
+]
+SAMPLE_TYPES = [MemoryType.ACTION, MemoryType.COMMUNICATION, MemoryType.STATE]
+QUERIES = ["决策", "对话", "Bob 对话"]
+
+
+def linear_retrieve(memories, query: str, limit: int = 5):
+    """旧实现：逐条计算分数后全量排序"""
+    now = time.time()
+    scored = []
+    for mem in memories:
+        recency = math.exp(-0.001 * (now - mem.timestamp))
+        relevance = sum(1 for w in query.split() if w in mem.content) / (len(query.split()) + 1)
+        importance = mem.importance / 10
+        score = 0.4 * relevance + 0.3 * recency + 0.3 * importance
+        scored.append((-score, mem.content))
+    return [c for _, c in sorted(scored)[:limit]]
+
+
+def python_score(stream: MemoryStream, doc_ids, relevance, limit: int = 5):
+    """候选集上逐条计算分数后全量排序（与MemoryColumns.score公式相同）"""
+    now = time.time()
+    scored = []
+    for doc_id, rel in zip(doc_ids.tolist(), relevance.tolist()):
+        memory = stream.memories[doc_id]
+        recency = math.exp(-0.001 * (now - memory.timestamp))
+        score = 0.4 * rel + 0.3 * recency + 0.3 * memory.importance / 10
+        scored.append((-score, doc_id))
+    return [doc_id for _, doc_id in sorted(scored)[:limit]]
+
+
+def numpy_score(stream: MemoryStream, doc_ids, relevance, limit: int = 5):
+    """候选集上向量化打分，argpartition取前k"""
+    scores = stream.columns.score(doc_ids, relevance, time.time())
+    return doc_ids[top_k(scores, limit)].tolist()
+
+
+def candidates(stream: MemoryStream, query: str):
+    """检索使用的候选集和相关性，两种打分方式共用"""
+    if stream.embeddings is not None:
+        return stream._embedding_candidates(query)
+    return stream._keyword_candidates(query)
+
+
+def build_stream(size: int, seed: int = 0) -> MemoryStream:
+    """直接构造内存中的记忆流，不写磁盘"""
+    rng = random.Random(seed)
+    stream = MemoryStream("bench")
+    stream.memories = []
+    stream._rebuild_index()
+    start = time.time() - size
+    for i in range(size):
+        memory = MemoryRecord(start + i, f"{rng.choice(SAMPLE_CONTENTS)} #{i}",
+                              MEMORY_TYPE_CODES[rng.choice(SAMPLE_TYPES).value], rng.randint(1, 9))
+        stream.memories.append(memory)
+        stream._index_memory(i, memory)
+    return stream
+
+
+def timed(fn, repeat: int) -> float:
+    """平均每次调用耗时（毫秒）"""
+    begin = time.perf_counter()
+    for index in range(repeat):
+        fn(QUERIES[index % len(QUERIES)])
+    return (time.perf_counter() - begin) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="记忆检索基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=20, help="每个规模下的查询次数")
+    args = parser.parse_args()
+
+    print(f"{'记忆数':>10} {'旧实现(ms)':>12} {'当前实现(ms)':>14} {'加速比':>8} "
+          f"{'候选数':>8} {'逐条打分(ms)':>14} {'向量化打分(ms)':>16} {'打分加速比':>10}")
+    for size in args.sizes:
+        stream = build_stream(size)
+        # 旧实现在大规模下很慢，减少查询次数
+        linear_repeat = max(1, args.queries * 10000 // max(size, 10000))
+        linear_ms = timed(lambda q: linear_retrieve(stream.memories, q), linear_repeat)
+        current_ms = timed(stream.retrieve, args.queries)
+
+        # 只比较打分和取前k：候选集预先算好，两种方式输入相同
+        pools = {query: candidates(stream, query) for query in QUERIES}
+        pool_size = sum(len(doc_ids) for doc_ids, _ in pools.values()) // len(pools)
+        python_ms = timed(lambda q: python_score(stream, *pools[q]), linear_repeat)
+        numpy_ms = timed(lambda q: numpy_score(stream, *pools[q]), args.queries)
+        print(f"{size:>10} {linear_ms:>12.2f} {current_ms:>14.2f} {linear_ms / current_ms:>7.0f}x "
+              f"{pool_size:>8} {python_ms:>14.2f} {numpy_ms:>16.2f} {python_ms / numpy_ms:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+冷启动基准测试 - 对比从JSON状态文件加载与从二进制检查点恢复世界的耗时和存档大小
+
+用法: python bench_startup.py [--memories 500 2000] [--repeat 5] [--check-resume]
+在临时目录中生成测试数据，不影响data目录。
+--check-resume 只检查从检查点恢复后，下次正常加载的记忆与恢复时一致（JSON和SQLite后端）。
+"""
+import os
+import glob
+import time
+import random
+import argparse
+import tempfile
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame
+from config import SCREEN_WIDTH, SCREEN_HEIGHT, CHECKPOINT_PATH, STORAGE_SQLITE_PATH
+from checkpoint import load_checkpoint, save_checkpoint
+from dialog_system import GlobalDialogSystem
+from memory_record import MemoryRecord, MemoryType, MEMORY_TYPES
+from memory_system import Chronicle
+from persistence import PersistenceManager
+from sqlite_storage import SqliteStorage
+from world import World
+from bench_memory import SAMPLE_CONTENTS
+
+
+def build_world(memories: int, seed: int = 0):
+    """生成一个世界，每个NPC带memories条记忆，同时写出JSON状态和检查点"""
+    rng = random.Random(seed)
+    persistence = PersistenceManager(background=False)
+    world = World(None, GlobalDialogSystem(persistence), Chronicle(persistence=persistence), persistence)
+    start = time.time() - memories
+    for npc in world.npcs:
+        npc.memory.restore([
+            MemoryRecord(start + i, f"{rng.choice(SAMPLE_CONTENTS)} #{i}",
+                         rng.randrange(1, len(MEMORY_TYPES)), rng.randint(1, 9))
+            for i in range(memories)
+        ])
+        npc.save_state()
+    world.save_resources()
+    world.save_world_state()
+    save_checkpoint(CHECKPOINT_PATH, world)
+
+
+def timed_start(resume: bool, repeat: int) -> float:
+    """平均每次构造世界的耗时（毫秒），写盘交给后台线程，不计入"""
+    total = 0.0
+    for _ in range(repeat):
+        persistence = PersistenceManager()
+        begin = time.perf_counter()
+        checkpoint = load_checkpoint(CHECKPOINT_PATH) if resume else None
+        World(None, GlobalDialogSystem(persistence), Chronicle(persistence=persistence), persistence,
+              checkpoint=checkpoint)
+        total += time.perf_counter() - begin
+        persistence.close()
+    return total / repeat * 1000
+
+
+def open_world(backend: str, checkpoint=None):
+    persistence = PersistenceManager()
+    storage = SqliteStorage(STORAGE_SQLITE_PATH) if backend == "sqlite" else None
+    world = World(None, GlobalDialogSystem(persistence, storage),
+                  Chronicle(persistence=persistence, storage=storage), persistence, storage, checkpoint)
+    return world, persistence, storage
+
+
+def close_world(world, persistence, storage):
+    for npc in world.npcs:
+        npc.memory.flush_pending()
+    persistence.close()
+    for npc in world.npcs:
+        npc.memory.close()
+    if storage is not None:
+        storage.close()
+
+
+def memory_state(world):
+    """每个NPC的内存窗口和冷存储中的全部记忆"""
+    state = {}
+    for npc in world.npcs:
+        cold = npc.memory.cold
+        state[npc.name] = ([(m.timestamp, m.content) for m in npc.memory.memories],
+                           sorted((m.timestamp, m.content) for m in cold.latest(len(cold) + 1))
+                           if cold is not None else [])
+    return state
+
+
+def add_memories(world, count: int, rng: random.Random):
+    for npc in world.npcs:
+        for i in range(count):
+            npc.memory.add(f"{rng.choice(SAMPLE_CONTENTS)} @{time.time():.6f}", MemoryType.ACTION,
+                           rng.randint(1, 9))
+
+
+def check_resume(backend: str, memories: int) -> bool:
+    """保存检查点后继续运行，再从检查点恢复：恢复后的记忆与随后正常加载的一致，
+    且不含检查点之后新增的记忆"""
+    rng = random.Random(0)
+    world, persistence, storage = open_world(backend)
+    add_memories(world, memories, rng)
+    for npc in world.npcs:
+        npc.memory.flush_pending()
+    save_checkpoint(CHECKPOINT_PATH, world)
+    add_memories(world, memories // 2, rng)
+    close_world(world, persistence, storage)
+
+    checkpoint = load_checkpoint(CHECKPOINT_PATH)
+    world, persistence, storage = open_world(backend, checkpoint)
+    resumed = memory_state(world)
+    close_world(world, persistence, storage)
+    world, persistence, storage = open_world(backend)
+    reloaded = memory_state(world)
+    close_world(world, persistence, storage)
+    newer = [key for hot, cold in reloaded.values() for key in hot + cold if key[0] > checkpoint.saved_at]
+    return resumed == reloaded and not newer
+
+
+def json_bytes() -> int:
+    paths = [path for pattern in ("npc_*.json", "memory_*.json", "memory_*.jsonl",
+                                  "resources.json", "world_state.json")
+             for path in glob.glob(os.path.join("data", pattern))]
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动基准测试")
+    parser.add_argument("--memories", type=int, nargs="+", default=[500, 2000], help="每个NPC的记忆条数")
+    parser.add_argument("--repeat", type=int, default=5, help="每种方式的启动次数")
+    parser.add_argument("--check-resume", action="store_true", help="只检查恢复后重新加载的一致性")
+    args = parser.parse_args()
+
+    pygame.init()
+    pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    if args.check_resume:
+        for backend in ("json", "sqlite"):
+            with tempfile.TemporaryDirectory() as directory:
+                cwd = os.getcwd()
+                os.chdir(directory)
+                try:
+                    os.makedirs("data")
+                    ok = check_resume(backend, max(args.memories))
+                finally:
+                    os.chdir(cwd)
+            print(f"{backend}: 恢复后重新加载{'一致' if ok else '不一致'}")
+        pygame.quit()
+        return
+    print(f"{'记忆数/NPC':>10} {'JSON(ms)':>10} {'检查点(ms)':>12} {'JSON大小(KB)':>14} {'检查点大小(KB)':>16}")
+    for memories in args.memories:
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                os.makedirs("data")
+                build_world(memories)
+                json_ms = timed_start(False, args.repeat)
+                checkpoint_ms = timed_start(True, args.repeat)
+                print(f"{memories:>10} {json_ms:>10.1f} {checkpoint_ms:>12.1f} "
+                      f"{json_bytes() / 1024:>14.1f} {os.path.getsize(CHECKPOINT_PATH) / 1024:>16.1f}")
+            finally:
+                os.chdir(cwd)
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+世界检查点 - 紧凑的二进制存档（地形和资源网格、NPC生命体征和背包、记忆窗口），一次读取即可恢复
+"""
+import os
+import zlib
+import mmap
+import struct
+import time
+from typing import Dict, List, Optional
+import numpy as np
+from memory_record import MemoryRecord
+from persistence import PersistenceManager
+from config import CHECKPOINT_VECTORS
+
+MAGIC = b"ISCK"
+VERSION = 2
+
+# 文件头：魔数、版本、世界边长、NPC数、天数、时间、保存时间、背包条目数、
+# 记忆条数、向量维度、带向量的字符串数、字符串数、字符串字节数、正文的CRC32
+HEADER = struct.Struct("<4sHHIIddIIHIIII")
+
+# 网格中的空值（没有资源），字符串编号不会用到
+NO_STRING = 0xFFFFFFFF
+
+NPC_DTYPE = np.dtype([
+    ("name", "<u4"),
+    ("x", "<f8"),
+    ("y", "<f8"),
+    ("energy", "<f8"),
+    ("is_dead", "u1"),
+    ("inventory_offset", "<u4"),
+    ("inventory_count", "<u2"),
+    ("memory_offset", "<u4"),
+    ("memory_count", "<u4"),
+])
+INVENTORY_DTYPE = np.dtype([("item", "<u4"), ("amount", "<i4")])
+MEMORY_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("content", "<u4"),
+    ("type_code", "u1"),
+    ("importance", "u1"),
+])
+
+
+class CheckpointError(ValueError):
+    """检查点文件损坏或版本不兼容"""
+
+
+class NPCCheckpoint:
+    """一个NPC在检查点中的状态；saved_at为检查点的保存时间，恢复时据此回退记忆存储"""
+
+    def __init__(self, name: str, x: float, y: float, energy: float, is_dead: bool,
+                 inventory: Dict[str, int], memories: List[MemoryRecord],
+                 vectors: Optional[np.ndarray] = None, saved_at: Optional[float] = None):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.energy = energy
+        self.is_dead = is_dead
+        self.inventory = inventory
+        self.memories = memories
+        self.vectors = vectors
+        self.saved_at = saved_at
+
+
+class Checkpoint:
+    """解码后的检查点"""
+
+    def __init__(self, world_size: int, day: int, time: float, saved_at: float,
+                 tiles: List[List[str]], resources: List[List[Optional[str]]],
+                 amounts: List[List[int]], npcs: Dict[str, NPCCheckpoint]):
+        self.world_size = world_size
+        self.day = day
+        self.time = time
+        self.saved_at = saved_at
+        self.tiles = tiles
+        self.resources = resources
+        self.amounts = amounts
+        self.npcs = npcs
+
+
+class _StringTable:
+    """检查点中所有字符串（地形、资源、名字、物品、记忆内容）去重后只存一份"""
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self._ids: Dict[str, int] = {}
+
+    def id(self, text: str) -> int:
+        string_id = self._ids.get(text)
+        if string_id is None:
+            string_id = self._ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+
+def encode_checkpoint(world, include_vectors: bool = CHECKPOINT_VECTORS) -> bytes:
+    """把世界状态编码为检查点字节串
+
+    依次为：文件头、地形网格(u4)、资源网格(u4)、资源数量(i4)、NPC表、
+    背包条目、记忆记录、记忆向量(i1)、字符串偏移表(u4)和UTF-8字符串数据。
+    NPC表中记录各自背包和记忆在对应数组中的起始位置和条数。
+
+    记忆内容最先登记到字符串表，编号为0..K-1。include_vectors为True时向量表
+    按编号存放这K条内容的检索向量（量化为int8，各分量乘以127），恢复时
+    不必重新计算；不存向量的检查点更小，但恢复时要重新计算。
+    """
+    size = len(world.tiles)
+    strings = _StringTable()
+    dims = {npc.memory.embeddings.dim for npc in world.npcs if npc.memory.embeddings is not None}
+    dim = dims.pop() if (include_vectors and len(dims) == 1
+                         and all(npc.memory.embeddings is not None for npc in world.npcs)) else 0
+    vectors = []
+    memories = []
+    for npc in world.npcs:
+        for doc_id, m in enumerate(npc.memory.memories):
+            content = strings.id(m.content)
+            if dim and content == len(vectors):
+                vectors.append(npc.memory.embeddings.matrix[doc_id])
+            memories.append((m.timestamp, content, m.type_code, m.importance))
+    tiles = np.array([[strings.id(tile) for tile in row] for row in world.tiles], dtype="<u4")
+    resources = np.array([[NO_STRING if kind is None else strings.id(kind) for kind in row]
+                          for row in world.resources], dtype="<u4")
+    amounts = np.array(world.resource_amounts, dtype="<i4")
+
+    npcs = np.zeros(len(world.npcs), dtype=NPC_DTYPE)
+    inventory, memory_offset = [], 0
+    for row, npc in zip(npcs, world.npcs):
+        row["name"] = strings.id(npc.name)
+        row["x"], row["y"], row["energy"] = npc.x, npc.y, npc.energy
+        row["is_dead"] = npc.is_dead
+        row["inventory_offset"], row["inventory_count"] = len(inventory), len(npc.inventory)
+        inventory.extend((strings.id(item), amount) for item, amount in npc.inventory.items())
+        row["memory_offset"], row["memory_count"] = memory_offset, len(npc.memory.memories)
+        memory_offset += len(npc.memory.memories)
+
+    if len(strings.strings) >= NO_STRING:
+        raise CheckpointError(f"字符串过多，无法写入检查点: {len(strings.strings)}")
+    encoded = [text.encode("utf-8") for text in strings.strings]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    blob = b"".join(encoded)
+
+    body = b"".join([
+        tiles.tobytes(), resources.tobytes(), amounts.tobytes(), npcs.tobytes(),
+        np.array(inventory, dtype=INVENTORY_DTYPE).tobytes(),
+        np.array(memories, dtype=MEMORY_DTYPE).tobytes(),
+        np.rint(np.array(vectors, dtype=np.float32).reshape(len(vectors), dim) * 127).astype("i1").tobytes(),
+        offsets.tobytes(), blob,
+    ])
+    header = HEADER.pack(MAGIC, VERSION, size, len(world.npcs), world.day, world.time, time.time(),
+                         len(inventory), len(memories), dim, len(vectors), len(encoded), len(blob),
+                         zlib.crc32(body))
+    return header + body
+
+
+def decode_checkpoint(data) -> Checkpoint:
+    """从字节串（或mmap）解码检查点，数组直接在缓冲区上按偏移读取
+
+    抛出CheckpointError时不再持有指向data的缓冲区视图，mmap可以正常关闭。
+    """
+    if len(data) < HEADER.size:
+        raise CheckpointError("检查点文件不完整")
+    header = HEADER.unpack_from(data, 0)
+    magic, version, crc = header[0], header[1], header[-1]
+    if magic != MAGIC:
+        raise CheckpointError("不是检查点文件")
+    if version != VERSION:
+        raise CheckpointError(f"不支持的检查点版本: {version}")
+    with memoryview(data) as view:
+        valid = zlib.crc32(view[HEADER.size:]) == crc
+    if not valid:
+        raise CheckpointError("检查点校验失败")
+
+    error = None
+    try:
+        return _decode_body(data, header)
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        # 只保留错误信息，异常（及其引用的数组）在离开except后释放
+        error = str(e)
+    raise CheckpointError(f"检查点内容不一致: {error}")
+
+
+def _decode_body(data, header) -> Checkpoint:
+    (_, _, size, npc_count, day, world_time, saved_at, inventory_count,
+     memory_count, dim, vector_count, string_count, blob_bytes, _) = header
+    offset = HEADER.size
+
+    def take(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array
+
+    tiles = take("<u4", size * size).reshape(size, size)
+    resources = take("<u4", size * size).reshape(size, size)
+    amounts = take("<i4", size * size).reshape(size, size)
+    npc_table = take(NPC_DTYPE, npc_count)
+    inventory = take(INVENTORY_DTYPE, inventory_count)
+    memory_table = take(MEMORY_DTYPE, memory_count)
+    vector_table = take("i1", vector_count * dim).reshape(vector_count, dim)
+    string_offsets = take("<u4", string_count + 1)
+    blob = bytes(data[offset:offset + blob_bytes])
+    if len(blob) != blob_bytes:
+        raise ValueError("字符串数据不完整")
+    strings = [blob[string_offsets[i]:string_offsets[i + 1]].decode("utf-8") for i in range(string_count)]
+
+    npcs = {}
+    for row in npc_table:
+        name = strings[row["name"]]
+        items = inventory[row["inventory_offset"]:row["inventory_offset"] + row["inventory_count"]]
+        window = memory_table[row["memory_offset"]:row["memory_offset"] + row["memory_count"]]
+        npcs[name] = NPCCheckpoint(
+            name, float(row["x"]), float(row["y"]), float(row["energy"]), bool(row["is_dead"]),
+            {strings[item]: int(amount) for item, amount in items.tolist()},
+            [MemoryRecord(timestamp, strings[content], type_code, importance)
+             for timestamp, content, type_code, importance in window.tolist()],
+            _dequantize(vector_table[window["content"]]) if dim else None,
+            saved_at
+        )
+    return Checkpoint(
+        size, day, world_time, saved_at,
+        [[strings[code] for code in row] for row in tiles.tolist()],
+        [[None if code == NO_STRING else strings[code] for code in row] for row in resources.tolist()],
+        amounts.tolist(), npcs
+    )
+
+
+def _dequantize(quantized: np.ndarray) -> np.ndarray:
+    """int8向量还原为单位长度的float32向量"""
+    vectors = quantized.astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=vectors, where=norms > 0)
+
+
+def save_checkpoint(path: str, world, persistence=None):
+    """保存检查点；经由持久化服务时在写盘线程中先写临时文件再替换"""
+    data = encode_checkpoint(world)
+    if persistence is not None:
+        persistence.replace(path, data)
+    else:
+        PersistenceManager._atomic_write(path, data)
+
+
+def load_checkpoint(path: str, use_mmap: bool = False) -> Checkpoint:
+    """一次读取（或mmap）检查点文件并解码"""
+    with open(path, "rb") as f:
+        if not use_mmap:
+            return decode_checkpoint(f.read())
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise CheckpointError("检查点文件不完整")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return decode_checkpoint(mapped)
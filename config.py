@@ -15,8 +15,137 @@ CAMERA_SPEED = 10
 VOLUME_NORMAL_RANGE = 10.0  # 正常说话范围
 VOLUME_LOUD_RANGE = 15.0  # 喊叫范围
 
-# 大模型调用冷却时间（秒）
-MODEL_CALL_COOLDOWN = 10
+# 大模型后端（bailian: 阿里云百炼; mock: 离线模拟）
+LLM_PROVIDER = "bailian"
+
+# 百炼应用ID（按角色）
+BAILIAN_APP_IDS = {
+    "凯": "3eae9a8c46aa49d596cc10015ff3b11b",
+    "伊拉拉": "4a1b71350ea54ec6bedd304ac6938709",
+    "贾克斯": "fdcabb9f543e4da8a333902f3f7a4330",
+    # "批量决策": "<应用ID>",  # 配置后才启用批量决策，见BATCH_ACTION_ROLE
+}
+BAILIAN_DEFAULT_ROLE = "贾克斯"  # 行动决策遇到未知角色时使用的应用
+
+# 模拟后端参数
+MOCK_LATENCY = {"distribution": "lognormal", "mu": -0.5, "sigma": 0.5}  # 延迟分布（秒）
+MOCK_ERROR_RATE = 0.02  # 调用失败概率
+
+# 大模型调用限流（按应用ID配置，未单独配置的应用使用default）
+# requests_per_second: 令牌补充速率; burst: 允许的突发请求数; max_concurrency: 同时进行的请求上限
+MODEL_RATE_LIMITS = {
+    "default": {"requests_per_second": 1.0, "burst": 3, "max_concurrency": 2},
+}
+
+# 大模型调用优先级（数值越小越优先）
+PRIORITY_CONVERSATION = 0  # 对话中的回应
+PRIORITY_DECISION = 1  # 行动决策
+PRIORITY_REFLECTION = 2  # 反思总结
+
+# 模型上下文窗口（每个角色的消息历史上限）
+CONTEXT_MAX_MESSAGES = 20  # 保留的最近消息条数
+CONTEXT_MAX_TOKENS = 3000  # 历史消息的估算token上限
+CONTEXT_SUMMARY_MAX_CHARS = 600  # 滚动摘要的最大字符数
+
+# 流式输出对话回应（说出第一句就开始广播）
+STREAM_RESPONSES = True
+
+# 批量行动决策（同一帧内多个NPC的决策合并为一次请求）
+BATCH_ACTION_DECISIONS = True
+BATCH_ACTION_MAX_SIZE = 8  # 每次批量请求最多包含的NPC数
+BATCH_ACTION_ROLE = "批量决策"  # 批量请求使用的角色；百炼后端需在BAILIAN_APP_IDS中为它单独配置应用，否则逐个决策
+
+# 行动决策预取
+ACTION_PREFETCH_LEAD = 15.0  # 提前多少秒在后台发起下一次决策请求
+PREFETCH_DISTANCE_TOLERANCE = 3.0  # 位置变化超过该距离时丢弃预取结果
+PREFETCH_ENERGY_TOLERANCE = 10  # 能量变化超过该值时丢弃预取结果
+
+# 本地行动策略（状态已经决定结果时不请求大模型）
+ACTION_POLICY = {
+    "enabled": True,
+    "enabled_rules": ["drink_when_low", "eat_when_low", "gather_nearby",
+                      "move_on_when_full", "explore_when_alone"],
+    "low_energy": 40,  # 低于该能量时优先喝水/进食
+    "explore_radius": 8,  # 探索目标距岛屿中心的最大偏移
+}
+
+# 提示词预算（估算token数），超出时截断或丢弃较不重要的条目
+PROMPT_BUDGETS = {
+    "decide_action": {"memories": 160, "max_npcs": 6, "max_resource_types": 5},
+    "conversation": {"memories": 100},
+    "check_reflection": {"memories": 200},
+}
+PROMPT_MEMORY_ITEM_CHARS = 60  # 单条记忆写入提示词的最大字符数
+
+# 模型响应缓存
+RESPONSE_CACHE_SIZE = 512  # 内存中最多缓存的回复数
+RESPONSE_CACHE_TTL = 600  # 缓存有效期（秒）
+RESPONSE_CACHE_PATH = "data/response_cache.jsonl"  # 磁盘缓存文件，设为None则只缓存在内存中
+
+# 记忆持久化：追加日志达到该条数时合并进快照
+MEMORY_COMPACT_INTERVAL = 500
+
+# 记忆检索
+MEMORY_INDEX_MAX_POSTINGS = 2000  # 每个查询词项最多取最近的多少条命中记忆
+MEMORY_RECENT_CANDIDATES = 50  # 无论是否命中，最近的多少条记忆都参与打分
+MEMORY_RELEVANCE = "keyword"  # 相关性计算方式: keyword（倒排索引词项命中）或 embedding（本地哈希向量）
+MEMORY_EMBEDDING = {
+    "dim": 128,  # 向量维度
+    "ngram_sizes": (1, 2, 3),  # 参与哈希的字符n-gram长度
+}
+
+# 记忆分层存储：内存中只保留最近和重要的记忆，其余写入SQLite冷存储
+MEMORY_RESIDENT_SIZES = {"default": 2000}  # 每个NPC内存中保留的记忆条数，可按NPC名称单独配置
+MEMORY_EVICT_BATCH = 500  # 超出上限时一次淘汰到 上限-该值 条，避免每次添加都重建索引
+MEMORY_HOT_IMPORTANCE = 8  # 重要性不低于该值的记忆优先留在内存中
+MEMORY_COLD_CANDIDATES = 200  # 每次从冷存储取出参与打分的候选条数
+
+# 记忆合并：连续的移动和重复的低重要性事件合并成一条记录
+MEMORY_COALESCE = {
+    "enabled": True,
+    "max_importance": 3,  # 重要性不超过该值的事件才参与合并
+    "max_span": 60.0,  # 一条合并记录最多覆盖的秒数
+    "max_count": 500,  # 一条合并记录最多包含的事件数
+}
+
+# 反思触发水位线（只统计上次反思之后新增的记忆）
+REFLECTION_TRIGGER = {
+    "importance_threshold": 7,  # 重要性不低于该值的记忆计为重要记忆
+    "count_threshold": 5,  # 新增重要记忆达到该条数
+    "importance_sum_threshold": 60,  # 且新增记忆的重要性总和达到该值
+    "retry_delay": 30.0,  # 反思失败或模型返回空内容后，至少等待该秒数再试
+    "max_retry_delay": 600.0,  # 连续失败时等待时间逐次翻倍，最多到该秒数
+}
+
+# 状态文件写入：后台线程每隔该秒数批量提交一次修改
+PERSIST_INTERVAL = 2.0
+
+# 状态存储后端（json: data目录下的JSON文件; sqlite: 单个WAL模式的SQLite数据库，首次启用时从JSON迁移）
+STORAGE_BACKEND = "json"
+STORAGE_SQLITE_PATH = "data/simulation.db"
+
+# 二进制检查点：默认路径，以及运行中每隔多少秒自动保存一次（0为只在退出时保存）
+CHECKPOINT_PATH = "data/world.ckpt"
+CHECKPOINT_INTERVAL = 300
+CHECKPOINT_VECTORS = True  # 同时保存记忆检索向量（int8量化），恢复时不必重新计算
+
+# 对话日志：每段文件的大小上限（字节），以及每隔多少条记录在索引中记一次偏移
+CONVERSATION_SEGMENT_BYTES = 1024 * 1024
+CONVERSATION_INDEX_STRIDE = 64
+
+# 内存中的对话记录（环形缓冲区容量），以及对话面板显示最近多少秒内的对话
+DIALOG_CONVERSATION_CAPACITY = 1000
+DIALOG_COMMUNICATION_CAPACITY = 2000
+DIALOG_RECENT_SECONDS = 60
+
+# 按对话双方索引的历史：每对NPC保留的条数，启动时从日志预热的最近记录数，
+# 以及写入对话提示词的最近交流条数
+DIALOG_PAIR_CAPACITY = 50
+DIALOG_PAIR_WARM_RECORDS = 1000
+DIALOG_PAIR_HISTORY = 6
+
+# 编年史空间索引的网格边长（格）
+CHRONICLE_CELL_SIZE = 5
 
 # 资源类型与采集量
 RESOURCE_TYPES = {
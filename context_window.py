@@ -0,0 +1,91 @@
+"""
+对话上下文窗口 - 限制每个角色的消息历史，并把被淘汰的轮次折叠成滚动摘要
+"""
+from collections import deque
+from typing import List, Dict, Optional
+from config import CONTEXT_MAX_MESSAGES, CONTEXT_MAX_TOKENS, CONTEXT_SUMMARY_MAX_CHARS
+
+# 每条消息的格式开销（token）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _is_cjk(ch: str) -> bool:
+    return ('\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af'
+            or '\uf900' <= ch <= '\ufaff' or '\uff00' <= ch <= '\uffef')
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符约1字1个token，其余约4个字符1个token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: Dict) -> int:
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextWindow:
+    """单个角色的有界上下文
+
+    - 系统提示词只保留一份，始终放在最前面
+    - 历史按消息数和token预算截断，最早的轮次被折叠进滚动摘要
+    - 摘要本身也有长度上限，超出时丢弃最旧的部分
+    """
+
+    def __init__(self, system_prompt: Optional[str] = None,
+                 max_messages: int = CONTEXT_MAX_MESSAGES,
+                 max_tokens: int = CONTEXT_MAX_TOKENS,
+                 summary_max_chars: int = CONTEXT_SUMMARY_MAX_CHARS):
+        self.system_prompt = system_prompt
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.summary_max_chars = summary_max_chars
+        self.turns = deque()
+        self.summary = ""
+        self.token_count = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    def build(self, request: List[Dict], system_prompt: Optional[str] = None) -> List[Dict]:
+        """组装发送给模型的消息列表，request为本次新增的消息（不写入历史）"""
+        messages = []
+        head = system_prompt or self.system_prompt
+        if head:
+            messages.append({'role': 'system', 'content': head})
+        if self.summary:
+            messages.append({'role': 'system', 'content': f"此前对话摘要: {self.summary}"})
+        messages.extend(self.turns)
+        messages.extend(request)
+        return messages
+
+    def append(self, *messages: Dict):
+        """把一轮完成的对话写入历史，超出预算时淘汰最早的消息"""
+        for message in messages:
+            self.turns.append(message)
+            self.token_count += message_tokens(message)
+        self._evict()
+
+    def _evict(self):
+        while self.turns and (len(self.turns) > self.max_messages
+                              or self.token_count > self.max_tokens):
+            message = self.turns.popleft()
+            self.token_count -= message_tokens(message)
+            self._fold(message)
+
+    def _fold(self, message: Dict):
+        """把被淘汰的消息压缩成一小段写入摘要"""
+        content = " ".join(message.get("content", "").split())
+        if not content:
+            return
+        speaker = "我" if message.get("role") == "assistant" else "对方"
+        snippet = content if len(content) <= 40 else content[:40] + "…"
+        self.summary = f"{self.summary}{speaker}: {snippet}；"
+        if len(self.summary) > self.summary_max_chars:
+            self.summary = self.summary[-self.summary_max_chars:]
+
+    def request_tokens(self, request: List[Dict], system_prompt: Optional[str] = None) -> int:
+        """估算一次请求的总token数"""
+        return sum(message_tokens(m) for m in self.build(request, system_prompt))
@@ -0,0 +1,186 @@
+"""
+对话日志 - 按模拟天数或大小切分的追加写入日志，附带按时间定位的索引文件
+"""
+import os
+import json
+import bisect
+from typing import Dict, Iterator, List, Optional
+from config import CONVERSATION_SEGMENT_BYTES, CONVERSATION_INDEX_STRIDE
+from persistence import PersistenceManager
+
+
+class ConversationLog:
+    """对话记录日志
+
+    记录按时间顺序追加到当前段文件（JSONL），模拟天数变化或段文件超过
+    segment_max_bytes时开启新段。index.json记录每段的天数、时间范围、
+    条数，以及每隔index_stride条记录的(时间戳, 字节偏移)，读取时先按
+    时间范围挑选段，再直接跳到段内的偏移处开始读。
+
+    追加只写一行，不重写已有内容；索引只在换段和flush_index()时写入，
+    崩溃后当前段的索引信息在加载时通过扫描该段重建。
+    """
+
+    def __init__(self, directory: str = "data/conversations",
+                 segment_max_bytes: int = CONVERSATION_SEGMENT_BYTES,
+                 index_stride: int = CONVERSATION_INDEX_STRIDE,
+                 persistence: Optional[PersistenceManager] = None,
+                 legacy_path: str = "data/conversations.json"):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.index_stride = index_stride
+        self.persistence = persistence or PersistenceManager(background=False)
+        self.index_path = os.path.join(directory, "index.json")
+        self.segments: List[Dict] = []
+        self.day = None
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+        if not self.segments and os.path.exists(legacy_path):
+            self._migrate(legacy_path)
+
+    # ---- 写入 ----
+
+    def set_day(self, day):
+        """更新当前模拟天数，下一条记录写入新的一段"""
+        self.day = day
+
+    def append(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        segment = self.segments[-1] if self.segments else None
+        if (segment is None or segment["day"] != self.day
+                or (segment["bytes"] and segment["bytes"] + len(line.encode("utf-8")) > self.segment_max_bytes)):
+            segment = self._open_segment()
+        if segment["count"] % self.index_stride == 0:
+            segment["offsets"].append([record["timestamp"], segment["bytes"]])
+        if segment["start"] is None:
+            segment["start"] = record["timestamp"]
+        segment["end"] = record["timestamp"]
+        segment["count"] += 1
+        segment["bytes"] += len(line.encode("utf-8"))
+        self.persistence.append(self._path(segment), line)
+
+    def _open_segment(self) -> Dict:
+        number = self.segments[-1]["number"] + 1 if self.segments else 0
+        segment = {
+            "number": number,
+            "file": f"segment_{number:06d}.jsonl",
+            "day": self.day,
+            "start": None,
+            "end": None,
+            "count": 0,
+            "bytes": 0,
+            "offsets": []
+        }
+        self.segments.append(segment)
+        if len(self.segments) > 1:
+            # 上一段已经写完，把索引落盘
+            self.flush_index()
+        return segment
+
+    def flush_index(self):
+        self.persistence.replace(self.index_path, {
+            "segments": [dict(segment, offsets=list(segment["offsets"])) for segment in self.segments]
+        })
+
+    def _path(self, segment: Dict) -> str:
+        return os.path.join(self.directory, segment["file"])
+
+    # ---- 读取 ----
+
+    def read(self, since: Optional[float] = None, until: Optional[float] = None,
+             limit: Optional[int] = None) -> List[Dict]:
+        """读取时间范围内已落盘的记录（按时间顺序），limit只保留最近的若干条"""
+        segments = self.segments
+        if limit and since is None and until is None:
+            # 只要最近的记录时，从最后一段往前取够条数的段
+            needed, start = 0, len(segments)
+            while start > 0 and needed < limit:
+                start -= 1
+                needed += segments[start]["count"]
+            segments = segments[start:]
+        records = []
+        for segment in segments:
+            if segment["count"] == 0:
+                continue
+            if since is not None and segment["end"] is not None and segment["end"] < since:
+                continue
+            if until is not None and segment["start"] is not None and segment["start"] > until:
+                break
+            for record in self._iter_segment(segment, since):
+                if until is not None and record["timestamp"] > until:
+                    break
+                if since is None or record["timestamp"] >= since:
+                    records.append(record)
+        return records[-limit:] if limit else records
+
+    def _iter_segment(self, segment: Dict, since: Optional[float]) -> Iterator[Dict]:
+        offset = 0
+        if since is not None and segment["offsets"]:
+            position = bisect.bisect_left([ts for ts, _ in segment["offsets"]], since) - 1
+            if position >= 0:
+                offset = segment["offsets"][position][1]
+        try:
+            with open(self._path(segment), "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            return
+
+    # ---- 加载 ----
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.segments = json.load(f)["segments"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            self.segments = []
+        # 索引之后新建的段和最后一段的新内容需要扫描补齐
+        known = {segment["file"] for segment in self.segments}
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith("segment_") and name.endswith(".jsonl") and name not in known:
+                self.segments.append({"number": int(name[8:14]), "file": name, "day": None,
+                                      "start": None, "end": None, "count": 0, "bytes": 0, "offsets": []})
+        self.segments.sort(key=lambda s: s["number"])
+        if self.segments:
+            self._rescan(self.segments[-1])
+            self.day = self.segments[-1]["day"]
+
+    def _rescan(self, segment: Dict):
+        """按文件内容重建一段的索引信息"""
+        segment.update(start=None, end=None, count=0, bytes=0, offsets=[])
+        torn = False
+        try:
+            with open(self._path(segment), "rb") as f:
+                for line in f:
+                    try:
+                        timestamp = json.loads(line)["timestamp"]
+                    except (json.JSONDecodeError, KeyError):
+                        # 写到一半的最后一行：截掉，之后的追加从完整的行尾开始
+                        torn = True
+                        break
+                    if segment["count"] % self.index_stride == 0:
+                        segment["offsets"].append([timestamp, segment["bytes"]])
+                    if segment["start"] is None:
+                        segment["start"] = timestamp
+                    segment["end"] = timestamp
+                    segment["count"] += 1
+                    segment["bytes"] += len(line)
+        except FileNotFoundError:
+            return
+        if torn:
+            os.truncate(self._path(segment), segment["bytes"])
+
+    def _migrate(self, legacy_path: str):
+        """把旧版conversations.json转成分段日志"""
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return
+        for record in records:
+            self.append(record)
+        self.flush_index()
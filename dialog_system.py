@@ -1,24 +1,87 @@
 """
 全局对话系统
 """
-import json
 import time
-from typing import List, Tuple, Dict
+import itertools
+from typing import List, Tuple, Dict, Optional
+from config import (DIALOG_CONVERSATION_CAPACITY, DIALOG_COMMUNICATION_CAPACITY, DIALOG_RECENT_SECONDS,
+                    DIALOG_PAIR_CAPACITY, DIALOG_PAIR_WARM_RECORDS, DIALOG_PAIR_HISTORY)
+from conversation_log import ConversationLog
+from ring_buffer import RingBuffer
+
+
+def pair_key(npc_a: str, npc_b: str) -> Tuple[str, str]:
+    """不分说话方向的对话双方"""
+    return (npc_a, npc_b) if npc_a <= npc_b else (npc_b, npc_a)
+
 
 class GlobalDialogSystem:
-    def __init__(self):
-        self.npc_conversations = []
-        self.communication_events = []  # 专门存储communication类型的互动
-        self.max_conversations = 20
-        self.max_communication_events = 50
+    """全局对话记录
+
+    内存中的对话和communication事件保存在环形缓冲区中；另外按对话双方
+    （不分方向）各保留一个小的环形缓冲区，用于查询两人之间最近的交流。
+    使用文件日志时启动时从日志的最近记录预热；使用SQLite存储时每对NPC
+    第一次出现时按对话双方索引从数据库取回最近的记录。
+    """
+
+    def __init__(self, persistence=None, storage=None,
+                 conversation_capacity: int = DIALOG_CONVERSATION_CAPACITY,
+                 communication_capacity: int = DIALOG_COMMUNICATION_CAPACITY,
+                 pair_capacity: int = DIALOG_PAIR_CAPACITY):
+        self.storage = storage
+        if storage is not None:
+            self.conversation_log = storage.conversation_log()
+        else:
+            self.conversation_log = ConversationLog(persistence=persistence)
+        self.npc_conversations = RingBuffer(conversation_capacity)
+        self.communication_events = RingBuffer(communication_capacity)  # 专门存储communication类型的互动
+        self.pair_capacity = pair_capacity
+        self.pair_history: Dict[Tuple[str, str], RingBuffer] = {}
+        if storage is None:
+            for record in self.conversation_log.read(limit=DIALOG_PAIR_WARM_RECORDS):
+                self._index_pair(record["npc1"], record["npc2"], record["message"], record["timestamp"])
+        self.partial_utterances = {}  # 正在流式生成中的发言
+        self._utterance_ids = itertools.count()
 
     def add_conversation(self, npc1_name: str, npc2_name: str, message: str):
         timestamp = time.time()
-        self.npc_conversations.append((npc1_name, npc2_name, message, timestamp))
-        if len(self.npc_conversations) > self.max_conversations:
-            self.npc_conversations.pop(0)
+        self.npc_conversations.append((npc1_name, npc2_name, message, timestamp), timestamp)
+        self._index_pair(npc1_name, npc2_name, message, timestamp)
         self.save_to_json(npc1_name, npc2_name, message, timestamp)
 
+    def _pair_history(self, key: Tuple[str, str]) -> RingBuffer:
+        history = self.pair_history.get(key)
+        if history is None:
+            history = self.pair_history[key] = RingBuffer(self.pair_capacity)
+            if self.storage is not None:
+                for record in self.storage.conversations_between(*key, self.pair_capacity):
+                    self._append_exchange(history, record["npc1"], record["npc2"],
+                                          record["message"], record["timestamp"])
+        return history
+
+    def _index_pair(self, speaker_name: str, listener_name: str, message: str, timestamp: float):
+        self._append_exchange(self._pair_history(pair_key(speaker_name, listener_name)),
+                              speaker_name, listener_name, message, timestamp)
+
+    @staticmethod
+    def _append_exchange(history: RingBuffer, speaker_name: str, listener_name: str,
+                         message: str, timestamp: float):
+        # 同一句话会由听者（听到时）和说话者（回应结束时）各记录一次，只保留一条
+        for speaker, listener, previous, _ in history.last(2):
+            if speaker == speaker_name and listener == listener_name and previous == message:
+                return
+        history.append((speaker_name, listener_name, message, timestamp), timestamp)
+
+    def get_exchanges(self, npc_a: str, npc_b: str, limit: int = DIALOG_PAIR_HISTORY,
+                      since: Optional[float] = None) -> List[Tuple[str, str, str, float]]:
+        """两个NPC之间最近的limit条交流（不分说话方向），按时间顺序；
+        since限定只取该时刻之后的交流"""
+        if limit <= 0:
+            return []
+        history = self._pair_history(pair_key(npc_a, npc_b))
+        records = history.since(since) if since is not None else history.last(limit)
+        return records[-limit:]
+
     def add_communication_event(self, speaker_name: str, listener_name: str, message: str, volume: str):
         """添加communication类型的互动事件"""
         timestamp = time.time()
@@ -28,35 +91,60 @@ class GlobalDialogSystem:
             "listener": listener_name,
             "message": message
         }
-        self.communication_events.append(event)
-        if len(self.communication_events) > self.max_communication_events:
-            self.communication_events.pop(0)
+        self.communication_events.append(event, timestamp)
 
     def get_recent_communications(self, limit: int = 10) -> List[Dict]:
         """获取最近的communication事件"""
-        return self.communication_events[-limit:]
+        return self.communication_events.last(limit)
+
+    def begin_utterance(self, speaker_name: str, listener_name: str) -> int:
+        """开始一段流式发言，返回发言编号"""
+        utterance_id = next(self._utterance_ids)
+        self.partial_utterances[utterance_id] = {
+            "timestamp": time.time(),
+            "speaker": speaker_name,
+            "listener": listener_name,
+            "message": ""
+        }
+        return utterance_id
+
+    def update_utterance(self, utterance_id: int, message: str):
+        """更新流式发言目前已生成的内容"""
+        utterance = self.partial_utterances.get(utterance_id)
+        if utterance is not None:
+            utterance["message"] = message
+
+    def finish_utterance(self, utterance_id: int):
+        """流式发言结束，完整内容由调用方写入对话记录"""
+        self.partial_utterances.pop(utterance_id, None)
+
+    def get_partial_utterances(self) -> List[Dict]:
+        """获取正在进行中的发言"""
+        return [u for u in self.partial_utterances.values() if u["message"]]
+
+    def get_recent_conversations(self, seconds: float = DIALOG_RECENT_SECONDS) -> List[Tuple[str, str, str, float]]:
+        return self.npc_conversations.since(time.time() - seconds)
 
-    def get_recent_conversations(self) -> List[Tuple[str, str, str, float]]:
-        current_time = time.time()
-        return [(n1, n2, msg, t) for n1, n2, msg, t in self.npc_conversations
-                if current_time - t < 60]
+    def get_conversations_since(self, since: float) -> List[Tuple[str, str, str, float]]:
+        """内存中时间戳不早于since的对话，更早的记录用get_conversation_history从日志读取"""
+        return self.npc_conversations.since(since)
+
+    def set_day(self, day: int):
+        """模拟天数变化时对话日志换段"""
+        if day != self.conversation_log.day:
+            self.conversation_log.set_day(day)
+
+    def get_conversation_history(self, since: Optional[float] = None, until: Optional[float] = None,
+                                 limit: Optional[int] = None) -> List[Dict]:
+        """从对话日志中读取时间范围内的对话记录"""
+        return self.conversation_log.read(since, until, limit)
 
     def save_to_json(self, npc1_name: str, npc2_name: str, message: str, timestamp: float):
-        """保存对话到JSON文件"""
+        """追加一条对话到分段日志（或SQLite存储）"""
         conversation_data = {
             "timestamp": timestamp,
             "npc1": npc1_name,
             "npc2": npc2_name,
             "message": message
         }
-
-        try:
-            with open("data/conversations.json", "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            data = []
-
-        data.append(conversation_data)
-
-        with open("data/conversations.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+        self.conversation_log.append(conversation_data)
\ No newline at end of file
@@ -4,17 +4,22 @@
 import pygame
 import random
 import time
+import logging
 from ai_client import BailianClient
 from dialog_system import GlobalDialogSystem
 from memory_system import Chronicle
 from world import World
 from ui import UIRenderer
+from persistence import PersistenceManager
+from sqlite_storage import SqliteStorage
+from checkpoint import load_checkpoint, save_checkpoint
 from config import *
 import asyncio
 
 
 class Game:
-    def __init__(self, api_key: str = "", screen=None):
+    def __init__(self, api_key: str = "", screen=None, provider=None, storage_backend: str = STORAGE_BACKEND,
+                 resume: str = None):
         # 初始化pygame和屏幕
         pygame.init()
         pygame.font.init()
@@ -30,10 +35,21 @@ class Game:
 
         self.clock = pygame.time.Clock()
 
-        self.bailian = BailianClient(api_key)
-        self.dialog_system = GlobalDialogSystem()
-        self.chronicle = Chronicle()
-        self.world = World(self.bailian, self.dialog_system, self.chronicle)
+        self.persistence = PersistenceManager()
+        self.bailian = BailianClient(api_key, provider, persistence=self.persistence)
+        self.batch_actions = BATCH_ACTION_DECISIONS and self.bailian.supports_batch_actions()
+        if BATCH_ACTION_DECISIONS and not self.batch_actions:
+            print(f"未给{BATCH_ACTION_ROLE}配置单独的应用，行动决策逐个请求")
+        # sqlite后端：NPC、记忆、资源、编年史和对话统一存入一个数据库
+        self.storage = SqliteStorage(STORAGE_SQLITE_PATH) if storage_backend == "sqlite" else None
+        self.dialog_system = GlobalDialogSystem(self.persistence, self.storage)
+        self.chronicle = Chronicle(persistence=self.persistence, storage=self.storage)
+        # 指定检查点时从二进制存档恢复世界和NPC，否则从各自的状态文件加载
+        checkpoint = load_checkpoint(resume) if resume else None
+        self.world = World(self.bailian, self.dialog_system, self.chronicle, self.persistence, self.storage,
+                           checkpoint)
+        self.last_checkpoint_time = time.time()
+        self.dialog_system.set_day(self.world.day)
         self.ui_renderer = UIRenderer()
 
         self.running = True
@@ -98,10 +114,16 @@ class Game:
     async def update(self):
         # 更新NPC状态
         await asyncio.sleep(0.1)
+        alive_npcs = [npc for npc in self.world.npcs if not npc.is_dead]
+        for npc in alive_npcs:
+            npc.find_nearby_npcs(self.world.npcs)
+            npc.find_nearby_resources(self.world)
+
+        if self.batch_actions:
+            self.request_batch_actions(alive_npcs)
+
         for npc in self.world.npcs:
             if not npc.is_dead:
-                npc.find_nearby_npcs(self.world.npcs)
-                npc.find_nearby_resources(self.world)
                 npc.interact_with_nearby_npcs()
 
                 # 决策并执行行动
@@ -112,6 +134,40 @@ class Game:
 
             npc.update(self.world)
 
+        self.dialog_system.set_day(self.world.day)
+
+        if CHECKPOINT_INTERVAL and time.time() - self.last_checkpoint_time >= CHECKPOINT_INTERVAL:
+            self.save_checkpoint()
+            self.last_checkpoint_time = time.time()
+
+        # 到达提交间隔时把本周期的修改交给写盘线程；SQLite存储每轮提交一个事务
+        self.persistence.tick()
+        if self.storage is not None:
+            self.storage.tick()
+
+    def save_checkpoint(self):
+        """保存检查点；失败只记录日志，不影响游戏循环和退出时的写盘"""
+        try:
+            save_checkpoint(CHECKPOINT_PATH, self.world, self.persistence)
+        except Exception as e:
+            logging.error(f"保存检查点失败: {e}")
+
+    def request_batch_actions(self, npcs):
+        """把本帧需要决策（含预取）的NPC合并成批量请求，每批一次模型调用"""
+        due_npcs = [npc for npc in npcs if npc.needs_decision()]
+        if len(due_npcs) < 2:
+            return
+
+        world_state = self.world.get_state_str()
+        for start in range(0, len(due_npcs), BATCH_ACTION_MAX_SIZE):
+            group = due_npcs[start:start + BATCH_ACTION_MAX_SIZE]
+            prompts = {npc.name: npc.build_action_prompt(world_state) for npc in group}
+            batch = asyncio.get_running_loop().create_task(
+                self.bailian.agenerate_actions_batch(prompts)
+            )
+            for npc in group:
+                npc.request_action(prompts[npc.name], batch)
+
     async def handle_camera_movement(self):
         """异步处理相机移动"""
         camera_dx, camera_dy = 0, 0
@@ -183,7 +239,7 @@ class Game:
             self.ui_renderer.draw_npc_details(self.screen, self.world.npcs, self.selected_npc)
 
         if self.show_chronicle:
-            self.ui_renderer.draw_chronicle(self.screen, self.chronicle)
+            self.ui_renderer.draw_chronicle(self.screen, self.chronicle, self.selected_npc)
 
         if self.show_communications:
             self.ui_renderer.draw_communication_events(self.screen, self.dialog_system)
@@ -243,4 +299,22 @@ class Game:
             # 控制帧率
             await asyncio.sleep(1/self.frame_rate_limit)
 
+        try:
+            for npc in self.world.npcs:
+                npc.memory.flush_pending()
+            self.dialog_system.conversation_log.flush_index()
+            self.save_checkpoint()
+        finally:
+            self.persistence.close()
+            for npc in self.world.npcs:
+                npc.memory.close()
+            if self.storage is not None:
+                self.storage.close()
+        print(self.world.action_policy.report())
+        used = sum(npc.prefetch_stats["used"] for npc in self.world.npcs)
+        discarded = sum(npc.prefetch_stats["discarded"] for npc in self.world.npcs)
+        print(f"决策预取: 直接使用{used}次，感知变化后丢弃{discarded}次")
+        print(self.bailian.ledger.report())
+        print(self.bailian.cache.report())
+        print(self.bailian.scheduler.report())
         pygame.quit()
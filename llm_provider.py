@@ -0,0 +1,236 @@
+"""
+大模型后端接口 - 百炼在线服务和离线可复现的模拟后端
+"""
+import re
+import time
+import json
+import random
+import threading
+from abc import ABC, abstractmethod
+from http import HTTPStatus
+from typing import List, Dict, Optional, Iterator
+from config import BAILIAN_APP_IDS, BAILIAN_DEFAULT_ROLE, MOCK_LATENCY, MOCK_ERROR_RATE
+
+# 批量决策提示词中每个角色段落的标题前缀
+BATCH_SECTION_HEADER = "### 角色: "
+
+
+class LLMProvider(ABC):
+    """大模型后端的统一接口
+
+    complete()在工作线程中被调用，成功返回文本，失败返回None。
+    stream()中途失败时抛出异常，调用方据此丢弃已收到的不完整内容。
+    """
+
+    def route(self, role: str, strict: bool = True) -> str:
+        """返回角色对应的限流键（如应用ID）"""
+        return role
+
+    def model_id(self, role: str) -> str:
+        """回答该角色的后端和模型标识，用于区分响应缓存"""
+        return f"{type(self).__name__}:{self.route(role, strict=False)}"
+
+    @abstractmethod
+    def complete(self, role: str, messages: List[Dict], expect_json: bool = False) -> Optional[str]:
+        """返回完整回复文本，失败返回None"""
+
+    @abstractmethod
+    def stream(self, role: str, messages: List[Dict]) -> Iterator[str]:
+        """逐段返回回复文本；不支持流式的后端可以用super().stream()一次性返回全文"""
+        text = self.complete(role, messages)
+        if text:
+            yield text
+
+
+class BailianProvider(LLMProvider):
+    """阿里云百炼应用后端"""
+
+    def __init__(self, api_key: str, app_ids: Optional[Dict[str, str]] = None):
+        # 延迟导入，使用模拟后端时不需要安装dashscope
+        from dashscope import Application
+        self._application = Application
+        self.api_key = api_key
+        self.app_ids = dict(app_ids or BAILIAN_APP_IDS)
+
+    def route(self, role: str, strict: bool = True) -> str:
+        if role in self.app_ids:
+            return self.app_ids[role]
+        if not strict:
+            return self.app_ids[BAILIAN_DEFAULT_ROLE]
+        raise ValueError(f"未知角色: {role}")
+
+    def model_id(self, role: str) -> str:
+        return f"bailian:{self.route(role, strict=False)}"
+
+    def complete(self, role: str, messages: List[Dict], expect_json: bool = False) -> Optional[str]:
+        try:
+            response = self._application.call(
+                api_key=self.api_key,
+                app_id=self.route(role, strict=False),
+                messages=messages
+            )
+        except Exception as e:
+            print(f"调用百炼模型失败: {str(e)}")
+            return None
+
+        if response.status_code == HTTPStatus.OK:
+            return response.output.text.strip()
+        print(f"百炼API错误: {response.status_code} - {response.message}")
+        return None
+
+    def stream(self, role: str, messages: List[Dict]) -> Iterator[str]:
+        try:
+            responses = self._application.call(
+                api_key=self.api_key,
+                app_id=self.route(role, strict=False),
+                messages=messages,
+                stream=True,
+                incremental_output=True
+            )
+        except Exception as e:
+            raise RuntimeError(f"调用百炼模型失败: {str(e)}") from e
+        for response in responses:
+            if response.status_code != HTTPStatus.OK:
+                raise RuntimeError(f"百炼API错误: {response.status_code} - {response.message}")
+            if response.output.text:
+                yield response.output.text
+
+
+class MockProvider(LLMProvider):
+    """离线模拟后端，用于无网络环境下的压测和可复现对比
+
+    - 行动请求返回符合决策格式的JSON，对话请求返回自然语言文本
+    - latency: {"distribution": "fixed"|"uniform"|"lognormal", ...} 模拟网络延迟
+    - error_rate: 调用失败（返回None）的概率
+    - seed: 相同种子、相同的每角色调用顺序下输出完全一致
+    """
+
+    SENTENCES = [
+        "今天的海风有点大。", "我刚才在岸边看到了鱼群。", "我们得多存一些淡水。",
+        "你最近还好吗？", "那边的果树好像结果了。", "晚上记得找个避风的地方。",
+        "要不要一起去找点吃的？", "我有点累了，先歇一会儿。", "这座岛比想象的大。",
+        "谢谢你之前的帮助。", "我们应该互相照应。", "明天我想去岛的另一边看看。"
+    ]
+
+    def __init__(self, seed: int = 0, latency: Optional[Dict] = None, error_rate: float = 0.0):
+        self.seed = seed
+        self.latency = latency or {"distribution": "fixed", "value": 0.0}
+        self.error_rate = error_rate
+        self._call_counts = {}
+        self._lock = threading.Lock()
+
+    def model_id(self, role: str) -> str:
+        # 不同种子的模拟回复不能互相命中
+        return f"mock:{self.seed}:{role}"
+
+    def _rng(self, role: str) -> random.Random:
+        """每个角色独立编号的随机源，不受其他角色调用顺序影响"""
+        with self._lock:
+            count = self._call_counts.get(role, 0)
+            self._call_counts[role] = count + 1
+        return random.Random(f"{self.seed}:{role}:{count}")
+
+    def _sample_latency(self, rng: random.Random) -> float:
+        config = self.latency
+        distribution = config.get("distribution", "fixed")
+        if distribution == "uniform":
+            return rng.uniform(config.get("min", 0.0), config.get("max", 1.0))
+        if distribution == "lognormal":
+            return rng.lognormvariate(config.get("mu", -0.5), config.get("sigma", 0.5))
+        return config.get("value", 0.0)
+
+    def complete(self, role: str, messages: List[Dict], expect_json: bool = False) -> Optional[str]:
+        rng = self._rng(role)
+        delay = self._sample_latency(rng)
+        if delay > 0:
+            time.sleep(delay)
+        if rng.random() < self.error_rate:
+            print(f"模拟后端错误: {role}")
+            return None
+
+        prompt = messages[-1]["content"] if messages else ""
+        if expect_json and BATCH_SECTION_HEADER in prompt:
+            return json.dumps(self._mock_batch(rng, prompt), ensure_ascii=False)
+        if expect_json:
+            return json.dumps(self._mock_action(rng, prompt), ensure_ascii=False)
+        return "".join(rng.sample(self.SENTENCES, rng.randint(1, 3)))
+
+    def stream(self, role: str, messages: List[Dict]) -> Iterator[str]:
+        """模拟流式输出：首句在总延迟的一部分之后到达，其余按句子陆续到达"""
+        rng = self._rng(role)
+        delay = self._sample_latency(rng)
+        sentences = rng.sample(self.SENTENCES, rng.randint(1, 3))
+        broken = rng.random() < self.error_rate
+        if broken:
+            # 模拟中途断开：只返回部分内容后抛出异常
+            sentences = sentences[:len(sentences) // 2]
+        first_share = 0.4
+        for index, sentence in enumerate(sentences):
+            if index == 0:
+                wait = delay * first_share
+            else:
+                wait = delay * (1 - first_share) / max(1, len(sentences) - 1)
+            if wait > 0:
+                time.sleep(wait)
+            yield sentence
+        if broken:
+            raise RuntimeError(f"模拟后端流式中断: {role}")
+
+    @staticmethod
+    def _parse_list(pattern: str, prompt: str) -> List[str]:
+        match = re.search(pattern, prompt)
+        if not match:
+            return []
+        return re.findall(r"'([^']+)'", match.group(1))
+
+    def _mock_batch(self, rng: random.Random, prompt: str) -> List[Dict]:
+        """批量决策：每个角色段落生成一个条目，按error_rate产生无效条目"""
+        sections = prompt.split(BATCH_SECTION_HEADER)[1:]
+        entries = []
+        for section in sections:
+            name, _, body = section.partition("\n")
+            if rng.random() < self.error_rate:
+                entries.append({"name": name.strip()})
+                continue
+            entry = {"name": name.strip()}
+            entry.update(self._mock_action(rng, body))
+            entries.append(entry)
+        return entries
+
+    def _mock_action(self, rng: random.Random, prompt: str) -> Dict:
+        """根据提示词中的感知信息生成一个合法的行动"""
+        npc_names = self._parse_list(r"附近有\d+个NPC: \[(.*?)\]", prompt)
+        resources = self._parse_list(r"附近有\d+种资源: \[(.*?)\]", prompt)
+        energy_match = re.search(r"能量值: ([\d.]+)", prompt)
+        energy = float(energy_match.group(1)) if energy_match else 100.0
+        inventory = dict(re.findall(r"(水|鱼|果实):(\d+)", prompt))
+
+        if energy < 50 and int(inventory.get("水", 0)) > 0:
+            return {"action": "drink", "target": None, "details": "有点渴了", "volume": None}
+        if energy < 50 and (int(inventory.get("鱼", 0)) > 0 or int(inventory.get("果实", 0)) > 0):
+            return {"action": "eat", "target": None, "details": "吃点东西", "volume": None}
+
+        roll = rng.random()
+        if npc_names and roll < 0.3:
+            return {"action": "talk", "target": rng.choice(npc_names),
+                    "details": rng.choice(self.SENTENCES),
+                    "volume": rng.choice(["normal", "loud"])}
+        if npc_names and inventory and roll < 0.35:
+            resource_type = rng.choice(sorted(inventory))
+            return {"action": "give", "target": rng.choice(npc_names),
+                    "details": f"{resource_type},1", "volume": None}
+        if resources and roll < 0.7:
+            return {"action": "gather", "target": rng.choice(resources),
+                    "details": "采集附近的资源", "volume": None}
+        return {"action": "move",
+                "target": {"x": round(rng.uniform(8, 22), 1), "y": round(rng.uniform(8, 22), 1)},
+                "details": "四处看看", "volume": None}
+
+
+def create_provider(name: str, api_key: str = "", seed: int = 0) -> LLMProvider:
+    """根据名称创建后端"""
+    if name == "mock":
+        return MockProvider(seed=seed, latency=MOCK_LATENCY, error_rate=MOCK_ERROR_RATE)
+    if name == "bailian":
+        return BailianProvider(api_key)
+    raise ValueError(f"未知的大模型后端: {name}")
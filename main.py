@@ -4,19 +4,37 @@ AI驱动的NPC互动模拟游戏
 """
 import os
 import sys
+import argparse
 from game import Game
+from llm_provider import create_provider
+from config import LLM_PROVIDER, STORAGE_BACKEND, CHECKPOINT_PATH
 import asyncio
 # 确保数据目录存在
 os.makedirs("data", exist_ok=True)
 
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="荒岛模拟")
+    parser.add_argument("--provider", choices=["bailian", "mock"], default=LLM_PROVIDER,
+                        help="大模型后端，mock为离线模拟（默认: %(default)s）")
+    parser.add_argument("--seed", type=int, default=0, help="模拟后端的随机种子")
+    parser.add_argument("--resume", metavar="CHECKPOINT",
+                        help=f"从二进制检查点恢复世界和NPC状态（运行中和退出时自动保存到{CHECKPOINT_PATH}）")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default=STORAGE_BACKEND,
+                        help="状态存储后端，sqlite首次启用时从JSON文件迁移（默认: %(default)s）")
+    return parser.parse_args()
+
 def main():
     """主函数"""
+    args = parse_args()
+
     # API密钥 - 请替换为有效的API密钥
     API_KEY = "sk-7cb1a01af2e946d3a075d761cd74a166"
 
     try:
         # 创建并运行游戏
-        game = Game(API_KEY)
+        provider = create_provider(args.provider, API_KEY, args.seed)
+        game = Game(API_KEY, provider=provider, storage_backend=args.storage, resume=args.resume)
         asyncio.run(game.run())
     except KeyboardInterrupt:
         print("\n游戏被用户中断")
@@ -0,0 +1,125 @@
+"""
+记忆合并 - 把连续的移动和重复的低重要性事件合并成一条轨迹记录
+"""
+import re
+from typing import Callable, List, Optional, Tuple
+from config import MEMORY_COALESCE
+from memory_record import MemoryRecord
+
+
+class CoalesceRule:
+    """一条合并规则：key(memory)返回合并键（None表示不适用），
+    render(first, last, count, duration)生成合并后的内容"""
+
+    def __init__(self, name: str, key: Callable, render: Callable):
+        self.name = name
+        self.key = key
+        self.render = render
+
+
+_MOVE_PATTERN = re.compile(r"^移动到\((.+)\)$")
+
+
+def _move_position(content: str) -> str:
+    return _MOVE_PATTERN.match(content).group(1)
+
+
+def default_rules() -> List[CoalesceRule]:
+    """默认规则，按顺序匹配"""
+    return [
+        CoalesceRule(
+            "trajectory",
+            lambda memory: "trajectory" if _MOVE_PATTERN.match(memory.content) else None,
+            lambda first, last, count, duration: (
+                f"从({_move_position(first.content)})移动到({_move_position(last.content)})，"
+                f"走了{count}步，用时{duration:.1f}秒")
+        ),
+        CoalesceRule(
+            "repeat",
+            lambda memory: ("repeat", memory.type_code, memory.content),
+            lambda first, last, count, duration: (
+                f"{first.content}（连续{count}次，历时{duration:.1f}秒）")
+        ),
+    ]
+
+
+class _Run:
+    """正在合并中的一段连续事件"""
+
+    def __init__(self, rule: CoalesceRule, key, memory: MemoryRecord):
+        self.rule = rule
+        self.key = key
+        self.first = memory
+        self.last = memory
+        self.count = 1
+        self.importance = memory.importance
+
+    def record(self) -> MemoryRecord:
+        if self.count == 1:
+            return self.first
+        duration = self.last.timestamp - self.first.timestamp
+        return MemoryRecord(self.last.timestamp,
+                            self.rule.render(self.first, self.last, self.count, duration),
+                            self.first.type_code, self.importance)
+
+
+class MemoryCoalescer:
+    """位于记忆流前面的合并层
+
+    重要性不超过max_importance的事件按规则合并：同一合并键的连续事件
+    只保留一段进行中的记录，直到出现其他记忆、跨度超过max_span秒
+    或条数达到max_count时才输出一条合并后的记忆（时间戳为最后一次事件）。
+    """
+
+    def __init__(self, rules: Optional[List[CoalesceRule]] = None,
+                 max_importance: int = MEMORY_COALESCE["max_importance"],
+                 max_span: float = MEMORY_COALESCE["max_span"],
+                 max_count: int = MEMORY_COALESCE["max_count"]):
+        self.rules = rules if rules is not None else default_rules()
+        self.max_importance = max_importance
+        self.max_span = max_span
+        self.max_count = max_count
+        self._run: Optional[_Run] = None
+        self.stats = {"events": 0, "records": 0}
+
+    def _match(self, memory: MemoryRecord) -> Optional[Tuple[CoalesceRule, object]]:
+        if memory.importance > self.max_importance:
+            return None
+        for rule in self.rules:
+            key = rule.key(memory)
+            if key is not None:
+                return rule, key
+        return None
+
+    def offer(self, memory: MemoryRecord) -> List[MemoryRecord]:
+        """送入一条记忆，返回现在需要写入记忆流的记忆（按时间顺序）"""
+        self.stats["events"] += 1
+        matched = self._match(memory)
+        run = self._run
+        if (matched is not None and run is not None and run.key == matched[1]
+                and run.count < self.max_count
+                and memory.timestamp - run.first.timestamp <= self.max_span):
+            run.last = memory
+            run.count += 1
+            run.importance = max(run.importance, memory.importance)
+            return []
+
+        output = []
+        flushed = self.flush()
+        if flushed is not None:
+            output.append(flushed)
+        if matched is None:
+            output.append(memory)
+            self.stats["records"] += 1
+        else:
+            self._run = _Run(matched[0], matched[1], memory)
+        return output
+
+    def flush(self) -> Optional[MemoryRecord]:
+        """结束进行中的合并，返回合并后的记忆"""
+        if self._run is None:
+            return None
+        record = self._run.record()
+        self._run = None
+        self.stats["records"] += 1
+        return record
@@ -0,0 +1,207 @@
+"""
+记忆检索索引 - 字符n-gram倒排索引、本地哈希向量索引和列式打分数组，随记忆添加增量更新
+"""
+import re
+import zlib
+import numpy as np
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+from context_window import _is_cjk
+
+# 非中日韩文本按单词切分
+_WORD_PATTERN = re.compile(r"[0-9A-Za-z_]+")
+
+
+def ngram_tokenize(text: str, n: int = 2) -> Set[str]:
+    """把文本切成检索用的词项
+
+    连续的中日韩字符取字符n-gram（不足n个字时整段作为一个词项），
+    字母数字按单词切分并转为小写，标点和空白作为分隔。
+    """
+    terms = set()
+    run = []
+    for ch in text + " ":
+        if _is_cjk(ch):
+            run.append(ch)
+            continue
+        if run:
+            if len(run) < n:
+                terms.add("".join(run))
+            else:
+                terms.update("".join(run[i:i + n]) for i in range(len(run) - n + 1))
+            run = []
+    terms.update(word.lower() for word in _WORD_PATTERN.findall(text))
+    return terms
+
+
+class InvertedIndex:
+    """词项 -> 记忆编号列表
+
+    记忆编号按添加顺序递增，所以每个倒排列表天然按时间排序，
+    查询时只需从列表尾部取最近的若干条。
+    """
+
+    def __init__(self, tokenizer: Callable[[str], Set[str]] = ngram_tokenize):
+        self.tokenizer = tokenizer
+        self.postings: Dict[str, List[int]] = {}
+
+    def add(self, doc_id: int, text: str):
+        for term in self.tokenizer(text):
+            self.postings.setdefault(term, []).append(doc_id)
+
+    def clear(self):
+        self.postings.clear()
+
+    def compact(self, remap: np.ndarray):
+        """按 旧编号 -> 新编号 重写倒排列表（-1表示已删除），旧编号的先后顺序保持不变"""
+        new_ids = remap.tolist()
+        for term in list(self.postings):
+            posting = [new_ids[doc_id] for doc_id in self.postings[term] if new_ids[doc_id] >= 0]
+            if posting:
+                self.postings[term] = posting
+            else:
+                del self.postings[term]
+
+    def candidates(self, terms: Set[str], max_per_term: int) -> Dict[int, int]:
+        """返回 记忆编号 -> 命中的查询词项数，每个词项最多取最近的max_per_term条"""
+        hits: Dict[int, int] = {}
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            for doc_id in posting[-max_per_term:]:
+                hits[doc_id] = hits.get(doc_id, 0) + 1
+        return hits
+
+
+class MemoryColumns:
+    """与记忆列表平行的列式数组（时间戳、重要性、类型编码），用于向量化打分
+
+    容量不足时按两倍扩容，追加的均摊开销为O(1)。
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.timestamps = np.empty(capacity, dtype=np.float64)
+        self.importance = np.empty(capacity, dtype=np.float32)
+        self.type_codes = np.empty(capacity, dtype=np.int8)
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, needed: int):
+        capacity = max(needed, 2 * len(self.timestamps))
+        for name in ("timestamps", "importance", "type_codes"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append(self, timestamp: float, importance: float, type_code: int):
+        if self.size == len(self.timestamps):
+            self._grow(self.size + 1)
+        self.timestamps[self.size] = timestamp
+        self.importance[self.size] = importance
+        self.type_codes[self.size] = type_code
+        self.size += 1
+
+    def clear(self):
+        self.size = 0
+
+    def compact(self, keep: np.ndarray):
+        """只保留keep为True的行，行的先后顺序不变"""
+        for name in ("timestamps", "importance", "type_codes"):
+            column = getattr(self, name)
+            kept = column[:self.size][keep]
+            column[:len(kept)] = kept
+        self.size = int(np.count_nonzero(keep))
+
+    def score(self, doc_ids: np.ndarray, relevance: np.ndarray, now: float) -> np.ndarray:
+        """0.4*相关性 + 0.3*时效性 + 0.3*重要性，与逐条计算的公式一致"""
+        recency = np.exp(-0.001 * (now - self.timestamps[doc_ids]))
+        importance = self.importance[doc_ids] / 10
+        return 0.4 * relevance + 0.3 * recency + 0.3 * importance
+
+    def where_type(self, type_code: int) -> np.ndarray:
+        """某类型记忆的编号，按添加顺序排列"""
+        return np.flatnonzero(self.type_codes[:self.size] == type_code)
+
+    def where_importance(self, threshold: float) -> np.ndarray:
+        """重要性不低于阈值的记忆编号，按添加顺序排列"""
+        return np.flatnonzero(self.importance[:self.size] >= threshold)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """分数最高的k个位置（降序），用argpartition避免全量排序"""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(len(scores))
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+def hashed_ngram_vector(text: str, dim: int, ngram_sizes: Sequence[int] = (1, 2, 3)) -> np.ndarray:
+    """特征哈希的字符n-gram向量（L2归一化），不依赖网络和预训练模型
+
+    空白被压缩成单个空格；使用crc32保证不同进程间哈希一致。
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    normalized = " ".join(text.lower().split())
+    for n in ngram_sizes:
+        for i in range(len(normalized) - n + 1):
+            gram = normalized[i:i + n]
+            if gram.isspace():
+                continue
+            digest = zlib.crc32(gram.encode("utf-8"))
+            # 低位决定维度，高位决定符号，减少哈希冲突带来的偏差
+            vector[digest % dim] += 1.0 if digest & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class EmbeddingIndex:
+    """记忆向量矩阵，检索时对全部向量做一次矩阵向量乘（精确余弦）
+
+    内存窗口不超过resident_size条，全量计算的开销有上限，不需要近似索引。
+    """
+
+    def __init__(self, dim: int = 128, ngram_sizes: Sequence[int] = (1, 2, 3), capacity: int = 1024):
+        self.dim = dim
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.size = 0
+        self.matrix = np.empty((capacity, dim), dtype=np.float32)
+
+    def __len__(self):
+        return self.size
+
+    def embed(self, text: str) -> np.ndarray:
+        return hashed_ngram_vector(text, self.dim, self.ngram_sizes)
+
+    def add(self, doc_id: int, text: str, vector: Optional[np.ndarray] = None):
+        """追加一条记忆；vector为已经算好的向量（如来自检查点）时不再重新计算"""
+        if doc_id != self.size:
+            raise ValueError(f"向量索引只能按顺序追加: 期望{self.size}, 实际{doc_id}")
+        if self.size == len(self.matrix):
+            grown = np.empty((2 * len(self.matrix), self.dim), dtype=np.float32)
+            grown[:self.size] = self.matrix[:self.size]
+            self.matrix = grown
+        if vector is None:
+            vector = self.embed(text)
+        self.matrix[self.size] = vector
+        self.size += 1
+
+    def clear(self):
+        self.size = 0
+
+    def compact(self, keep: np.ndarray):
+        """只保留keep为True的向量，行的先后顺序不变"""
+        kept = self.matrix[:self.size][keep]
+        self.matrix[:len(kept)] = kept
+        self.size = len(kept)
+
+    def similarities(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """返回(记忆编号, 余弦相似度)，覆盖全部记忆"""
+        return np.arange(self.size), self.matrix[:self.size] @ self.embed(query)
@@ -0,0 +1,59 @@
+"""
+记忆记录 - 紧凑的记忆表示（__slots__、整数类型编码、内容字符串驻留）
+"""
+import sys
+from enum import Enum
+from typing import Dict
+
+
+# 记忆类型枚举
+class MemoryType(Enum):
+    OBSERVATION = "observation"  # 观察到的事件
+    ACTION = "action"  # 自己的行动
+    COMMUNICATION = "communication"  # 交流内容
+    STATE = "state"  # 状态变化
+
+
+# 记忆类型的整数编码
+MEMORY_TYPES = list(MemoryType)
+MEMORY_TYPE_CODES = {memory_type.value: code for code, memory_type in enumerate(MEMORY_TYPES)}
+
+
+class MemoryRecord:
+    """一条记忆
+
+    只有四个槽位，不带实例字典；类型存为整数编码，内容字符串经过驻留，
+    重复出现的文本（如"结束了一次对话"）在内存中只保留一份。
+    磁盘上仍使用与旧版相同的字典格式（to_dict/from_dict）。
+    """
+
+    __slots__ = ("timestamp", "content", "type_code", "importance")
+
+    def __init__(self, timestamp: float, content: str, type_code: int, importance: int):
+        self.timestamp = timestamp
+        self.content = sys.intern(content)
+        self.type_code = type_code
+        self.importance = importance
+
+    @property
+    def type(self) -> str:
+        return MEMORY_TYPES[self.type_code].value
+
+    @property
+    def memory_type(self) -> MemoryType:
+        return MEMORY_TYPES[self.type_code]
+
+    def to_dict(self) -> Dict:
+        return {
+            "timestamp": self.timestamp,
+            "content": self.content,
+            "type": self.type,
+            "importance": self.importance
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MemoryRecord":
+        return cls(data["timestamp"], data["content"], MEMORY_TYPE_CODES[data["type"]], data["importance"])
+
+    def __repr__(self):
+        return f"MemoryRecord({self.timestamp!r}, {self.content!r}, {self.type!r}, {self.importance!r})"
@@ -0,0 +1,386 @@
+"""
+记忆冷存储 - 被挤出内存窗口的记忆写入每个NPC独立的SQLite文件，按需查询
+"""
+import sqlite3
+import threading
+import numpy as np
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from memory_record import MemoryRecord, MEMORY_TYPE_CODES
+from memory_index import ngram_tokenize
+
+
+def ensure_vector_column(conn: sqlite3.Connection):
+    """旧版本创建的memories表没有vector列，打开时补上"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(memories)")}
+    if "vector" not in columns:
+        conn.execute("ALTER TABLE memories ADD COLUMN vector BLOB")
+
+
+def _decode_vector(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+class ColdMemoryStore:
+    """SQLite中的冷记忆，字段与磁盘上的记忆字典一致（类型存为字符串）
+
+    同时维护条数、最大时间戳和最大重要性，调用方据此判断
+    冷存储中是否可能有比内存窗口更好的结果，不必每次都查询。
+
+    每条冷记忆的检索词项（与内存窗口相同的分词）连同时间戳写入memory_terms表，
+    每个词项的记录按时间有序，检索和term_hits()按词项走索引，不扫描content。
+
+    向量模式（传入embed）下每条冷记忆同时保存向量（float32），检索时直接用存下的
+    向量打分，不重新计算；另外维护全部冷记忆向量每一维的最大值和最小值
+    （memory_vector_bounds表），relevance_bound()据此给出余弦相似度的上界。
+    删除冷记忆时上下界不收缩，只会变宽松，仍然是有效的上界。
+
+    insert_later()把写入交给PersistenceManager的写盘线程（使用单独的连接），
+    写完之前这批记忆（及其向量）暂存在内存中，查询结果照常包含它们。
+
+    所有查询都带上_scope条件，子类可以把冷记忆放在共享的表中。
+    """
+
+    _scope = "1 = 1"
+    _bounds_owner = ""
+
+    def __init__(self, path: str, tokenizer: Callable[[str], Set[str]] = ngram_tokenize,
+                 embed: Optional[Callable[[str], np.ndarray]] = None):
+        self.path = path
+        self.tokenizer = tokenizer
+        self.embed = embed
+        self.vector_upper: Optional[np.ndarray] = None
+        self.vector_lower: Optional[np.ndarray] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writer_conn: Optional[sqlite3.Connection] = None
+        self._scope_params: Tuple = ()
+        self._pending: List[MemoryRecord] = []
+        self._pending_vectors: Dict[int, np.ndarray] = {}
+        self._pending_lock = threading.Lock()
+        self.count = 0
+        self.max_timestamp = float("-inf")
+        self.max_importance = 0
+        self._open()
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path)
+        # 写盘线程写入时主线程仍可读取
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY,
+                timestamp REAL NOT NULL,
+                content TEXT NOT NULL,
+                type TEXT NOT NULL,
+                importance INTEGER NOT NULL,
+                vector BLOB
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_memories_key ON memories(timestamp, content);
+            CREATE INDEX IF NOT EXISTS idx_memories_type ON memories(type, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_memories_importance ON memories(importance, timestamp);
+            CREATE TABLE IF NOT EXISTS memory_terms (
+                term TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                memory_id INTEGER NOT NULL,
+                PRIMARY KEY (term, timestamp, memory_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS memory_vector_bounds (
+                owner TEXT PRIMARY KEY,
+                upper BLOB NOT NULL,
+                lower BLOB NOT NULL
+            );
+        """)
+        ensure_vector_column(self._conn)
+        self._load_stats()
+        with self._conn:
+            self._backfill_terms(self._conn)
+            self._backfill_vectors(self._conn)
+
+    def _backfill_terms(self, conn: sqlite3.Connection):
+        """旧版本写入的冷记忆没有词项，打开时补齐一次"""
+        if not self.count or conn.execute(
+                f"SELECT 1 FROM memory_terms JOIN memories ON memories.id = memory_terms.memory_id "
+                f"WHERE {self._scope} LIMIT 1", self._scope_params).fetchone():
+            return
+        rows = conn.execute(f"SELECT id, timestamp, content FROM memories WHERE {self._scope}",
+                            self._scope_params)
+        conn.executemany("INSERT OR IGNORE INTO memory_terms(term, timestamp, memory_id) VALUES (?, ?, ?)",
+                         [(term, timestamp, memory_id) for memory_id, timestamp, content in rows.fetchall()
+                          for term in self.tokenizer(content)])
+
+    def _backfill_vectors(self, conn: sqlite3.Connection):
+        """向量模式下补齐没有向量（或维度不同）的冷记忆，并加载每一维的上下界"""
+        if self.embed is None:
+            return
+        nbytes = self.embed("").nbytes
+        rows = conn.execute(
+            f"SELECT id, content FROM memories WHERE {self._scope} AND (vector IS NULL OR length(vector) != ?)",
+            (*self._scope_params, nbytes)).fetchall()
+        conn.executemany("UPDATE memories SET vector = ? WHERE id = ?",
+                         [(self.embed(content).tobytes(), memory_id) for memory_id, content in rows])
+        row = conn.execute("SELECT upper, lower FROM memory_vector_bounds WHERE owner = ?",
+                           (self._bounds_owner,)).fetchone()
+        if row is not None and not rows and len(row[0]) == nbytes:
+            self.vector_upper, self.vector_lower = _decode_vector(row[0]).copy(), _decode_vector(row[1]).copy()
+            return
+        # 没有保存过或刚补齐了向量：扫描一次全部冷记忆向量
+        conn.execute("DELETE FROM memory_vector_bounds WHERE owner = ?", (self._bounds_owner,))
+        cursor = conn.execute(f"SELECT vector FROM memories WHERE {self._scope}", self._scope_params)
+        while True:
+            blobs = cursor.fetchmany(4096)
+            if not blobs:
+                break
+            vectors = _decode_vector(b"".join(blob for blob, in blobs)).reshape(len(blobs), -1)
+            self._widen_bounds(vectors)
+            self._store_bounds(conn, vectors)
+
+    def _widen_bounds(self, vectors: Optional[np.ndarray]):
+        if vectors is None or not len(vectors):
+            return
+        upper, lower = vectors.max(axis=0), vectors.min(axis=0)
+        if self.vector_upper is not None:
+            upper, lower = np.maximum(upper, self.vector_upper), np.minimum(lower, self.vector_lower)
+        self.vector_upper, self.vector_lower = upper, lower
+
+    def _store_bounds(self, conn: sqlite3.Connection, vectors: Optional[np.ndarray]):
+        """把一批向量合并进表中保存的上下界；在写入这批记忆的连接和事务中执行"""
+        if vectors is None or not len(vectors):
+            return
+        upper, lower = vectors.max(axis=0), vectors.min(axis=0)
+        row = conn.execute("SELECT upper, lower FROM memory_vector_bounds WHERE owner = ?",
+                           (self._bounds_owner,)).fetchone()
+        if row is not None and len(row[0]) == upper.nbytes:
+            upper = np.maximum(upper, _decode_vector(row[0]))
+            lower = np.minimum(lower, _decode_vector(row[1]))
+        conn.execute("INSERT OR REPLACE INTO memory_vector_bounds(owner, upper, lower) VALUES (?, ?, ?)",
+                     (self._bounds_owner, upper.tobytes(), lower.tobytes()))
+
+    def _vectors_for(self, memories: List[MemoryRecord], vectors: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """向量模式下返回与memories对齐的向量，调用方没有提供时才计算"""
+        if self.embed is None or not memories:
+            return None
+        if vectors is None:
+            vectors = np.stack([self.embed(m.content) for m in memories])
+        return np.asarray(vectors, dtype=np.float32)
+
+    def relevance_bound(self, query_vector: np.ndarray) -> float:
+        """冷记忆与查询向量余弦相似度的上界（负值按0计）
+
+        每一维取查询分量与该维最大值、最小值之积中较大的一个，求和即为
+        任意冷记忆向量与查询内积的上界。没有向量信息时返回1。
+        """
+        if self.vector_upper is None:
+            return 1.0
+        bound = np.maximum(query_vector * self.vector_upper, query_vector * self.vector_lower).sum()
+        return float(min(max(bound, 0.0), 1.0))
+
+    def _load_stats(self):
+        count, max_timestamp, max_importance = self._conn.execute(
+            f"SELECT COUNT(*), MAX(timestamp), MAX(importance) FROM memories WHERE {self._scope}",
+            self._scope_params).fetchone()
+        self.count = count
+        if count:
+            self.max_timestamp = max_timestamp
+            self.max_importance = max_importance
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def _to_record(row: Tuple) -> MemoryRecord:
+        timestamp, content, memory_type, importance = row
+        return MemoryRecord(timestamp, content, MEMORY_TYPE_CODES[memory_type], importance)
+
+    def insert_many(self, memories: List[MemoryRecord], vectors: Optional[np.ndarray] = None):
+        """在一个事务中写入一批记忆；同一时间戳和内容的记忆只保留一条
+
+        vectors为与memories对齐的向量（如内存窗口中已有的），只在向量模式下使用。
+        """
+        vectors = self._vectors_for(memories, vectors)
+        with self._conn:
+            inserted = self._write(self._conn, memories, vectors)
+        self._add_stats(memories, inserted, vectors)
+
+    def insert_later(self, memories: List[MemoryRecord], persistence, vectors: Optional[np.ndarray] = None):
+        """统计立即更新，写入在写盘线程中进行；同批之后排队的快照重写会在它之后执行"""
+        memories = list(memories)
+        vectors = self._vectors_for(memories, vectors)
+        with self._pending_lock:
+            self._pending.extend(memories)
+            if vectors is not None:
+                self._pending_vectors.update(zip(map(id, memories), vectors))
+        # 重复的记忆也计入条数，count只用于判断冷存储是否为空
+        self._add_stats(memories, len(memories), vectors)
+        persistence.run(self.path, lambda: self._write_pending(memories, vectors))
+
+    def _write_pending(self, memories: List[MemoryRecord], vectors: Optional[np.ndarray]):
+        """写盘线程：用单独的连接写入，提交后从暂存中移除"""
+        if self._writer_conn is None:
+            self._writer_conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._writer_conn:
+            self._write(self._writer_conn, memories, vectors)
+        written = set(map(id, memories))
+        with self._pending_lock:
+            self._pending = [m for m in self._pending if id(m) not in written]
+            for key in written:
+                self._pending_vectors.pop(key, None)
+
+    def _write(self, conn: sqlite3.Connection, memories: List[MemoryRecord],
+               vectors: Optional[np.ndarray] = None) -> int:
+        """写入记忆及其词项（和向量），返回新增的条数"""
+        blobs = [v.tobytes() for v in vectors] if vectors is not None else [None] * len(memories)
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO memories(timestamp, content, type, importance, vector) VALUES (?, ?, ?, ?, ?)",
+            [(m.timestamp, m.content, m.type, m.importance, blob) for m, blob in zip(memories, blobs)]
+        )
+        inserted = max(0, cursor.rowcount)
+        self._write_terms(conn, memories)
+        self._store_bounds(conn, vectors)
+        return inserted
+
+    def _write_terms(self, conn: sqlite3.Connection, memories: List[MemoryRecord]):
+        conn.executemany(
+            f"INSERT OR IGNORE INTO memory_terms(term, timestamp, memory_id) "
+            f"SELECT ?, timestamp, id FROM memories WHERE {self._scope} AND timestamp = ? AND content = ?",
+            [(term, *self._scope_params, m.timestamp, m.content)
+             for m in memories for term in self.tokenizer(m.content)])
+
+    def discard(self, after: float, memories: List[MemoryRecord]):
+        """删除时间晚于after的冷记忆和与memories相同的冷记忆（连同词项），重新统计
+
+        用于从检查点恢复：检查点之后新增的和之后才被淘汰的记忆都不应留在冷存储中。
+        """
+        keys = [(*self._scope_params, m.timestamp, m.content) for m in memories]
+        with self._conn:
+            self._conn.execute(
+                f"DELETE FROM memory_terms WHERE memory_id IN "
+                f"(SELECT id FROM memories WHERE {self._scope} AND timestamp > ?)", (*self._scope_params, after))
+            self._conn.execute(f"DELETE FROM memories WHERE {self._scope} AND timestamp > ?",
+                               (*self._scope_params, after))
+            self._conn.executemany(
+                f"DELETE FROM memory_terms WHERE memory_id IN "
+                f"(SELECT id FROM memories WHERE {self._scope} AND timestamp = ? AND content = ?)", keys)
+            self._conn.executemany(
+                f"DELETE FROM memories WHERE {self._scope} AND timestamp = ? AND content = ?", keys)
+        self.count = 0
+        self.max_timestamp = float("-inf")
+        self.max_importance = 0
+        self._load_stats()
+
+    def _pending_snapshot(self) -> List[MemoryRecord]:
+        with self._pending_lock:
+            return list(self._pending)
+
+    def _add_stats(self, memories: List[MemoryRecord], inserted: int, vectors: Optional[np.ndarray] = None):
+        self.count += inserted
+        self._widen_bounds(vectors)
+        for memory in memories:
+            self.max_timestamp = max(self.max_timestamp, memory.timestamp)
+            self.max_importance = max(self.max_importance, memory.importance)
+
+    def existing_keys(self, start: float, end: float) -> Set[Tuple[float, str]]:
+        """时间范围内已写入的(时间戳, 内容)，用于加载时去掉重复的记忆"""
+        pending = {(m.timestamp, m.content) for m in self._pending_snapshot() if start <= m.timestamp <= end}
+        rows = self._conn.execute(
+            f"SELECT timestamp, content FROM memories WHERE {self._scope} AND timestamp BETWEEN ? AND ?",
+            (*self._scope_params, start, end))
+        return set(rows) | pending
+
+    def latest(self, limit: int, memory_type: Optional[str] = None,
+               min_importance: Optional[int] = None) -> List[MemoryRecord]:
+        """按时间倒序取记忆，可按类型和最低重要性过滤"""
+        pending = [m for m in self._pending_snapshot()
+                   if (memory_type is None or m.type == memory_type)
+                   and (min_importance is None or m.importance >= min_importance)]
+        clauses, params = [self._scope], list(self._scope_params)
+        if memory_type is not None:
+            clauses.append("type = ?")
+            params.append(memory_type)
+        if min_importance is not None:
+            clauses.append("importance >= ?")
+            params.append(min_importance)
+        rows = self._conn.execute(
+            f"SELECT timestamp, content, type, importance FROM memories WHERE {' AND '.join(clauses)} "
+            f"ORDER BY timestamp DESC LIMIT ?", (*params, limit))
+        return self._merge_pending([self._to_record(row) for row in rows], pending)[:limit]
+
+    @staticmethod
+    def _merge_pending(memories: List[MemoryRecord], pending: List[MemoryRecord]) -> List[MemoryRecord]:
+        """合并查询结果和暂存的记忆，去掉已经写入的重复项，按时间倒序"""
+        if not pending:
+            return memories
+        merged = {(m.timestamp, m.content): m for m in memories + pending}
+        return sorted(merged.values(), key=lambda m: m.timestamp, reverse=True)
+
+    def latest_timestamp_with_prefix(self, prefix: str) -> float:
+        """内容以prefix开头的最新记忆的时间戳，没有时返回负无穷"""
+        row = self._conn.execute(
+            f"SELECT MAX(timestamp) FROM memories WHERE {self._scope} AND content LIKE ? ESCAPE '\\'",
+            (*self._scope_params, f"{self._escape(prefix)}%")).fetchone()
+        pending = [m.timestamp for m in self._pending_snapshot() if m.content.startswith(prefix)]
+        return max([row[0] if row[0] is not None else float("-inf")] + pending)
+
+    def term_hits(self, terms: Iterable[str]) -> int:
+        """冷存储中出现过的查询词项个数，每个词项是一次索引查找"""
+        terms = [term for term in terms if term]
+        present = set()
+        for term in terms:
+            if self._conn.execute(
+                    f"SELECT 1 FROM memory_terms JOIN memories ON memories.id = memory_terms.memory_id "
+                    f"WHERE memory_terms.term = ? AND {self._scope} LIMIT 1",
+                    (term, *self._scope_params)).fetchone():
+                present.add(term)
+        pending = self._pending_snapshot()
+        if pending and len(present) < len(terms):
+            missing = set(terms) - present
+            for memory in pending:
+                present |= missing & self.tokenizer(memory.content)
+        return len(present)
+
+    def search(self, terms: Iterable[str], limit: int) -> List[MemoryRecord]:
+        """检索候选：包含任一词项的最近记忆，加上最重要的若干条记忆
+
+        每个词项沿索引从最新的记录往前取，最多limit条后停止，合并后保留最近的limit条。
+        """
+        return [memory for memory, _ in self._search(terms, limit)]
+
+    def search_with_vectors(self, terms: Iterable[str], limit: int) -> Tuple[List[MemoryRecord], np.ndarray]:
+        """与search()相同的候选，连同存下的向量（向量模式下使用，不重新计算）"""
+        results = self._search(terms, limit)
+        vectors = [vector if vector is not None else self.embed(memory.content) for memory, vector in results]
+        return [memory for memory, _ in results], np.stack(vectors) if vectors else np.empty((0, 0), np.float32)
+
+    def _search(self, terms: Iterable[str], limit: int) -> List[Tuple[MemoryRecord, Optional[np.ndarray]]]:
+        terms = {term for term in terms if term}
+        matched: Dict[Tuple[float, str], Tuple] = {}
+        for term in terms:
+            rows = self._conn.execute(
+                f"SELECT memories.timestamp, content, type, importance, vector FROM memory_terms "
+                f"JOIN memories ON memories.id = memory_terms.memory_id "
+                f"WHERE memory_terms.term = ? AND {self._scope} "
+                f"ORDER BY memory_terms.timestamp DESC LIMIT ?", (term, *self._scope_params, limit))
+            matched.update(((row[0], row[1]), row) for row in rows)
+        rows = [matched[key] for key in sorted(matched, key=lambda key: key[0], reverse=True)[:limit]]
+        rows += self._conn.execute(
+            f"SELECT timestamp, content, type, importance, vector FROM memories WHERE {self._scope} "
+            f"ORDER BY importance DESC, timestamp DESC LIMIT ?", (*self._scope_params, limit)).fetchall()
+        results = {(row[0], row[1]): (self._to_record(row[:4]), _decode_vector(row[4]) if row[4] else None)
+                   for row in rows}
+        with self._pending_lock:
+            pending = [(memory, self._pending_vectors.get(id(memory))) for memory in self._pending]
+        for memory, vector in pending:
+            if terms & self.tokenizer(memory.content) or memory.importance >= self.max_importance:
+                results[(memory.timestamp, memory.content)] = (memory, vector)
+        return list(results.values())
+
+    @staticmethod
+    def _escape(term: str) -> str:
+        return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    def close(self):
+        """关闭连接；经由写盘线程的写入须先由PersistenceManager.close()完成"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._writer_conn is not None:
+            self._writer_conn.close()
+            self._writer_conn = None
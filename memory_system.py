@@ -1,104 +1,495 @@
 """
 记忆流系统和编年史系统
 """
+import os
 import json
 import time
 import math
+import heapq
+import bisect
 import logging
-from enum import Enum
-from typing import List, Tuple, Dict, Optional
+import numpy as np
+from typing import Callable, List, Tuple, Dict, Optional, Set
+from config import (PRIORITY_REFLECTION, PROMPT_BUDGETS, PROMPT_MEMORY_ITEM_CHARS,
+                    MEMORY_COMPACT_INTERVAL, MEMORY_INDEX_MAX_POSTINGS, MEMORY_RECENT_CANDIDATES,
+                    MEMORY_RELEVANCE, MEMORY_EMBEDDING, MEMORY_RESIDENT_SIZES, MEMORY_EVICT_BATCH,
+                    MEMORY_HOT_IMPORTANCE, MEMORY_COLD_CANDIDATES, REFLECTION_TRIGGER,
+                    MEMORY_COALESCE, CHRONICLE_CELL_SIZE)
+from token_budget import format_lines
+from memory_index import EmbeddingIndex, InvertedIndex, MemoryColumns, ngram_tokenize, top_k
+from memory_record import MemoryType, MemoryRecord, MEMORY_TYPE_CODES
+from memory_store import ColdMemoryStore
+from memory_coalesce import MemoryCoalescer
+from persistence import PersistenceManager
 
-# 记忆类型枚举
-class MemoryType(Enum):
-    OBSERVATION = "observation"  # 观察到的事件
-    ACTION = "action"  # 自己的行动
-    COMMUNICATION = "communication"  # 交流内容
-    STATE = "state"  # 状态变化
+
+# 反思总结记忆的内容前缀，加载时据此恢复上次反思的时间
+REFLECTION_PREFIX = "反思总结: "
 
 # 记忆流系统
 class MemoryStream:
-    def __init__(self, owner_name: str):
+    """NPC的记忆流
+
+    持久化分为两部分：data/memory_{name}.json 为快照（格式与旧版一致），
+    data/memory_{name}.jsonl 为追加写入的日志。每次添加只追加一行，
+    日志达到MEMORY_COMPACT_INTERVAL条时合并进快照并清空日志。
+
+    检索使用按内容建立的倒排索引（默认为字符二元组，可传入tokenizer替换），
+    只对命中查询词项的记忆和最近的一小段记忆打分；时间戳、重要性和类型
+    另存一份列式数组，打分和按类型/重要性筛选都向量化完成。
+
+    relevance为"embedding"时改用本地哈希向量的余弦相似度作为相关性，
+    不再建立倒排索引（tokenizer仍用于冷存储的词项）。
+
+    内存中只保留resident_size条记忆（self.memories，按时间顺序），超出时
+    成批把最旧的普通记忆（其次是最旧的重要记忆）移入冷存储
+    data/memory_{name}_cold.db。检索、交流记忆和反思只在冷存储可能给出
+    更好的结果时才去查询它。
+
+    传入memories（如从检查点恢复的内存窗口）时不读取快照和日志，
+    而是以它为准重写快照；同时传入restored_at（检查点的保存时间）时，
+    冷存储（或数据库）也回退到检查点时的状态，之后正常加载与恢复后一致。
+
+    传入storage（SqliteStorage）时不使用上述文件：记忆写入共享的memories表，
+    被淘汰的记忆只在表中标记为冷记忆。
+
+    反思按水位线触发：记录上次反思之后新增的重要记忆条数和重要性总和，
+    两者都达到REFLECTION_TRIGGER中的阈值时reflection_due()才返回True。
+    反思失败或模型返回空内容时按retry_delay退避（连续失败逐次翻倍），
+    避免每帧重复请求。
+
+    连续的移动和重复的低重要性事件先经过合并层，合并成一条轨迹记录后
+    才写入记忆流；退出前需调用flush_pending()写入最后一段。
+    """
+
+    def __init__(self, owner_name: str, tokenizer: Callable[[str], Set[str]] = ngram_tokenize,
+                 relevance: str = MEMORY_RELEVANCE, resident_size: Optional[int] = None,
+                 persistence: Optional[PersistenceManager] = None, storage=None,
+                 memories: Optional[List[MemoryRecord]] = None, vectors: Optional[np.ndarray] = None,
+                 restored_at: Optional[float] = None):
+        if relevance not in ("keyword", "embedding"):
+            raise ValueError(f"未知的相关性计算方式: {relevance}")
         self.owner_name = owner_name
+        self.persistence = persistence or PersistenceManager(background=False)
+        self.snapshot_path = f"data/memory_{owner_name}.json"
+        self.log_path = f"data/memory_{owner_name}.jsonl"
+        self.cold_path = f"data/memory_{owner_name}_cold.db"
+        if resident_size is None:
+            resident_size = MEMORY_RESIDENT_SIZES.get(owner_name, MEMORY_RESIDENT_SIZES["default"])
+        self.resident_size = resident_size
+        self.storage = storage
         self.memories = []
-        self.load_from_json()
+        self.relevance = relevance
+        self.index = InvertedIndex(tokenizer)
+        self.embeddings = EmbeddingIndex(**MEMORY_EMBEDDING) if relevance == "embedding" else None
+        # 文件后端的冷存储在第一次淘汰时才创建
+        self.cold = self._open_cold() if storage is not None or os.path.exists(self.cold_path) else None
+        self.columns = MemoryColumns()
+        self.coalescer = MemoryCoalescer() if MEMORY_COALESCE["enabled"] else None
+        self._log_entries = 0
+        # 反思水位线：上次反思的时间，以及此后新增记忆的计数
+        self.reflection_watermark = float("-inf")
+        self._new_important = 0
+        self._new_importance_sum = 0
+        # 反思失败后的退避：下次允许反思的时间和当前等待秒数
+        self._reflection_retry_at = 0.0
+        self._reflection_retry_delay = 0.0
+        if memories is not None:
+            self.restore(memories, vectors, restored_at)
+        else:
+            self.load_from_json()
+        self._restore_reflection_watermark()
 
     def add(self, content: str, memory_type: MemoryType, importance: int = 5):
         """添加记忆，包含类型和重要性"""
-        memory = {
-            "timestamp": time.time(),
-            "content": content,
-            "type": memory_type.value,
-            "importance": importance
-        }
-        if memory["type"] != "observation":
-            self.memories.append(memory)
+        if memory_type == MemoryType.OBSERVATION:
+            return
+        memory = MemoryRecord(time.time(), content, MEMORY_TYPE_CODES[memory_type.value], importance)
+        records = self.coalescer.offer(memory) if self.coalescer is not None else [memory]
+        for record in records:
+            self._store(record)
+            self._count_for_reflection(record)
+
+    def flush_pending(self):
+        """把合并层中进行中的记录写入记忆流"""
+        if self.coalescer is None:
+            return
+        record = self.coalescer.flush()
+        if record is not None:
+            self._store(record)
+            self._count_for_reflection(record)
+
+    def close(self):
+        """关闭冷存储的连接；须在PersistenceManager.close()之后调用，写盘线程中排队的冷存储写入已经完成"""
+        if self.cold is not None:
+            self.cold.close()
+
+    def _store(self, memory: MemoryRecord):
+        self.memories.append(memory)
+        self._index_memory(len(self.memories) - 1, memory)
+        self._append_log(memory)
+        if len(self.memories) > self.resident_size:
+            self._evict()
+
+    def _evict(self):
+        """把内存窗口压回resident_size - MEMORY_EVICT_BATCH条（至少保留一半），被淘汰的记忆写入冷存储
+
+        冷存储写入和快照重写都在写盘线程中按顺序执行；主线程按保留行压缩已有的
+        索引和列数组，不重新分词或计算向量。
+        """
+        target = max(self.resident_size - MEMORY_EVICT_BATCH, self.resident_size // 2)
+        excess = len(self.memories) - target
+        if excess <= 0:
+            return
+        # 先淘汰普通记忆，再淘汰重要记忆，各自从最旧的开始
+        ordinary = np.flatnonzero(self.columns.importance[:self.columns.size] < MEMORY_HOT_IMPORTANCE)
+        important = np.flatnonzero(self.columns.importance[:self.columns.size] >= MEMORY_HOT_IMPORTANCE)
+        victims = np.concatenate([ordinary, important])[:excess]
+        keep = np.ones(len(self.memories), dtype=bool)
+        keep[victims] = False
+
+        if self.cold is None:
+            self.cold = self._open_cold()
+        victims = np.sort(victims)
+        # 向量模式下直接把内存窗口中的向量交给冷存储
+        vectors = self.embeddings.matrix[victims] if self.embeddings is not None else None
+        self.cold.insert_later([self.memories[i] for i in victims], self.persistence, vectors)
+        self.memories = [memory for memory, kept in zip(self.memories, keep) if kept]
+        self._compact_index(keep)
+        # 冷存储写入成功后再重写快照；两步之间崩溃时由加载时的去重处理
+        self.save_to_json()
+
+    def _open_cold(self) -> ColdMemoryStore:
+        embed = self.embeddings.embed if self.embeddings is not None else None
+        if self.storage is not None:
+            return self.storage.cold_store(self.owner_name, self.index.tokenizer, embed)
+        return ColdMemoryStore(self.cold_path, self.index.tokenizer, embed)
+
+    def _append_log(self, memory: MemoryRecord):
+        """追加一条记忆到日志，写入量与记忆总数无关"""
+        if self.storage is not None:
+            self.storage.append_memory(self.owner_name, memory)
+            return
+        self.persistence.append(self.log_path, json.dumps(memory.to_dict(), ensure_ascii=False) + "\n")
+        self._log_entries += 1
+        if self._log_entries >= MEMORY_COMPACT_INTERVAL:
             self.save_to_json()
 
     def retrieve(self, query: str, limit: int = 5) -> List[str]:
-        """根据时间、重要性和相关性检索记忆"""
+        """根据时间、重要性和相关性检索记忆
+
+        关键词模式：候选集为倒排索引中命中查询词项的记忆（每个词项取最近的若干条）
+        加上最近的MEMORY_RECENT_CANDIDATES条记忆，检索耗时不随记忆总数增长。
+        向量模式：对内存窗口中的全部记忆做精确余弦计算，是O(N)的矩阵向量乘，
+        N不超过resident_size。
+        """
         now = time.time()
+        if self.embeddings is not None:
+            doc_ids, relevance = self._embedding_candidates(query)
+        else:
+            doc_ids, relevance = self._keyword_candidates(query)
+        scores = self.columns.score(doc_ids, relevance, now) if len(doc_ids) else np.empty(0)
+        order = top_k(scores, limit)
+        results = [(scores[i], self.memories[doc_ids[i]].content) for i in order]
+
+        if self._cold_may_beat(query, results, limit, now):
+            results = sorted(results + self._retrieve_cold(query, now),
+                             key=lambda item: item[0], reverse=True)[:limit]
+        return [content for _, content in results]
+
+    def _cold_may_beat(self, query: str, results: List[Tuple[float, str]], limit: int, now: float) -> bool:
+        """冷存储中是否可能有分数高于当前第limit名的记忆
+
+        时间和重要性按冷存储中的最大值计。关键词模式下相关性的上界为冷存储中
+        出现过的查询词项占比（每个词项一次索引查找）；向量模式下为冷记忆向量
+        逐维上下界给出的余弦相似度上界（一次128维的计算）。
+        """
+        if self.cold is None or not len(self.cold) or limit <= 0:
+            return False
+        if len(results) < limit:
+            return True
+        base = 0.3 * math.exp(-0.001 * (now - self.cold.max_timestamp)) + 0.3 * self.cold.max_importance / 10
+        worst = results[-1][0]
+        if worst >= base + 0.4:
+            return False
+        if self.embeddings is not None:
+            return worst < base + 0.4 * self.cold.relevance_bound(self.embeddings.embed(query))
+        terms = self.index.tokenizer(query)
+        return worst < base + 0.4 * self.cold.term_hits(terms) / (len(terms) + 1)
+
+    def _retrieve_cold(self, query: str, now: float) -> List[Tuple[float, str]]:
+        """从冷存储取候选记忆，按与内存窗口相同的公式打分；向量模式下使用冷存储中存下的向量"""
+        terms = self.index.tokenizer(query)
+        if self.embeddings is not None:
+            memories, vectors = self.cold.search_with_vectors(terms, MEMORY_COLD_CANDIDATES)
+            if not memories:
+                return []
+            relevance = np.clip(vectors @ self.embeddings.embed(query), 0.0, 1.0)
+        else:
+            memories = self.cold.search(terms, MEMORY_COLD_CANDIDATES)
+            if not memories:
+                return []
+            relevance = np.array([len(terms & self.index.tokenizer(m.content)) for m in memories],
+                                 dtype=np.float64) / (len(terms) + 1)
         scored = []
-        for mem in self.memories:
-            # 计算时效性分数（最近的记忆分数高）
-            recency = math.exp(-0.001 * (now - mem["timestamp"]))
-            # 计算相关性分数
-            relevance = sum(1 for w in query.split() if w in mem["content"]) / (len(query.split()) + 1)
-            # 计算重要性分数
-            importance = mem["importance"] / 10
-            # 综合分数
-            score = 0.4 * relevance + 0.3 * recency + 0.3 * importance
-            scored.append((-score, mem["content"]))  # 负号用于升序排序
-        return [c for _, c in sorted(scored)[:limit]]
-
-    def get_communication_memories(self, limit: int = 10) -> List[Dict]:
+        for memory, rel in zip(memories, relevance):
+            recency = math.exp(-0.001 * (now - memory.timestamp))
+            score = 0.4 * rel + 0.3 * recency + 0.3 * memory.importance / 10
+            scored.append((score, memory.content))
+        return scored
+
+    def _recent_ids(self) -> range:
+        return range(max(0, len(self.memories) - MEMORY_RECENT_CANDIDATES), len(self.memories))
+
+    def _keyword_candidates(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """倒排索引候选，相关性为命中的查询词项占比"""
+        terms = self.index.tokenizer(query)
+        candidates = self.index.candidates(terms, MEMORY_INDEX_MAX_POSTINGS)
+        for doc_id in self._recent_ids():
+            candidates.setdefault(doc_id, 0)
+        doc_ids = np.fromiter(candidates.keys(), dtype=np.int64, count=len(candidates))
+        matched = np.fromiter(candidates.values(), dtype=np.float64, count=len(candidates))
+        return doc_ids, matched / (len(terms) + 1)
+
+    def _embedding_candidates(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """全部记忆都是候选，相关性为余弦相似度（负值按0计）"""
+        doc_ids, similarity = self.embeddings.similarities(query)
+        return doc_ids, np.clip(similarity, 0.0, 1.0)
+
+    def get_communication_memories(self, limit: int = 10) -> List[MemoryRecord]:
         """获取communication类型的记忆"""
-        communications = [m for m in self.memories if m["type"] == MemoryType.COMMUNICATION.value]
-        # 按时间排序，取最近的
-        communications.sort(key=lambda x: x["timestamp"], reverse=True)
-        return communications[:limit]
+        if limit <= 0:
+            return []
+        # 记忆按时间顺序追加，取最后limit条并倒序即为最近的
+        doc_ids = self.columns.where_type(MEMORY_TYPE_CODES[MemoryType.COMMUNICATION.value])
+        hot = [self.memories[i] for i in doc_ids[-limit:][::-1]]
+        return self._merge_cold(hot, limit, memory_type=MemoryType.COMMUNICATION.value)
+
+    def _merge_cold(self, hot: List[MemoryRecord], limit: int, **filters) -> List[MemoryRecord]:
+        """内存窗口中按时间倒序的结果不足limit条，或冷存储中可能有更新的记忆时，合并冷存储结果"""
+        if self.cold is None or not len(self.cold):
+            return hot
+        if len(hot) >= limit and hot[limit - 1].timestamp >= self.cold.max_timestamp:
+            return hot
+        merged = hot + self.cold.latest(limit, **filters)
+        merged.sort(key=lambda m: m.timestamp, reverse=True)
+        return merged[:limit]
 
     def save_to_json(self):
-        """保存记忆到JSON文件"""
-        with open(f"data/memory_{self.owner_name}.json", "w", encoding="utf-8") as f:
-            json.dump(self.memories, f, ensure_ascii=False, indent=2)
+        """压缩：把全部记忆写入快照（先写临时文件再替换），然后清空日志"""
+        if self.storage is not None:
+            # 记忆在添加时已经写入数据库
+            return
+        # 只在主线程复制列表，转换为字典和序列化在写盘线程中进行（记录写入后不再修改）
+        memories = list(self.memories)
+        self.persistence.replace(self.snapshot_path, lambda: [memory.to_dict() for memory in memories])
+        self.persistence.replace(self.log_path, "")
+        self._log_entries = 0
 
     def load_from_json(self):
-        """从JSON文件加载记忆"""
+        """加载快照并重放日志"""
+        if self.storage is not None:
+            self.memories = self.storage.load_memories(self.owner_name)
+            self._rebuild_index()
+            if len(self.memories) > self.resident_size:
+                self._evict()
+            return
         try:
-            with open(f"data/memory_{self.owner_name}.json", "r", encoding="utf-8") as f:
-                self.memories = json.load(f)
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                self.memories = [MemoryRecord.from_dict(data) for data in json.load(f)]
         except (FileNotFoundError, json.JSONDecodeError):
             self.memories = []
 
-    def check_reflection(self, bailian, npc_name: str,
-                         importance_threshold: int = 7, count_threshold: int = 5):
-        """检查是否需要触发反思，并生成新的高重要性记忆"""
-        high_importance = [m for m in self.memories if m["importance"] >= importance_threshold]
+        # 写入冷存储后、重写快照前崩溃时，快照中会残留已进入冷存储的记忆
+        if self.cold is not None and self.memories:
+            stored = self.cold.existing_keys(self.memories[0].timestamp, self.memories[-1].timestamp)
+            if stored:
+                self.memories = [m for m in self.memories if (m.timestamp, m.content) not in stored]
+
+        # 快照写入后、日志清空前崩溃时，日志中会残留已进入快照的记忆
+        last_timestamp = self.memories[-1].timestamp if self.memories else float("-inf")
+        self._log_entries = 0
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        memory = MemoryRecord.from_dict(json.loads(line))
+                    except (json.JSONDecodeError, KeyError):
+                        # 写到一半的最后一行
+                        continue
+                    self._log_entries += 1
+                    if memory.timestamp > last_timestamp:
+                        self.memories.append(memory)
+        except FileNotFoundError:
+            pass
+        self._rebuild_index()
+        if len(self.memories) > self.resident_size:
+            self._evict()
+
+    def restore(self, memories: List[MemoryRecord], vectors: Optional[np.ndarray] = None,
+                restored_at: Optional[float] = None):
+        """以给定的记忆作为内存窗口，并重写快照使之后的加载与其一致
+
+        vectors为与memories逐条对应的向量（维度须与当前配置一致），有则直接使用。
+        restored_at为检查点的保存时间：删除存储中此后新增的记忆，窗口中的记忆
+        不再留在冷存储中（检查点之后才被淘汰的），其余冷记忆保持不变。
+        """
+        self.memories = list(memories)
+        if restored_at is not None:
+            self._roll_back_storage(restored_at)
+        if vectors is not None and (self.embeddings is None or vectors.shape != (len(memories), self.embeddings.dim)):
+            vectors = None
+        self._rebuild_index(vectors)
+        if len(self.memories) > self.resident_size:
+            self._evict()
+        else:
+            self.save_to_json()
+
+    def _roll_back_storage(self, restored_at: float):
+        """把持久化的记忆回退到检查点时的状态（内存窗口为self.memories）"""
+        if self.storage is not None:
+            # 在一个事务中删除、改写本NPC的记忆，再按新的内容统计冷存储
+            self.storage.roll_back_memories(self.owner_name, self.memories, restored_at)
+            self.cold = self._open_cold()
+        elif self.cold is not None:
+            self.cold.discard(restored_at, self.memories)
+
+    def _index_memory(self, doc_id: int, memory: MemoryRecord, vector: Optional[np.ndarray] = None):
+        # 向量模式下检索不读倒排索引，只用它的分词器
+        if self.embeddings is not None:
+            self.embeddings.add(doc_id, memory.content, vector)
+        else:
+            self.index.add(doc_id, memory.content)
+        self.columns.append(memory.timestamp, memory.importance, memory.type_code)
+
+    def _compact_index(self, keep: np.ndarray):
+        """淘汰后压缩索引：保留的记忆编号变为其在新列表中的位置"""
+        self.columns.compact(keep)
+        if self.embeddings is not None:
+            self.embeddings.compact(keep)
+        else:
+            remap = np.full(len(keep), -1, dtype=np.int64)
+            remap[keep] = np.arange(np.count_nonzero(keep))
+            self.index.compact(remap)
+
+    def _rebuild_index(self, vectors: Optional[np.ndarray] = None):
+        self.index.clear()
+        self.columns.clear()
+        if self.embeddings is not None:
+            self.embeddings.clear()
+        for doc_id, memory in enumerate(self.memories):
+            self._index_memory(doc_id, memory, vectors[doc_id] if vectors is not None else None)
+
+    def _count_for_reflection(self, memory: MemoryRecord):
+        self._new_importance_sum += memory.importance
+        if memory.importance >= REFLECTION_TRIGGER["importance_threshold"]:
+            self._new_important += 1
+
+    def _restore_reflection_watermark(self):
+        """以最近一条反思总结的时间为水位线，重新统计其后的记忆"""
+        for memory in reversed(self.memories):
+            if memory.content.startswith(REFLECTION_PREFIX):
+                self.reflection_watermark = memory.timestamp
+                break
+        else:
+            if self.cold is not None:
+                self.reflection_watermark = self.cold.latest_timestamp_with_prefix(REFLECTION_PREFIX)
+        self._new_important = 0
+        self._new_importance_sum = 0
+        for memory in self.memories:
+            if memory.timestamp > self.reflection_watermark:
+                self._count_for_reflection(memory)
 
-        if len(high_importance) >= count_threshold:
-            # 取最近的若干条重要记忆
-            selected = high_importance[-count_threshold:]
-            contents = [m["content"] for m in selected]
+    def reflection_due(self) -> bool:
+        """上次反思之后是否积累了足够的新材料，且不在失败退避期内（O(1)）"""
+        return (self._new_important >= REFLECTION_TRIGGER["count_threshold"]
+                and self._new_importance_sum >= REFLECTION_TRIGGER["importance_sum_threshold"]
+                and time.time() >= self._reflection_retry_at)
 
-            prompt = f"""你是{npc_name}。
+    def _build_reflection_prompt(self, npc_name: str) -> Optional[str]:
+        """用上次反思之后的重要记忆构造反思提示词，新材料不足时返回None"""
+        if not self.reflection_due():
+            return None
+        threshold = REFLECTION_TRIGGER["importance_threshold"]
+        count = REFLECTION_TRIGGER["count_threshold"]
+        # 取水位线之后最近的若干条重要记忆
+        high_importance = self.columns.where_importance(threshold)
+        hot = [self.memories[i] for i in high_importance[::-1][:count]
+               if self.memories[i].timestamp > self.reflection_watermark]
+        selected = [m for m in self._merge_cold(hot, count, min_importance=threshold)
+                    if m.timestamp > self.reflection_watermark]
+        if not selected:
+            # 计数对应的记忆已不可取（如被合并或丢失），清零以免反复构造
+            self._new_important = 0
+            self._new_importance_sum = 0
+            return None
+
+        contents = [m.content for m in reversed(selected)]
+
+        return f"""你是{npc_name}。
 以下是你最近的一些重要记忆：
-{json.dumps(contents, ensure_ascii=False, indent=2)}
+{format_lines(contents, PROMPT_BUDGETS["check_reflection"]["memories"], PROMPT_MEMORY_ITEM_CHARS)}
 
 请你进行一次反思，总结这些记忆中的规律或经验，并生成一条简短的反思性总结。"""
 
-            try:
-                summary = bailian.generate_response(npc_name, prompt)
-                if summary:
-                    self.add(f"反思总结: {summary}", MemoryType.STATE, importance=8)
-                    return summary
-            except Exception as e:
-                logging.error(f"Reflection 生成失败: {e}")
+    def _record_reflection(self, summary: str, counted: Tuple[int, int]):
+        """写入反思总结并推进水位线；等待模型期间新增的记忆留给下一次反思"""
+        memory = MemoryRecord(time.time(), f"{REFLECTION_PREFIX}{summary}",
+                              MEMORY_TYPE_CODES[MemoryType.STATE.value], 8)
+        # 反思总结本身不计入下一次反思的材料
+        self._store(memory)
+        self.reflection_watermark = memory.timestamp
+        self._new_important = max(0, self._new_important - counted[0])
+        self._new_importance_sum = max(0, self._new_importance_sum - counted[1])
+        self._reflection_retry_delay = 0.0
+
+    def _defer_reflection(self):
+        """反思失败或返回空内容：水位线不动，等待一段时间后再试，连续失败时等待翻倍"""
+        self._reflection_retry_delay = min(
+            max(self._reflection_retry_delay * 2, REFLECTION_TRIGGER["retry_delay"]),
+            REFLECTION_TRIGGER["max_retry_delay"])
+        self._reflection_retry_at = time.time() + self._reflection_retry_delay
+
+    async def acheck_reflection(self, bailian, npc_name: str, priority: int = PRIORITY_REFLECTION):
+        """新材料足够时触发反思，并生成新的高重要性记忆；等待模型时不阻塞事件循环"""
+        prompt = self._build_reflection_prompt(npc_name)
+        if prompt is None:
+            return None
+        counted = (self._new_important, self._new_importance_sum)
+
+        try:
+            summary = await bailian.agenerate_response(npc_name, prompt, priority=priority,
+                                                       call_site="check_reflection")
+            if summary:
+                self._record_reflection(summary, counted)
+                return summary
+        except Exception as e:
+            logging.error(f"Reflection 生成失败: {e}")
+        self._defer_reflection()
         return None
 
 # 全局编年史系统
 class Chronicle:
-    def __init__(self):
+    """全局事件编年史
+
+    事件以JSONL格式追加写入data/chronicle.jsonl，旧版的data/chronicle.json
+    在第一次加载时迁移过来；传入storage时事件写入SQLite存储的chronicle表。
+    内存中按角色、行动类型和地图网格建立二级索引，
+    事件按时间顺序追加，时间范围用二分查找定位。
+    """
+
+    def __init__(self, cell_size: int = CHRONICLE_CELL_SIZE,
+                 persistence: Optional[PersistenceManager] = None, storage=None):
+        self.persistence = persistence or PersistenceManager(background=False)
+        self.storage = storage
+        self.path = "data/chronicle.jsonl"
+        self.legacy_path = "data/chronicle.json"
+        self.cell_size = cell_size
         self.events = []
+        self._timestamps = []
+        self._by_agent: Dict[str, List[int]] = {}
+        self._by_action: Dict[str, List[int]] = {}
+        self._by_cell: Dict[Tuple[int, int], List[int]] = {}
         self.load_from_json()
 
     def add_event(self, agent_name: str, action: str, location: Tuple[float, float], details: str):
@@ -112,22 +503,129 @@ class Chronicle:
         }
         if event["action"]!="observation":
             print(f"{agent_name} {action} {location} {details}")
-            self.events.append(event)
-            self.save_to_json()
+            self._index_event(event)
+            if self.storage is not None:
+                self.storage.append_event(event)
+            else:
+                self.persistence.append(self.path, json.dumps(event, ensure_ascii=False) + "\n")
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def _index_event(self, event: Dict):
+        event_id = len(self.events)
+        self.events.append(event)
+        # 时钟回拨时仍保持时间索引有序
+        timestamp = max(event["timestamp"], self._timestamps[-1]) if self._timestamps else event["timestamp"]
+        self._timestamps.append(timestamp)
+        self._by_agent.setdefault(event["agent"], []).append(event_id)
+        self._by_action.setdefault(event["action"], []).append(event_id)
+        self._by_cell.setdefault(self._cell(*event["location"]), []).append(event_id)
 
     def save_to_json(self):
-        """保存编年史到JSON文件"""
-        with open("data/chronicle.json", "w", encoding="utf-8") as f:
-            json.dump(self.events, f, ensure_ascii=False, indent=2)
+        """按当前内容重写日志文件（先写临时文件再替换）"""
+        self.persistence.replace(self.path, "".join(
+            json.dumps(event, ensure_ascii=False) + "\n" for event in self.events))
 
     def load_from_json(self):
-        """从JSON文件加载编年史"""
-        try:
-            with open("data/chronicle.json", "r", encoding="utf-8") as f:
-                self.events = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            self.events = []
+        """加载事件日志；只有旧版JSON文件时迁移为日志格式"""
+        self.events = []
+        self._timestamps = []
+        self._by_agent.clear()
+        self._by_action.clear()
+        self._by_cell.clear()
+        if self.storage is not None:
+            for event in self.storage.load_events():
+                self._index_event(event)
+            return
+        if not os.path.exists(self.path):
+            try:
+                with open(self.legacy_path, "r", encoding="utf-8") as f:
+                    for event in json.load(f):
+                        self._index_event(event)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+            if self.events:
+                self.save_to_json()
+            return
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self._index_event(json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    # 写到一半的最后一行
+                    continue
 
     def get_recent_events(self, limit: int = 10) -> List[Dict]:
         """获取最近的事件"""
-        return self.events[-limit:]
\ No newline at end of file
+        return self.events[-limit:]
+
+    def _time_slice(self, event_ids: List[int], since: Optional[float],
+                    until: Optional[float]) -> List[int]:
+        """在按时间排序的事件编号列表中二分截取时间范围"""
+        low = 0 if since is None else bisect.bisect_left(
+            event_ids, since, key=lambda i: self._timestamps[i])
+        high = len(event_ids) if until is None else bisect.bisect_right(
+            event_ids, until, key=lambda i: self._timestamps[i])
+        return event_ids[low:high]
+
+    def _near_ids(self, x: float, y: float, radius: float, since: Optional[float],
+                  until: Optional[float]) -> List[int]:
+        """覆盖以(x, y)为圆心、radius为半径的网格中、时间范围内的事件编号（按时间排序）"""
+        min_cx, min_cy = self._cell(x - radius, y - radius)
+        max_cx, max_cy = self._cell(x + radius, y + radius)
+        lists = [self._time_slice(self._by_cell[(cx, cy)], since, until)
+                 for cx in range(min_cx, max_cx + 1) for cy in range(min_cy, max_cy + 1)
+                 if (cx, cy) in self._by_cell]
+        return list(heapq.merge(*lists))
+
+    def query(self, agent: Optional[str] = None, action: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              near: Optional[Tuple[float, float]] = None, radius: float = 5.0,
+              limit: Optional[int] = None) -> List[Dict]:
+        """按角色、行动、时间范围和位置组合查询，结果按时间顺序排列
+
+        先从最小的索引列表出发，再按时间二分截取，其余条件逐条过滤，
+        limit只保留最近的若干条。
+        """
+        candidates = []
+        if agent is not None:
+            candidates.append(self._by_agent.get(agent, []))
+        if action is not None:
+            candidates.append(self._by_action.get(action, []))
+        if near is not None:
+            candidates.append(self._near_ids(near[0], near[1], radius, since, until))
+        if candidates:
+            event_ids = min(candidates, key=len)
+        else:
+            event_ids = range(len(self.events))
+        if since is not None or until is not None:
+            event_ids = self._time_slice(event_ids, since, until)
+
+        results = []
+        for event_id in reversed(event_ids):
+            event = self.events[event_id]
+            if agent is not None and event["agent"] != agent:
+                continue
+            if action is not None and event["action"] != action:
+                continue
+            if near is not None and math.hypot(event["location"][0] - near[0],
+                                               event["location"][1] - near[1]) > radius:
+                continue
+            results.append(event)
+            if limit is not None and len(results) >= limit:
+                break
+        results.reverse()
+        return results
+
+    def events_near(self, x: float, y: float, radius: float = 5.0,
+                    within: Optional[float] = None, limit: Optional[int] = None) -> List[Dict]:
+        """(x, y)附近发生的事件，within为回溯的秒数"""
+        since = time.time() - within if within is not None else None
+        return self.query(near=(x, y), radius=radius, since=since, limit=limit)
+
+    def events_by(self, agent: str, action: Optional[str] = None,
+                  limit: Optional[int] = None) -> List[Dict]:
+        """某个角色的事件，可限定行动类型"""
+        return self.query(agent=agent, action=action, limit=limit)
\ No newline at end of file
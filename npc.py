@@ -8,20 +8,30 @@ import math
 import random
 import re
 import logging
+import asyncio
 from typing import List, Dict, Optional
+from collections import Counter
 from memory_system import MemoryStream, MemoryType
+from persistence import PersistenceManager
+from token_budget import format_lines
 from config import *
 
 
 
 class SmartNPC:
     def __init__(self, name: str, x: float, y: float, bailian,
-                 dialog_system, chronicle):
+                 dialog_system, chronicle, policy=None, persistence=None, storage=None, restore=None):
         self.name = name
         self.x = x
         self.y = y
         self.bailian = bailian
-        self.memory = MemoryStream(name)
+        self.policy = policy
+        self.persistence = persistence or PersistenceManager(background=False)
+        self.storage = storage
+        self.memory = MemoryStream(name, persistence=self.persistence, storage=storage,
+                                   memories=restore.memories if restore is not None else None,
+                                   vectors=restore.vectors if restore is not None else None,
+                                   restored_at=restore.saved_at if restore is not None else None)
         self.chronicle = chronicle
         self.state = "wandering"
         self.last_action_time = time.time()
@@ -55,13 +65,35 @@ class SmartNPC:
         self.last_conversation_time = 0
         self.is_dead = False
 
-        # 模型调用冷却相关
-        self.last_model_call_time = 0
+        # 模拟思考延迟（模型调用的限流由BailianClient的调度器负责）
         self.model_response_delay = random.uniform(1.0, 3.0)
 
+        # 后台模型请求
+        self._tasks = set()
+        self._pending_action = None
+        self._pending_snapshot = None  # 预取决策时的感知快照
+        self._pending_reflection = None
+        self.prefetch_stats = {"used": 0, "discarded": 0}
+
         # 预生成名字标签
         self.name_surface = self._pre_render_name_tag(name)
-        self.load_state()
+        if restore is not None:
+            self.restore_state(restore)
+        else:
+            self.load_state()
+
+    def _spawn(self, coro):
+        """在事件循环中后台运行协程，模型请求期间游戏循环继续运行"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task):
+        """回收后台任务并记录异常"""
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"{self.name} 后台任务失败: {task.exception()}")
 
     def _pre_render_name_tag(self, name):
         """预生成带背景的名字标签"""
@@ -78,30 +110,45 @@ class SmartNPC:
         return bg_surf
 
     def save_state(self):
-        """保存NPC状态到JSON"""
-        state = {
+        """标记NPC状态需要保存（由持久化服务或SQLite存储批量写入）"""
+        snapshot = lambda: {
             "name": self.name,
             "x": self.x,
             "y": self.y,
             "energy": self.energy,
-            "inventory": self.inventory,
+            "inventory": dict(self.inventory),
             "is_dead": self.is_dead
         }
-        with open(f"data/npc_{self.name}.json", "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        if self.storage is not None:
+            self.storage.save_npc(self.name, snapshot)
+        else:
+            self.persistence.mark_dirty(f"data/npc_{self.name}.json", snapshot)
 
     def load_state(self):
-        """从JSON加载NPC状态"""
-        try:
-            with open(f"data/npc_{self.name}.json", "r", encoding="utf-8") as f:
-                state = json.load(f)
-                self.x = state["x"]
-                self.y = state["y"]
-                self.energy = state["energy"]
-                self.inventory = state["inventory"]
-                self.is_dead = state["is_dead"]
-        except (FileNotFoundError, json.JSONDecodeError):
-            pass
+        """从JSON或SQLite存储加载NPC状态"""
+        if self.storage is not None:
+            state = self.storage.load_npc(self.name)
+        else:
+            try:
+                with open(f"data/npc_{self.name}.json", "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                state = None
+        if state is not None:
+            self.x = state["x"]
+            self.y = state["y"]
+            self.energy = state["energy"]
+            self.inventory = state["inventory"]
+            self.is_dead = state["is_dead"]
+
+    def restore_state(self, restore):
+        """从检查点恢复生命体征和背包，并写回状态存储"""
+        self.x = self.target_x = restore.x
+        self.y = self.target_y = restore.y
+        self.energy = restore.energy
+        self.inventory = dict(restore.inventory)
+        self.is_dead = restore.is_dead
+        self.save_state()
 
     def find_nearby_npcs(self, all_npcs: List['SmartNPC']):
         """找到附近的NPC"""
@@ -154,6 +201,44 @@ class SmartNPC:
             if npc.can_hear(self, volume):
                 npc.hear_message(self, message, volume)
 
+    async def talk_stream(self, chunks, listener_name: str, volume: str = "normal") -> str:
+        """边生成边说话：部分内容实时显示在对话面板，结束后按完整消息记录
+
+        生成中途失败时，已经说出的部分标记为没说完再记录。
+        """
+        utterance_id = self.dialog_system.begin_utterance(self.name, listener_name)
+        message = ""
+        interrupted = False
+        try:
+            async for chunk in chunks:
+                message += chunk
+                self.dialog_system.update_utterance(utterance_id, message)
+        except Exception as e:
+            print(f"调用大模型失败: {str(e)}")
+            interrupted = True
+        finally:
+            self.dialog_system.finish_utterance(utterance_id)
+
+        message = message.strip()
+        if message and interrupted:
+            message = f"{message}……（话没说完）"
+        if message:
+            self.talk(message, volume)
+        return message
+
+    async def speak_response(self, prompt: str, listener_name: str, volume: str = "normal",
+                             call_site: str = "response") -> str:
+        """请求模型生成回应并说出来，开启流式时说出第一句就开始广播"""
+        if STREAM_RESPONSES:
+            return await self.talk_stream(
+                self.bailian.astream_response(self.name, prompt, call_site=call_site),
+                listener_name, volume
+            )
+        response = await self.bailian.agenerate_response(self.name, prompt, call_site=call_site)
+        if response:
+            self.talk(response, volume)
+        return response
+
     def hear_message(self, speaker, message: str, volume: str):
         """听到消息"""
         distance = math.sqrt((self.x - speaker.x) ** 2 + (self.y - speaker.y) ** 2)
@@ -335,26 +420,18 @@ class SmartNPC:
         """初次见面问候"""
         greeting = f"{target_npc.name}你好"
         self.talk(greeting)
-        target_npc.respond_to_greeting(self.name, greeting)
+        target_npc._spawn(target_npc.respond_to_greeting(self.name, greeting))
 
-    def respond_to_greeting(self, speaker_name: str, message: str):
+    async def respond_to_greeting(self, speaker_name: str, message: str):
         """回应问候"""
-        # 检查模型调用冷却
-        current_time = time.time()
-        if current_time - self.last_model_call_time < MODEL_CALL_COOLDOWN / 2:
-            return
-
-        self.last_model_call_time = current_time
-
         prompt = f"""你是{self.name}，第一次见到{speaker_name}。
 {speaker_name}对你说: "{message}"
 """
 
         # 模拟思考延迟
-        time.sleep(self.model_response_delay)
+        await asyncio.sleep(self.model_response_delay)
 
-        response = self.bailian.generate_response(self.name, prompt)
-        self.talk(response)
+        response = await self.speak_response(prompt, speaker_name, call_site="respond_to_greeting")
 
         # 添加到全局对话系统
         self.dialog_system.add_conversation(self.name, speaker_name, response)
@@ -370,59 +447,45 @@ class SmartNPC:
         target_npc.conversation_partner = self
         target_npc.is_conversation_initiator = False
 
-        recent_memories = self.memory.retrieve("对话", 3)
+        self._spawn(self._open_conversation(target_npc))
+
+    def _exchange_history(self, other_name: str, exclude: Optional[str] = None) -> str:
+        """与other_name之间最近的交流，exclude为已经单独写进提示词的对方发言"""
+        lines = [f"{speaker}: {message}"
+                 for speaker, _, message, _ in self.dialog_system.get_exchanges(self.name, other_name)
+                 if not (exclude is not None and speaker == other_name and message == exclude)]
+        return format_lines(lines, PROMPT_BUDGETS["conversation"]["memories"], PROMPT_MEMORY_ITEM_CHARS)
+
+    async def _open_conversation(self, target_npc):
+        """生成开场白并等待对方回应"""
         prompt = f"""你是{self.name}，正在与{target_npc.name}在荒岛上对话。
-之前的交流: {recent_memories}
+之前的交流:
+{self._exchange_history(target_npc.name)}
 请说一句开始对话的话，说话请像人类，尽量自然。"""
 
         # 模拟思考延迟
-        time.sleep(self.model_response_delay)
+        await asyncio.sleep(self.model_response_delay)
 
-        response = self.bailian.generate_response(self.name, prompt)
-        self.talk(response)
-        target_npc.receive_message(self.name, response)
+        response = await self.speak_response(prompt, target_npc.name,
+                                             call_site="start_conversation_with")
+        await target_npc.receive_message(self.name, response)
 
-    def receive_message(self, speaker_name: str, message: str):
+    async def receive_message(self, speaker_name: str, message: str):
         """接收并回应消息"""
-        # 检查模型调用冷却
-        current_time = time.time()
-        if current_time - self.last_model_call_time < MODEL_CALL_COOLDOWN / 2:
-            return
-
-        self.last_model_call_time = current_time
-
-        recent_memories = self.memory.retrieve(f"{speaker_name} 对话", 3)
         prompt = f"""你是{self.name}，正在与{speaker_name}对话。
 {speaker_name}对你说: "{message}"
-之前的交流: {recent_memories}
+之前的交流:
+{self._exchange_history(speaker_name, exclude=message)}
 请自然回应。"""
 
         # 模拟思考延迟
-        time.sleep(self.model_response_delay)
+        await asyncio.sleep(self.model_response_delay)
 
-        response = self.bailian.generate_response(self.name, prompt)
-        self.talk(response)
+        response = await self.speak_response(prompt, speaker_name, call_site="receive_message")
 
         # 添加到全局对话系统
         self.dialog_system.add_conversation(self.name, speaker_name, response)
 
-    def continue_conversation(self):
-        """继续对话（只有发起者调用）"""
-        if not self.conversation_partner or not self.is_conversation_initiator:
-            return
-
-        recent_memories = self.memory.retrieve("对话", 5)
-        prompt = f"""你是{self.name}，正在与{self.conversation_partner.name}继续对话。
-之前的交流: {recent_memories}
-请继续对话，保持自然。"""
-
-        # 模拟思考延迟
-        time.sleep(self.model_response_delay)
-
-        response = self.bailian.generate_response(self.name, prompt)
-        self.talk(response)
-        self.conversation_partner.receive_message(self.name, response)
-
     def should_end_conversation(self):
         """检查是否应该结束对话"""
         if not self.conversation_partner:
@@ -459,29 +522,116 @@ class SmartNPC:
         self.memory.add("结束了一次对话", MemoryType.ACTION, 5)
 
     def decide_action(self, world_state: str) -> Dict:
-        """决定下一步行动"""
-        
+        """决定下一步行动
+
+        模型请求在后台进行，本帧立即返回；结果在之后的帧中交付执行。
+        临近决策时间时会根据当前感知提前预取，到期时若感知没有明显变化则直接使用。
+        """
+        if self._pending_action is not None:
+            if self._pending_snapshot is None:
+                if not self._pending_action.done():
+                    return {"action": "idle", "target": None, "details": "思考中", "volume": None}
+                return self._take_pending_action()
+
+            # 预取的决策：到期前保留，到期时检查感知是否变化
+            if self._time_until_due() >= 0:
+                return {"action": "idle", "target": None, "details": "无行动", "volume": None}
+            if (self._perception_changed(self._pending_snapshot)
+                    or (self.policy is not None and self.policy.match(self) is not None)):
+                self._pending_action.cancel()
+                self._pending_action = None
+                self._pending_snapshot = None
+                self.prefetch_stats["discarded"] += 1
+            elif not self._pending_action.done():
+                return {"action": "idle", "target": None, "details": "思考中", "volume": None}
+            else:
+                self.last_action_time = time.time()
+                self.prefetch_stats["used"] += 1
+                return self._take_pending_action()
 
+        if self._pending_action is None and self._time_until_due() < 0:
+            local_action = self._evaluate_policy()
+            if local_action is not None:
+                return local_action
 
-        current_time = time.time()
-        if current_time - self.last_action_time > (144.0 / FPS):
-            self.last_action_time = current_time
-            self.last_model_call_time = current_time
-
-            # 收集决策所需信息
-            memories = self.memory.retrieve("决策", 5)
-            nearby_npcs_info = f"附近有{len(self.nearby_npcs)}个NPC: {[npc.name for npc in self.nearby_npcs]}" if self.nearby_npcs else "附近没有其他NPC"
-            nearby_resources_info = f"附近有{len(self.nearby_resources)}种资源: {[res['type'] for res in self.nearby_resources]}" if self.nearby_resources else "附近没有明显资源"
-            inventory_info = f"背包: {', '.join([f'{k}:{v}' for k, v in self.inventory.items() if v > 0])}"
-            vitals_info = f"能量值: {self.energy}"
-
-            prompt = f"""你是{self.name}，在荒岛上生存。
+        if self.needs_decision():
+            self.request_action(self.build_action_prompt(world_state))
+        return {"action": "idle", "target": None, "details": "无行动", "volume": None}
+
+    def _evaluate_policy(self) -> Optional[Dict]:
+        """到期时先用本地规则决策，命中则不再请求模型"""
+        if self.policy is None:
+            return None
+        action = self.policy.evaluate(self)
+        if action is not None:
+            self.last_action_time = time.time()
+        return action
+
+    def _take_pending_action(self) -> Dict:
+        """取出已完成的决策结果"""
+        task, self._pending_action = self._pending_action, None
+        self._pending_snapshot = None
+        if task.cancelled() or task.exception() is not None:
+            return {"action": "rest", "target": None, "details": "暂时休息", "volume": None}
+        return task.result()
+
+    def _time_until_due(self) -> float:
+        """距离下一次行动决策的秒数，负数表示已到期"""
+        return self.last_action_time + 144.0 / FPS - time.time()
+
+    def needs_decision(self) -> bool:
+        """是否需要发起模型决策请求（已到期，或即将到期可以预取）
+
+        本地规则能直接决定的情况不需要请求模型。
+        """
+        if self._pending_action is not None or self._time_until_due() > ACTION_PREFETCH_LEAD:
+            return False
+        return self.policy is None or self.policy.match(self) is None
+
+    def perception_snapshot(self) -> Dict:
+        """记录决策所依据的感知信息"""
+        return {
+            "x": self.x,
+            "y": self.y,
+            "energy": self.energy,
+            "inventory": dict(self.inventory),
+            "npcs": frozenset(npc.name for npc in self.nearby_npcs),
+            "resources": frozenset(res["type"] for res in self.nearby_resources)
+        }
+
+    def _perception_changed(self, snapshot: Dict) -> bool:
+        """与预取时的感知相比是否有明显变化"""
+        current = self.perception_snapshot()
+        moved = math.sqrt((current["x"] - snapshot["x"]) ** 2 + (current["y"] - snapshot["y"]) ** 2)
+        return (moved > PREFETCH_DISTANCE_TOLERANCE
+                or abs(current["energy"] - snapshot["energy"]) > PREFETCH_ENERGY_TOLERANCE
+                or current["inventory"] != snapshot["inventory"]
+                or current["npcs"] != snapshot["npcs"]
+                or current["resources"] != snapshot["resources"])
+
+    def build_action_prompt(self, world_state: str) -> str:
+        """根据当前感知构造行动决策的提示词"""
+        # 收集决策所需信息
+        budget = PROMPT_BUDGETS["decide_action"]
+        memories = format_lines(self.memory.retrieve("决策", 5), budget["memories"],
+                                PROMPT_MEMORY_ITEM_CHARS)
+        npc_names = [npc.name for npc in self.nearby_npcs][:budget["max_npcs"]]
+        nearby_npcs_info = f"附近有{len(self.nearby_npcs)}个NPC: {npc_names}" if self.nearby_npcs else "附近没有其他NPC"
+        # 同类资源合并计数，避免逐格列出
+        resource_counts = Counter(res["type"] for res in self.nearby_resources)
+        resource_types = [t for t, _ in resource_counts.most_common(budget["max_resource_types"])]
+        nearby_resources_info = f"附近有{len(resource_counts)}种资源: {resource_types}，共{len(self.nearby_resources)}处" if self.nearby_resources else "附近没有明显资源"
+        inventory_info = f"背包: {', '.join([f'{k}:{v}' for k, v in self.inventory.items() if v > 0])}"
+        vitals_info = f"能量值: {self.energy}"
+
+        prompt = f"""你是{self.name}，在荒岛上生存。
 当前状态: {world_state}
 生命状态: {vitals_info}
 {nearby_npcs_info}
 {nearby_resources_info}
 {inventory_info}
-最近的记忆: {memories}
+最近的记忆:
+{memories}
 
 请决定你接下来的行动。考虑你的生命值和能量，周围的资源和其他NPC。
 如果能量低，考虑吃东西或喝水。
@@ -494,18 +644,38 @@ details的格式必须为资源类型,数量
 detail的样子必须如"水,2"
 "details": "水,2"
 """
+        return prompt
 
-            # 模拟思考延迟
-            time.sleep(self.model_response_delay)
+    def request_action(self, prompt: str, batch: Optional[asyncio.Task] = None):
+        """开始一次行动决策；batch为多个NPC共享的批量决策任务
 
-            try:
-                response = self.bailian.generate_action(self.name, prompt)
-                action_data = json.loads(response)
-                return action_data
-            except Exception as e:
-                print(f"解析行动决策失败: {e}")
-                return {"action": "rest", "target": None, "details": "暂时休息", "volume": None}
-        return {"action": "idle", "target": None, "details": "无行动", "volume": None}
+        尚未到期时作为预取，记录当前感知快照，到期时再决定是否采用。
+        """
+        if self._time_until_due() >= 0:
+            self._pending_snapshot = self.perception_snapshot()
+        else:
+            self._pending_snapshot = None
+            self.last_action_time = time.time()
+        if self.policy is not None:
+            self.policy.record_deferred()
+        self._pending_action = self._spawn(self._request_action(prompt, batch))
+
+    async def _request_action(self, prompt: str, batch: Optional[asyncio.Task] = None) -> Dict:
+        """异步请求模型给出行动决策"""
+        # 模拟思考延迟
+        await asyncio.sleep(self.model_response_delay)
+
+        try:
+            if batch is None:
+                response = await self.bailian.agenerate_action(self.name, prompt)
+            else:
+                # shield: 单个NPC的任务被取消时不影响其他NPC共享的批量请求
+                response = (await asyncio.shield(batch))[self.name]
+            action_data = json.loads(response)
+            return action_data
+        except Exception as e:
+            print(f"解析行动决策失败: {e}")
+            return {"action": "rest", "target": None, "details": "暂时休息", "volume": None}
 
     def execute_action(self, action: Dict, world):
         """执行决策的行动"""
@@ -716,11 +886,18 @@ detail的样子必须如"水,2"
 
         # 保存状态
         self.save_state()
-        chance = random.randint(1, 10)
-        if chance == 1:
-            reflection = self.memory.check_reflection(self.bailian, self.name)
-            if reflection:
-                self.chronicle.add_event(self.name, "反思", (self.x, self.y), reflection)
+        # 上次反思之后积累了足够的新材料才反思
+        if self.memory.reflection_due() and (self._pending_reflection is None
+                                             or self._pending_reflection.done()):
+            self._pending_reflection = self._spawn(self._reflect())
+
+    async def _reflect(self):
+        """后台进行反思，完成后记录到编年史"""
+        reflection = await self.memory.acheck_reflection(
+            self.bailian, self.name, priority=PRIORITY_REFLECTION
+        )
+        if reflection:
+            self.chronicle.add_event(self.name, "反思", (self.x, self.y), reflection)
 
     def draw(self, surf, offset_x, offset_y):
         """绘制NPC"""
@@ -0,0 +1,146 @@
+"""
+持久化服务 - 脏标记加后台线程批量写盘，游戏循环中不做文件IO
+"""
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from config import PERSIST_INTERVAL
+
+
+class PersistenceManager:
+    """集中管理所有状态文件的写入
+
+    - mark_dirty(path, snapshot): 整文件状态（NPC、资源、世界时间），同一文件在
+      一个周期内多次标记只写一次；snapshot在主线程调用，返回可序列化的副本
+    - append(path, text): 追加写入的日志（记忆、编年史）
+    - replace(path, data): 需要与追加保持先后顺序的整文件重写（如日志压缩），
+      data为bytes时按二进制写入（检查点），为可调用对象时在写盘线程中生成
+    - run(path, action): 与上述写入保持先后顺序、在写盘线程中执行的操作
+      （如写入冷存储数据库），path只用于出错时的日志
+
+    tick()在主循环中调用，每PERSIST_INTERVAL秒把积累的修改作为一批交给
+    写盘线程；整文件写入先写临时文件再替换。close()提交剩余修改并等待写完。
+    background=False时不启动线程，所有写入立即同步完成。
+    """
+
+    def __init__(self, interval: float = PERSIST_INTERVAL, background: bool = True):
+        self.interval = interval
+        self.background = background
+        self._dirty: Dict[str, Callable[[], Any]] = {}
+        self._ops: List[Tuple[str, str, Any]] = []
+        self._last_flush = time.monotonic()
+        self.stats = {"batches": 0, "files_written": 0, "appends": 0, "errors": 0}
+        self._queue: "queue.Queue[Optional[List[Tuple[str, str, Any]]]]" = queue.Queue()
+        self._writer = None
+        if background:
+            self._writer = threading.Thread(target=self._run, name="persistence-writer", daemon=True)
+            self._writer.start()
+
+    def mark_dirty(self, path: str, snapshot: Callable[[], Any]):
+        if not self.background:
+            self._write_batch([("replace", path, snapshot())])
+            return
+        self._dirty[path] = snapshot
+
+    def append(self, path: str, text: str):
+        if not self.background:
+            self._write_batch([("append", path, text)])
+            return
+        self._ops.append(("append", path, text))
+
+    def replace(self, path: str, data: Any):
+        if not self.background:
+            self._write_batch([("replace", path, data)])
+            return
+        # 之前标记的同一文件快照已过时
+        self._dirty.pop(path, None)
+        self._ops.append(("replace", path, data))
+
+    def run(self, path: str, action: Callable[[], None]):
+        if not self.background:
+            self._write_batch([("run", path, action)])
+            return
+        self._ops.append(("run", path, action))
+
+    def tick(self):
+        """到达提交间隔时提交一批修改"""
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """在主线程生成快照，整批交给写盘线程"""
+        self._last_flush = time.monotonic()
+        if not self._dirty and not self._ops:
+            return
+        batch = self._ops + [("replace", path, snapshot()) for path, snapshot in self._dirty.items()]
+        self._ops = []
+        self._dirty = {}
+        if self.background:
+            self._queue.put(batch)
+        else:
+            self._write_batch(batch)
+
+    def close(self):
+        """提交剩余修改并等待写盘线程结束"""
+        self.flush()
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self.background = False
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            self._write_batch(batch)
+
+    def _write_batch(self, batch: List[Tuple[str, str, Any]]):
+        # 合并同一文件的连续追加，减少打开文件的次数
+        merged: List[Tuple[str, str, Any]] = []
+        for kind, path, data in batch:
+            if kind == "append" and merged and merged[-1][0] == "append" and merged[-1][1] == path:
+                merged[-1][2].append(data)
+            elif kind == "append":
+                merged.append(("append", path, [data]))
+            else:
+                merged.append((kind, path, data))
+
+        for kind, path, data in merged:
+            try:
+                if kind == "append":
+                    with open(path, "a", encoding="utf-8") as f:
+                        f.write("".join(data))
+                    self.stats["appends"] += len(data)
+                elif kind == "run":
+                    data()
+                else:
+                    self._atomic_write(path, data)
+                    self.stats["files_written"] += 1
+            except Exception as e:
+                # 单个文件失败（包括快照无法序列化）不影响同批的其他写入，写盘线程继续运行
+                self.stats["errors"] += 1
+                logging.error(f"写入{path}失败: {e}")
+        self.stats["batches"] += 1
+
+    @staticmethod
+    def _atomic_write(path: str, data: Any):
+        if callable(data):
+            data = data()
+        tmp_path = f"{path}.tmp"
+        if isinstance(data, bytes):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            return
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            if isinstance(data, str):
+                f.write(data)
+            else:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
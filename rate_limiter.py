@@ -0,0 +1,165 @@
+"""
+大模型调用限流调度器 - 按应用ID的令牌桶限速、并发上限和优先级队列
+"""
+import time
+import heapq
+import asyncio
+import itertools
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """令牌桶：以固定速率补充令牌，允许一定的突发"""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_available(self) -> float:
+        """距离下一个令牌可用的秒数"""
+        self._refill()
+        if self.tokens >= 1.0:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (1.0 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1.0
+
+
+class _AppLane:
+    """单个应用ID的调度通道"""
+
+    def __init__(self, rate: float, burst: float, max_concurrency: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.active = 0
+        self.waiters = []  # (优先级, 序号, future)
+        self.wakeup = None  # 等待令牌补充的定时回调
+        # 累计统计：放行次数、排队等待的总秒数和最大秒数、最多同时排队的请求数
+        self.granted = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.peak_queued = 0
+
+
+class RateLimitScheduler:
+    """按应用ID限流的调度器
+
+    每个应用ID有独立的令牌桶和并发上限；等待中的请求按优先级（数值越小越优先）
+    和提交顺序出队。
+    """
+
+    def __init__(self, limits: Dict[str, Dict]):
+        self.limits = limits
+        self.lanes = {}
+        self._counter = itertools.count()
+
+    def _lane(self, app_id: str) -> _AppLane:
+        lane = self.lanes.get(app_id)
+        if lane is None:
+            config = self.limits.get(app_id, self.limits.get("default", {}))
+            lane = _AppLane(
+                config.get("requests_per_second", 1.0),
+                config.get("burst", 1.0),
+                config.get("max_concurrency", 1)
+            )
+            self.lanes[app_id] = lane
+        return lane
+
+    def _dispatch(self, lane: _AppLane):
+        """按优先级放行等待中的请求，直到并发或令牌用尽"""
+        lane.wakeup = None
+        while lane.waiters and lane.active < lane.max_concurrency:
+            future = lane.waiters[0][2]
+            if future.done():
+                # 已取消的等待者
+                heapq.heappop(lane.waiters)
+                continue
+
+            delay = lane.bucket.time_until_available()
+            if delay <= 0:
+                lane.bucket.consume()
+            if delay > 0:
+                lane.wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch, lane)
+                return
+
+            heapq.heappop(lane.waiters)
+            lane.active += 1
+            future.set_result(None)
+
+    async def acquire(self, app_id: str, priority: int = 0):
+        """等待调用许可，调用结束后必须调用release"""
+        lane = self._lane(app_id)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.waiters, (priority, next(self._counter), future))
+        lane.peak_queued = max(lane.peak_queued, len(lane.waiters))
+        if lane.wakeup is None:
+            self._dispatch(lane)
+
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已获得许可但调用方被取消，归还并发名额
+                self.release(app_id)
+            raise
+        waited = time.monotonic() - started
+        lane.granted += 1
+        lane.wait_time += waited
+        lane.max_wait = max(lane.max_wait, waited)
+
+    def release(self, app_id: str):
+        """归还并发名额并唤醒等待者"""
+        lane = self._lane(app_id)
+        lane.active = max(0, lane.active - 1)
+        if lane.waiters and lane.wakeup is None:
+            self._dispatch(lane)
+
+    def slot(self, app_id: str, priority: int = 0) -> "_Slot":
+        """async with scheduler.slot(app_id, priority): ..."""
+        return _Slot(self, app_id, priority)
+
+    def stats(self, app_id: Optional[str] = None) -> Dict:
+        """返回各应用当前的排队和并发情况，以及累计的放行次数和等待时间"""
+        app_ids = [app_id] if app_id else list(self.lanes)
+        return {
+            key: {"active": lane.active, "queued": len(lane.waiters), "granted": lane.granted,
+                  "wait_time": lane.wait_time, "max_wait": lane.max_wait, "peak_queued": lane.peak_queued}
+            for key, lane in ((key, self._lane(key)) for key in app_ids)
+        }
+
+    def report(self) -> str:
+        lines = ["限流调度（按应用）:"]
+        for app_id, stats in self.stats().items():
+            average = stats["wait_time"] / stats["granted"] if stats["granted"] else 0.0
+            lines.append(
+                f"  {app_id}: 放行{stats['granted']}次, 平均等待{average:.2f}秒(最大{stats['max_wait']:.2f}秒), "
+                f"最多排队{stats['peak_queued']}个"
+            )
+        return "\n".join(lines)
+
+
+class _Slot:
+    def __init__(self, scheduler: RateLimitScheduler, app_id: str, priority: int):
+        self.scheduler = scheduler
+        self.app_id = app_id
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.app_id, self.priority)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release(self.app_id)
+        return False
@@ -0,0 +1,114 @@
+"""
+大模型响应缓存 - 内存LRU（容量和过期时间淘汰）加可选的磁盘持久化
+"""
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Dict
+from persistence import PersistenceManager
+from config import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+
+
+class ResponseCache:
+    """以模型、角色和规范化提示词的哈希为键缓存模型回复
+
+    磁盘文件为追加写入的JSONL，重启时重放并跳过过期条目；
+    文件行数超过容量的两倍时按当前内容重写一次。追加和重写都经由
+    PersistenceManager，在写盘线程中批量完成。
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 path: Optional[str] = None, persistence: Optional[PersistenceManager] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.persistence = persistence or PersistenceManager(background=False)
+        self._entries = OrderedDict()  # key -> (过期时间, 回复)
+        self._disk_lines = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.path:
+            self._load()
+
+    @staticmethod
+    def make_key(role: str, prompt: str, kind: str = "response", model: str = "") -> str:
+        """规范化空白后计算哈希，空格和换行的差异不影响命中
+
+        model为回答该角色的后端和模型标识，换了后端或应用后不会命中旧的回复。
+        """
+        normalized = " ".join(prompt.split())
+        raw = f"{model}\x1f{kind}\x1f{role}\x1f{normalized}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, text = entry
+            if expires_at >= time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return text
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, text: str):
+        expires_at = time.time() + self.ttl
+        self._entries[key] = (expires_at, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        if self.path:
+            self._append(key, expires_at, text)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def report(self) -> str:
+        stats = self.stats()
+        return (f"响应缓存: 命中{stats['hits']}次，未命中{stats['misses']}次 (命中率{stats['hit_rate']:.1%})，"
+                f"当前{stats['entries']}条，容量淘汰{stats['evictions']}条")
+
+    def _append(self, key: str, expires_at: float, text: str):
+        record = {"key": key, "expires": expires_at, "text": text}
+        self.persistence.append(self.path, json.dumps(record, ensure_ascii=False) + "\n")
+        self._disk_lines += 1
+        if self._disk_lines > 2 * self.max_entries:
+            self._compact()
+
+    def _compact(self):
+        """按当前内存中的条目重写磁盘文件，序列化在写盘线程中进行"""
+        entries = list(self._entries.items())
+        self.persistence.replace(self.path, lambda: "".join(
+            json.dumps({"key": key, "expires": expires_at, "text": text}, ensure_ascii=False) + "\n"
+            for key, (expires_at, text) in entries))
+        self._disk_lines = len(entries)
+
+    def _load(self):
+        now = time.time()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._disk_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get("expires", 0) < now:
+                        continue
+                    self._entries[record["key"]] = (record["expires"], record["text"])
+                    self._entries.move_to_end(record["key"])
+        except FileNotFoundError:
+            return
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,79 @@
+"""
+环形缓冲区 - 固定容量、按时间戳有序的内存记录，支持二分查找“最近N条”和“某时刻之后”
+"""
+from typing import Any, Iterator, List, Optional
+
+
+class RingBuffer:
+    """固定容量的环形缓冲区
+
+    写满后新记录覆盖最旧的记录，追加和淘汰都是O(1)，不移动其他元素。
+    每条记录带一个单调不减的时间戳（比上一条小时按上一条计），
+    since(t)在逻辑位置上二分查找起点，只复制结果部分。
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError("capacity必须为正数")
+        self.capacity = capacity
+        self._items: List[Any] = [None] * capacity
+        self._timestamps: List[float] = [0.0] * capacity
+        self._head = 0  # 最旧记录所在的槽位
+        self._count = 0
+
+    def append(self, item: Any, timestamp: float):
+        if self._count:
+            timestamp = max(timestamp, self._timestamps[self._slot(self._count - 1)])
+        if self._count < self.capacity:
+            slot = self._slot(self._count)
+            self._count += 1
+        else:
+            slot = self._head
+            self._head = (self._head + 1) % self.capacity
+        self._items[slot] = item
+        self._timestamps[slot] = timestamp
+
+    def _slot(self, position: int) -> int:
+        """逻辑位置（0为最旧）对应的槽位"""
+        return (self._head + position) % self.capacity
+
+    def _range(self, start: int) -> List[Any]:
+        """逻辑位置start到末尾的记录，按时间顺序"""
+        begin = self._slot(start)
+        end = begin + self._count - start
+        if end <= self.capacity:
+            return self._items[begin:end]
+        return self._items[begin:] + self._items[:end - self.capacity]
+
+    def last(self, n: int) -> List[Any]:
+        """最近的n条记录，按时间顺序"""
+        if n <= 0:
+            return []
+        return self._range(max(0, self._count - n))
+
+    def since(self, timestamp: float) -> List[Any]:
+        """时间戳不早于timestamp的记录，按时间顺序"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamps[self._slot(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return self._range(low)
+
+    def latest_timestamp(self) -> Optional[float]:
+        if not self._count:
+            return None
+        return self._timestamps[self._slot(self._count - 1)]
+
+    def clear(self):
+        self._items = [None] * self.capacity
+        self._head = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._range(0))
@@ -0,0 +1,521 @@
+"""
+SQLite存储后端 - 所有模拟状态放在一个WAL模式的数据库中，每个tick提交一个事务
+"""
+import os
+import glob
+import json
+import time
+import sqlite3
+import logging
+import threading
+import numpy as np
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from config import STORAGE_SQLITE_PATH
+from memory_record import MemoryRecord, MEMORY_TYPE_CODES
+from memory_store import ColdMemoryStore, ensure_vector_column
+from memory_index import ngram_tokenize
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS npcs (
+        name TEXT PRIMARY KEY,
+        x REAL NOT NULL,
+        y REAL NOT NULL,
+        energy REAL NOT NULL,
+        inventory TEXT NOT NULL,
+        is_dead INTEGER NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS memories (
+        id INTEGER PRIMARY KEY,
+        owner TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        content TEXT NOT NULL,
+        type TEXT NOT NULL,
+        importance INTEGER NOT NULL,
+        resident INTEGER NOT NULL DEFAULT 1,
+        vector BLOB
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_memories_key ON memories(owner, timestamp, content);
+    CREATE INDEX IF NOT EXISTS idx_memories_resident ON memories(owner, resident, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_memories_type ON memories(owner, resident, type, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_memories_importance ON memories(owner, resident, importance, timestamp);
+    CREATE TABLE IF NOT EXISTS memory_terms (
+        term TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        memory_id INTEGER NOT NULL,
+        PRIMARY KEY (term, timestamp, memory_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS memory_vector_bounds (
+        owner TEXT PRIMARY KEY,
+        upper BLOB NOT NULL,
+        lower BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS world (
+        key TEXT PRIMARY KEY,
+        value REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS resources (
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        kind TEXT,
+        amount INTEGER NOT NULL,
+        PRIMARY KEY (x, y)
+    );
+    CREATE TABLE IF NOT EXISTS chronicle (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL NOT NULL,
+        agent TEXT NOT NULL,
+        action TEXT NOT NULL,
+        x REAL NOT NULL,
+        y REAL NOT NULL,
+        details TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_chronicle_time ON chronicle(timestamp);
+    CREATE INDEX IF NOT EXISTS idx_chronicle_agent ON chronicle(agent, timestamp);
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL NOT NULL,
+        npc1 TEXT NOT NULL,
+        npc2 TEXT NOT NULL,
+        message TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversations_time ON conversations(timestamp);
+    CREATE INDEX IF NOT EXISTS idx_conversations_pair
+        ON conversations(min(npc1, npc2), max(npc1, npc2), timestamp);
+"""
+
+
+class SqliteStorage:
+    """统一的SQLite状态存储（可选后端，STORAGE_BACKEND = "sqlite"时启用）
+
+    NPC、记忆、资源、世界时间、编年史和对话记录使用同一个数据库，
+    连接只在主线程使用：
+    - 追加类写入（记忆、编年史、对话）立即执行，落在当前事务中，
+      同一连接上的查询能看到尚未提交的内容
+    - 整体状态（NPC、资源、世界时间）与PersistenceManager.mark_dirty
+      一样只登记快照函数，提交时才生成；资源只写入变化的格子
+
+    tick()在每次游戏更新结束时调用，把这一轮的全部修改作为一个事务提交，
+    崩溃时数据库停在某个tick结束时的一致状态。
+
+    第一次打开时（meta表中没有迁移标记）把data目录下已有的JSON状态
+    一次性导入。
+    """
+
+    def __init__(self, path: str = STORAGE_SQLITE_PATH, data_dir: str = "data"):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        ensure_vector_column(self._conn)
+        self._dirty_npcs: Dict[str, Callable[[], Dict]] = {}
+        self._dirty_world: Optional[Callable[[], Dict]] = None
+        self._dirty_resources: Optional[Callable[[], Dict]] = None
+        self._saved_resources: Dict[Tuple[int, int], Tuple[Optional[str], int]] = {}
+        self.stats = {"transactions": 0, "rows": 0}
+        if self._meta("migrated_from_json") is None:
+            self.migrate_json(data_dir)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return self._conn
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _execute(self, sql: str, params: Tuple = ()) -> sqlite3.Cursor:
+        cursor = self._conn.execute(sql, params)
+        self.stats["rows"] += max(0, cursor.rowcount)
+        return cursor
+
+    def _executemany(self, sql: str, rows: Iterable[Tuple]) -> sqlite3.Cursor:
+        cursor = self._conn.executemany(sql, rows)
+        self.stats["rows"] += max(0, cursor.rowcount)
+        return cursor
+
+    # ---- 事务 ----
+
+    def tick(self):
+        """生成登记过的快照，与本轮的追加写入一起提交"""
+        for snapshot in self._dirty_npcs.values():
+            self._write_npc(snapshot())
+        self._dirty_npcs = {}
+        if self._dirty_world is not None:
+            world = self._dirty_world()
+            self._executemany("INSERT OR REPLACE INTO world(key, value) VALUES (?, ?)",
+                              [("day", world["day"]), ("time", world["time"])])
+            self._dirty_world = None
+        if self._dirty_resources is not None:
+            self._write_resources(self._dirty_resources())
+            self._dirty_resources = None
+        if self._conn.in_transaction:
+            self._conn.commit()
+            self.stats["transactions"] += 1
+
+    flush = tick
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.tick()
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._conn.close()
+        self._conn = None
+
+    # ---- NPC ----
+
+    def save_npc(self, name: str, snapshot: Callable[[], Dict]):
+        self._dirty_npcs[name] = snapshot
+
+    def _write_npc(self, state: Dict):
+        self._execute(
+            "INSERT OR REPLACE INTO npcs(name, x, y, energy, inventory, is_dead, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (state["name"], state["x"], state["y"], state["energy"],
+             json.dumps(state["inventory"], ensure_ascii=False), int(state["is_dead"]), time.time()))
+
+    @staticmethod
+    def _npc_from_row(row: Tuple) -> Dict:
+        name, x, y, energy, inventory, is_dead = row
+        return {"name": name, "x": x, "y": y, "energy": energy,
+                "inventory": json.loads(inventory), "is_dead": bool(is_dead)}
+
+    def load_npc(self, name: str) -> Optional[Dict]:
+        row = self._conn.execute(
+            "SELECT name, x, y, energy, inventory, is_dead FROM npcs WHERE name = ?", (name,)).fetchone()
+        return self._npc_from_row(row) if row else None
+
+    def npc_states(self, alive_only: bool = False) -> List[Dict]:
+        """所有NPC的状态"""
+        where = "WHERE is_dead = 0" if alive_only else ""
+        rows = self._conn.execute(
+            f"SELECT name, x, y, energy, inventory, is_dead FROM npcs {where} ORDER BY name")
+        return [self._npc_from_row(row) for row in rows]
+
+    # ---- 世界时间和资源 ----
+
+    def save_world_state(self, snapshot: Callable[[], Dict]):
+        self._dirty_world = snapshot
+
+    def load_world_state(self) -> Optional[Dict]:
+        values = dict(self._conn.execute("SELECT key, value FROM world"))
+        if "day" not in values:
+            return None
+        return {"day": int(values["day"]), "time": values.get("time", 12.0)}
+
+    def save_resources(self, snapshot: Callable[[], Dict]):
+        self._dirty_resources = snapshot
+
+    def _write_resources(self, data: Dict):
+        """只写入与上次保存不同的格子"""
+        changed = []
+        for x, (kinds, amounts) in enumerate(zip(data["resources"], data["amounts"])):
+            for y, cell in enumerate(zip(kinds, amounts)):
+                if self._saved_resources.get((x, y)) != cell:
+                    self._saved_resources[(x, y)] = cell
+                    changed.append((x, y, cell[0], cell[1]))
+        if changed:
+            self._executemany("INSERT OR REPLACE INTO resources(x, y, kind, amount) VALUES (?, ?, ?, ?)",
+                              changed)
+
+    def load_resources(self, size: int) -> Optional[Dict]:
+        rows = self._conn.execute("SELECT x, y, kind, amount FROM resources").fetchall()
+        if not rows:
+            return None
+        resources = [[None for _ in range(size)] for _ in range(size)]
+        amounts = [[0 for _ in range(size)] for _ in range(size)]
+        for x, y, kind, amount in rows:
+            if x < size and y < size:
+                resources[x][y] = kind
+                amounts[x][y] = amount
+            self._saved_resources[(x, y)] = (kind, amount)
+        return {"resources": resources, "amounts": amounts}
+
+    # ---- 记忆 ----
+
+    def append_memory(self, owner: str, memory: MemoryRecord):
+        self._execute(
+            "INSERT OR IGNORE INTO memories(owner, timestamp, content, type, importance) VALUES (?, ?, ?, ?, ?)",
+            (owner, memory.timestamp, memory.content, memory.type, memory.importance))
+
+    def load_memories(self, owner: str) -> List[MemoryRecord]:
+        """内存窗口中的记忆（未被淘汰到冷存储的），按时间顺序"""
+        rows = self._conn.execute(
+            "SELECT timestamp, content, type, importance FROM memories "
+            "WHERE owner = ? AND resident = 1 ORDER BY timestamp, id", (owner,))
+        return [MemoryRecord(timestamp, content, MEMORY_TYPE_CODES[memory_type], importance)
+                for timestamp, content, memory_type, importance in rows]
+
+    def roll_back_memories(self, owner: str, memories: List[MemoryRecord], restored_at: float):
+        """从检查点恢复：在一个事务中把owner的记忆回退到检查点时的状态并立即提交
+
+        删除restored_at之后新增的记忆，删除不在检查点窗口中的常驻记忆，
+        窗口中的记忆写回并标记为常驻（检查点之后才被淘汰的恢复为常驻，去掉其词项），
+        其余冷记忆保持不变。
+        """
+        self._execute("DELETE FROM memory_terms WHERE memory_id IN "
+                      "(SELECT id FROM memories WHERE owner = ? AND timestamp > ?)", (owner, restored_at))
+        self._execute("DELETE FROM memories WHERE owner = ? AND timestamp > ?", (owner, restored_at))
+        self._execute("DELETE FROM memories WHERE owner = ? AND resident = 1", (owner,))
+        self._executemany(
+            "INSERT INTO memories(owner, timestamp, content, type, importance, resident) "
+            "VALUES (?, ?, ?, ?, ?, 1) "
+            "ON CONFLICT(owner, timestamp, content) DO UPDATE SET resident = 1",
+            [(owner, m.timestamp, m.content, m.type, m.importance) for m in memories])
+        self._execute("DELETE FROM memory_terms WHERE memory_id IN "
+                      "(SELECT id FROM memories WHERE owner = ? AND resident = 1)", (owner,))
+        self._conn.commit()
+        self.stats["transactions"] += 1
+
+    def cold_store(self, owner: str, tokenizer: Callable[[str], Set[str]] = ngram_tokenize,
+                   embed: Optional[Callable[[str], np.ndarray]] = None) -> "SqliteColdMemoryStore":
+        return SqliteColdMemoryStore(self, owner, tokenizer, embed)
+
+    def search_memories(self, term: str, owners: Optional[List[str]] = None,
+                        limit: int = 20) -> List[Tuple[str, MemoryRecord]]:
+        """跨NPC检索包含term的记忆（含冷记忆），按时间倒序返回(所属NPC, 记忆)"""
+        clauses, params = ["content LIKE ? ESCAPE '\\'"], [f"%{ColdMemoryStore._escape(term)}%"]
+        if owners is not None:
+            clauses.append(f"owner IN ({', '.join('?' for _ in owners)})")
+            params.extend(owners)
+        rows = self._conn.execute(
+            f"SELECT owner, timestamp, content, type, importance FROM memories "
+            f"WHERE {' AND '.join(clauses)} ORDER BY timestamp DESC LIMIT ?", (*params, limit))
+        return [(owner, MemoryRecord(timestamp, content, MEMORY_TYPE_CODES[memory_type], importance))
+                for owner, timestamp, content, memory_type, importance in rows]
+
+    # ---- 编年史 ----
+
+    def append_event(self, event: Dict):
+        self._execute(
+            "INSERT INTO chronicle(timestamp, agent, action, x, y, details) VALUES (?, ?, ?, ?, ?, ?)",
+            (event["timestamp"], event["agent"], event["action"],
+             event["location"][0], event["location"][1], event["details"]))
+
+    def load_events(self) -> List[Dict]:
+        rows = self._conn.execute(
+            "SELECT timestamp, agent, action, x, y, details FROM chronicle ORDER BY id")
+        return [{"timestamp": timestamp, "agent": agent, "action": action,
+                 "location": (x, y), "details": details}
+                for timestamp, agent, action, x, y, details in rows]
+
+    # ---- 对话 ----
+
+    def conversation_log(self) -> "SqliteConversationLog":
+        return SqliteConversationLog(self)
+
+    def append_conversation(self, record: Dict):
+        self._execute(
+            "INSERT INTO conversations(timestamp, npc1, npc2, message) VALUES (?, ?, ?, ?)",
+            (record["timestamp"], record["npc1"], record["npc2"], record["message"]))
+
+    def read_conversations(self, since: Optional[float] = None, until: Optional[float] = None,
+                           limit: Optional[int] = None) -> List[Dict]:
+        """时间范围内的对话（按时间顺序），limit只保留最近的若干条"""
+        clauses, params = ["1 = 1"], []
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+        rows = self._conn.execute(
+            f"SELECT timestamp, npc1, npc2, message FROM conversations WHERE {' AND '.join(clauses)} "
+            f"ORDER BY timestamp DESC, id DESC LIMIT ?", (*params, limit if limit else -1)).fetchall()
+        rows.reverse()
+        return [{"timestamp": timestamp, "npc1": npc1, "npc2": npc2, "message": message}
+                for timestamp, npc1, npc2, message in rows]
+
+    def conversations_between(self, npc_a: str, npc_b: str, limit: int,
+                              since: Optional[float] = None) -> List[Dict]:
+        """两个NPC之间（不分说话方向）最近的limit条对话，按时间顺序"""
+        low, high = min(npc_a, npc_b), max(npc_a, npc_b)
+        clauses, params = ["min(npc1, npc2) = ?", "max(npc1, npc2) = ?"], [low, high]
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        rows = self._conn.execute(
+            f"SELECT timestamp, npc1, npc2, message FROM conversations WHERE {' AND '.join(clauses)} "
+            f"ORDER BY timestamp DESC, id DESC LIMIT ?", (*params, limit)).fetchall()
+        rows.reverse()
+        return [{"timestamp": timestamp, "npc1": npc1, "npc2": npc2, "message": message}
+                for timestamp, npc1, npc2, message in rows]
+
+    # ---- 从JSON迁移 ----
+
+    def migrate_json(self, data_dir: str = "data"):
+        """把data目录下的JSON状态一次性导入数据库（一个事务），完成后写入迁移标记"""
+        started = time.perf_counter()
+        counts = {"npcs": 0, "memories": 0, "events": 0, "conversations": 0}
+
+        for path in glob.glob(os.path.join(data_dir, "npc_*.json")):
+            state = self._read_json(path)
+            if state is not None:
+                self._write_npc(state)
+                counts["npcs"] += 1
+
+        owners = set()
+        for pattern in ("memory_*.json", "memory_*.jsonl", "memory_*_cold.db"):
+            for path in glob.glob(os.path.join(data_dir, pattern)):
+                name = os.path.basename(path)[len("memory_"):]
+                owners.add(name[:-len("_cold.db")] if name.endswith("_cold.db") else name.rsplit(".", 1)[0])
+        for owner in sorted(owners):
+            counts["memories"] += self._migrate_memories(data_dir, owner)
+
+        world = self._read_json(os.path.join(data_dir, "world_state.json"))
+        if world is not None:
+            self._executemany("INSERT OR REPLACE INTO world(key, value) VALUES (?, ?)",
+                              [("day", world.get("day", 1)), ("time", world.get("time", 12.0))])
+        resources = self._read_json(os.path.join(data_dir, "resources.json"))
+        if resources is not None:
+            self._write_resources(resources)
+
+        events = self._read_lines(os.path.join(data_dir, "chronicle.jsonl"))
+        if events is None:
+            events = self._read_json(os.path.join(data_dir, "chronicle.json")) or []
+        for event in events:
+            self.append_event(event)
+        counts["events"] = len(events)
+
+        conversations_dir = os.path.join(data_dir, "conversations")
+        if os.path.isdir(conversations_dir):
+            from conversation_log import ConversationLog
+            conversations = ConversationLog(conversations_dir, legacy_path="").read()
+        else:
+            conversations = self._read_json(os.path.join(data_dir, "conversations.json")) or []
+        for record in conversations:
+            self.append_conversation(record)
+        counts["conversations"] = len(conversations)
+
+        self._execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)",
+                      ("schema_version", str(SCHEMA_VERSION)))
+        self._execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)",
+                      ("migrated_from_json", str(time.time())))
+        self._conn.commit()
+        logging.info(f"从JSON迁移完成: {counts}，耗时{time.perf_counter() - started:.2f}秒")
+
+    def _migrate_memories(self, data_dir: str, owner: str) -> int:
+        """快照和日志中的记忆进入内存窗口，冷存储中的记忆标记为已淘汰"""
+        rows = []
+        cold_path = os.path.join(data_dir, f"memory_{owner}_cold.db")
+        if os.path.exists(cold_path):
+            cold = sqlite3.connect(cold_path)
+            try:
+                rows.extend((owner, *row, 0) for row in cold.execute(
+                    "SELECT timestamp, content, type, importance FROM memories ORDER BY timestamp"))
+            except sqlite3.DatabaseError:
+                pass
+            finally:
+                cold.close()
+        hot = (self._read_json(os.path.join(data_dir, f"memory_{owner}.json")) or []) + \
+              (self._read_lines(os.path.join(data_dir, f"memory_{owner}.jsonl")) or [])
+        rows.extend((owner, m["timestamp"], m["content"], m["type"], m["importance"], 1) for m in hot)
+        self._executemany(
+            "INSERT OR IGNORE INTO memories(owner, timestamp, content, type, importance, resident) "
+            "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    @staticmethod
+    def _read_json(path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def _read_lines(path: str) -> Optional[List[Dict]]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                records = []
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+                return records
+        except FileNotFoundError:
+            return None
+
+
+class SqliteColdMemoryStore(ColdMemoryStore):
+    """共享memories表中某个NPC已淘汰（resident = 0）的记忆
+
+    记忆在添加时已经写入表中，淘汰只需把标记改为0并写入词项；写入走存储的
+    当前事务，随tick一起提交，因此insert_later()也直接写入，不经过写盘线程。
+    """
+
+    _scope = "owner = ? AND resident = 0"
+
+    def __init__(self, storage: SqliteStorage, owner: str,
+                 tokenizer: Callable[[str], Set[str]] = ngram_tokenize,
+                 embed: Optional[Callable[[str], np.ndarray]] = None):
+        self.path = storage.path
+        self.storage = storage
+        self.owner = owner
+        self.tokenizer = tokenizer
+        self.embed = embed
+        self.vector_upper = None
+        self.vector_lower = None
+        self._bounds_owner = owner
+        self.count = 0
+        self.max_timestamp = float("-inf")
+        self.max_importance = 0
+        self._conn = storage.connection
+        self._writer_conn = None
+        self._scope_params = (owner,)
+        self._pending = []
+        self._pending_vectors = {}
+        self._pending_lock = threading.Lock()
+        self._load_stats()
+        self._backfill_terms(self._conn)
+        self._backfill_vectors(self._conn)
+
+    def insert_many(self, memories: List[MemoryRecord], vectors: Optional[np.ndarray] = None):
+        vectors = self._vectors_for(memories, vectors)
+        blobs = [v.tobytes() for v in vectors] if vectors is not None else [None] * len(memories)
+        cursor = self.storage._executemany(
+            "INSERT INTO memories(owner, timestamp, content, type, importance, resident, vector) "
+            "VALUES (?, ?, ?, ?, ?, 0, ?) "
+            "ON CONFLICT(owner, timestamp, content) DO UPDATE SET resident = 0, vector = excluded.vector "
+            "WHERE resident = 1",
+            [(self.owner, m.timestamp, m.content, m.type, m.importance, blob) for m, blob in zip(memories, blobs)])
+        self._write_terms(self._conn, memories)
+        self._store_bounds(self._conn, vectors)
+        self._add_stats(memories, max(0, cursor.rowcount), vectors)
+
+    def insert_later(self, memories: List[MemoryRecord], persistence, vectors: Optional[np.ndarray] = None):
+        self.insert_many(memories, vectors)
+
+    def close(self):
+        # 连接属于SqliteStorage
+        self._conn = None
+
+
+class SqliteConversationLog:
+    """与ConversationLog接口相同的对话记录，存放在conversations表中"""
+
+    def __init__(self, storage: SqliteStorage):
+        self.storage = storage
+        self.day = None
+
+    def set_day(self, day):
+        self.day = day
+
+    def append(self, record: Dict):
+        self.storage.append_conversation(record)
+
+    def read(self, since: Optional[float] = None, until: Optional[float] = None,
+             limit: Optional[int] = None) -> List[Dict]:
+        return self.storage.read_conversations(since, until, limit)
+
+    def flush_index(self):
+        """按时间的索引由数据库维护"""
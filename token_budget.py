@@ -0,0 +1,79 @@
+"""
+提示词token预算和用量统计
+"""
+from typing import Dict, List, Tuple
+from context_window import estimate_tokens
+
+
+def fit_lines(items: List[str], budget: int, max_item_chars: int = 80) -> List[str]:
+    """按顺序截取条目直到用完token预算，单条过长时截断"""
+    fitted = []
+    used = 0
+    for item in items:
+        text = " ".join(str(item).split())
+        if len(text) > max_item_chars:
+            text = text[:max_item_chars] + "…"
+        cost = estimate_tokens(text) + 1
+        if used + cost > budget:
+            break
+        fitted.append(text)
+        used += cost
+    return fitted
+
+
+def format_lines(items: List[str], budget: int, max_item_chars: int = 80, empty: str = "无") -> str:
+    """把条目压缩成多行文本，每行一条"""
+    fitted = fit_lines(items, budget, max_item_chars)
+    if not fitted:
+        return empty
+    return "\n".join(f"- {line}" for line in fitted)
+
+
+class TokenLedger:
+    """按角色和调用位置记录提示词与回复的token数"""
+
+    def __init__(self):
+        self.records: Dict[Tuple[str, str], Dict] = {}
+
+    def _entry(self, role: str, call_site: str) -> Dict:
+        key = (role, call_site or "unknown")
+        entry = self.records.get(key)
+        if entry is None:
+            entry = self.records[key] = {
+                "calls": 0, "cached": 0, "prompt_tokens": 0,
+                "completion_tokens": 0, "max_prompt_tokens": 0
+            }
+        return entry
+
+    def record(self, role: str, call_site: str, prompt_tokens: int, completion_tokens: int):
+        entry = self._entry(role, call_site)
+        entry["calls"] += 1
+        entry["prompt_tokens"] += prompt_tokens
+        entry["completion_tokens"] += completion_tokens
+        entry["max_prompt_tokens"] = max(entry["max_prompt_tokens"], prompt_tokens)
+
+    def record_cached(self, role: str, call_site: str):
+        self._entry(role, call_site)["cached"] += 1
+
+    def by_call_site(self) -> Dict[str, Dict]:
+        """汇总每个调用位置的用量"""
+        totals = {}
+        for (_, call_site), entry in self.records.items():
+            total = totals.setdefault(call_site, {"calls": 0, "cached": 0, "prompt_tokens": 0,
+                                                  "completion_tokens": 0, "max_prompt_tokens": 0})
+            for key in ("calls", "cached", "prompt_tokens", "completion_tokens"):
+                total[key] += entry[key]
+            total["max_prompt_tokens"] = max(total["max_prompt_tokens"], entry["max_prompt_tokens"])
+        return totals
+
+    def report(self) -> str:
+        lines = ["token用量（按调用位置）:"]
+        for call_site, total in sorted(self.by_call_site().items(),
+                                       key=lambda item: item[1]["prompt_tokens"], reverse=True):
+            average = total["prompt_tokens"] // total["calls"] if total["calls"] else 0
+            lines.append(
+                f"  {call_site}: 调用{total['calls']}次(缓存命中{total['cached']}次), "
+                f"提示词{total['prompt_tokens']}(平均{average}, 最大{total['max_prompt_tokens']}), "
+                f"回复{total['completion_tokens']}"
+            )
+        return "\n".join(lines)
@@ -55,6 +55,9 @@ class UIRenderer:
         screen.blit(title, (SCREEN_WIDTH - 390, 15))
 
         conversations = dialog_system.get_recent_conversations()
+        # 正在流式生成的发言显示在最后，时间戳为None
+        conversations += [(u["speaker"], u["listener"], u["message"] + "…", None)
+                          for u in dialog_system.get_partial_utterances()]
 
         if not conversations:
             no_conv_text = self.small_font.render("暂无对话", True, (150, 150, 150))
@@ -62,8 +65,10 @@ class UIRenderer:
         else:
             y_offset = 45
             for npc1, npc2, message, timestamp in conversations[-8:]:
-                time_diff = time.time() - timestamp
-                if time_diff < 60:
+                time_diff = time.time() - timestamp if timestamp is not None else 0
+                if timestamp is None:
+                    time_str = "说话中"
+                elif time_diff < 60:
                     time_str = f"{int(time_diff)}秒前"
                 else:
                     time_str = f"{int(time_diff / 60)}分钟前"
@@ -217,16 +222,20 @@ class UIRenderer:
             if y_offset > 280:
                 break
 
-    def draw_chronicle(self, screen, chronicle):
-        """绘制编年史"""
+    def draw_chronicle(self, screen, chronicle, selected_npc=None):
+        """绘制编年史，选中NPC时只显示该NPC的事件"""
         chronicle_rect = pygame.Rect(SCREEN_WIDTH // 4, 10, SCREEN_WIDTH // 2, 400)
         pygame.draw.rect(screen, (20, 20, 20, 200), chronicle_rect)
         pygame.draw.rect(screen, (100, 100, 100), chronicle_rect, 2)
 
-        title = self.game_font.render("全局事件编年史", True, (255, 215, 0))
+        if selected_npc is not None:
+            title = self.game_font.render(f"{selected_npc.name}的事件编年史", True, (255, 215, 0))
+            events = chronicle.events_by(selected_npc.name, limit=10)
+        else:
+            title = self.game_font.render("全局事件编年史", True, (255, 215, 0))
+            events = chronicle.get_recent_events(10)
         screen.blit(title, (chronicle_rect.centerx - title.get_width() // 2, 15))
 
-        events = chronicle.get_recent_events(10)
         y_offset = 50
 
         if not events:
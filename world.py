@@ -7,20 +7,37 @@ import random
 import math
 from typing import List
 from npc import SmartNPC
+from action_policy import RulePolicy
+from persistence import PersistenceManager
 from texture import generate_textures
 from config import *
 
 
 class World:
-    def __init__(self, bailian, dialog_system, chronicle):
-        self.tiles = self._generate_terrain()
-        self.resources = [[None for _ in range(WORLD_SIZE)] for _ in range(WORLD_SIZE)]
-        self.resource_amounts = [[0 for _ in range(WORLD_SIZE)] for _ in range(WORLD_SIZE)]
-        self._generate_resources()
-        self.load_resources()
-
-        # 加载世界状态（仅保留天数和时间）
-        self.load_world_state()
+    def __init__(self, bailian, dialog_system, chronicle, persistence=None, storage=None,
+                 checkpoint=None):
+        self.persistence = persistence or PersistenceManager(background=False)
+        self.storage = storage
+        if checkpoint is not None:
+            # 从检查点恢复：地形、资源和时间直接取自存档，不重新生成
+            if checkpoint.world_size != WORLD_SIZE:
+                raise ValueError(f"检查点的世界大小{checkpoint.world_size}与当前配置{WORLD_SIZE}不一致")
+            self.tiles = checkpoint.tiles
+            self.resources = checkpoint.resources
+            self.resource_amounts = checkpoint.amounts
+            self.day = checkpoint.day
+            self.time = checkpoint.time
+            self.save_resources()
+            self.save_world_state()
+        else:
+            self.tiles = self._generate_terrain()
+            self.resources = [[None for _ in range(WORLD_SIZE)] for _ in range(WORLD_SIZE)]
+            self.resource_amounts = [[0 for _ in range(WORLD_SIZE)] for _ in range(WORLD_SIZE)]
+            self._generate_resources()
+            self.load_resources()
+
+            # 加载世界状态（仅保留天数和时间）
+            self.load_world_state()
 
         # 地形渲染缓存
         self.terrain_surface = pygame.Surface(
@@ -32,10 +49,17 @@ class World:
         self.textures = generate_textures()
         self._pre_render_terrain()
 
+        # 本地行动策略，由所有NPC共享，统计节省的模型调用
+        self.action_policy = RulePolicy()
+
+        restored = checkpoint.npcs if checkpoint is not None else {}
         self.npcs = [
-            SmartNPC("凯", 13, 13, bailian, dialog_system, chronicle),
-            SmartNPC("伊拉拉", 14, 15, bailian, dialog_system, chronicle),
-            SmartNPC("贾克斯", 15, 14, bailian, dialog_system, chronicle),
+            SmartNPC("凯", 13, 13, bailian, dialog_system, chronicle, self.action_policy,
+                     self.persistence, storage, restored.get("凯")),
+            SmartNPC("伊拉拉", 14, 15, bailian, dialog_system, chronicle, self.action_policy,
+                     self.persistence, storage, restored.get("伊拉拉")),
+            SmartNPC("贾克斯", 15, 14, bailian, dialog_system, chronicle, self.action_policy,
+                     self.persistence, storage, restored.get("贾克斯")),
         ]
 
         # 新增：记录所有NPC的行为，用于观察
@@ -130,16 +154,24 @@ class World:
 
 
     def save_resources(self):
-        """保存资源状态到JSON"""
-        resource_data = {
-            "resources": self.resources,
-            "amounts": self.resource_amounts
+        """标记资源状态需要保存（由持久化服务或SQLite存储批量写入）"""
+        snapshot = lambda: {
+            "resources": [row[:] for row in self.resources],
+            "amounts": [row[:] for row in self.resource_amounts]
         }
-        with open("data/resources.json", "w", encoding="utf-8") as f:
-            json.dump(resource_data, f, ensure_ascii=False, indent=2)
+        if self.storage is not None:
+            self.storage.save_resources(snapshot)
+        else:
+            self.persistence.mark_dirty("data/resources.json", snapshot)
 
     def load_resources(self):
-        """从JSON加载资源状态"""
+        """从JSON或SQLite存储加载资源状态"""
+        if self.storage is not None:
+            resource_data = self.storage.load_resources(WORLD_SIZE)
+            if resource_data is not None:
+                self.resources = resource_data["resources"]
+                self.resource_amounts = resource_data["amounts"]
+            return
         try:
             with open("data/resources.json", "r", encoding="utf-8") as f:
                 resource_data = json.load(f)
@@ -204,16 +236,23 @@ class World:
         return f"第{self.day}天 {time_str}"
 
     def save_world_state(self):
-        """保存世界状态（天气和天数）到JSON"""
-        world_data = {
+        """标记世界状态（天气和天数）需要保存"""
+        snapshot = lambda: {
             "day": self.day,
             "time": self.time
         }
-        with open("data/world_state.json", "w", encoding="utf-8") as f:
-            json.dump(world_data, f, ensure_ascii=False, indent=2)
+        if self.storage is not None:
+            self.storage.save_world_state(snapshot)
+        else:
+            self.persistence.mark_dirty("data/world_state.json", snapshot)
 
     def load_world_state(self):
-        """从JSON加载世界状态（天气和天数）"""
+        """从JSON或SQLite存储加载世界状态（天气和天数）"""
+        if self.storage is not None:
+            world_data = self.storage.load_world_state() or {}
+            self.day = world_data.get("day", 1)
+            self.time = world_data.get("time", 12.0)
+            return
         try:
             with open("data/world_state.json", "r", encoding="utf-8") as f:
                 world_data = json.load(f)